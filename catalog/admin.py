@@ -24,7 +24,7 @@ class AIToolAdmin(admin.ModelAdmin):
             'fields': ('is_featured', 'popularity', 'created_at', 'updated_at')
         }),
         ('API Integration', {
-            'fields': ('api_type', 'api_endpoint', 'api_model'),
+            'fields': ('api_type', 'api_endpoint', 'api_model', 'temperature'),
             'classes': ('collapse',),
         }),
     )
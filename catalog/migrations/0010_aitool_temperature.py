@@ -0,0 +1,18 @@
+# Generated by Django 5.1.9 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0009_alter_aitool_image_alter_aitool_logo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aitool',
+            name='temperature',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
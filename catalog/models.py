@@ -29,6 +29,7 @@ class AITool(models.Model):
     api_type = models.CharField(max_length=20, choices=API_TYPE_CHOICES, default='NONE')
     api_endpoint = models.CharField(max_length=255, blank=True, null=True)
     api_model = models.CharField(max_length=100, blank=True, null=True)
+    temperature = models.FloatField(blank=True, null=True)  # Sampling temperature; empty uses the provider default
     
     class Meta:
         ordering = ['-popularity', 'name']
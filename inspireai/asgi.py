@@ -8,6 +8,7 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
+import sys
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 
@@ -17,9 +18,18 @@ from django.core.asgi import get_asgi_application
 django_asgi_app = get_asgi_application()
 
 import interaction.routing
+from interaction import lifespan
+from interaction.lifespan import lifespan_app
+
+if 'daphne.server' in sys.modules:
+    # Daphne never sends lifespan events: run the startup hooks (job worker,
+    # Gemini file sweeper) as soon as its reactor, and so the event loop, runs
+    from twisted.internet import reactor
+    reactor.callWhenRunning(reactor.callLater, 0, lifespan.start_without_lifespan)
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
+    "lifespan": lifespan_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             interaction.routing.websocket_urlpatterns
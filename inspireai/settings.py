@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 # import dotenv # python-dotenv is loaded differently
 import dj_database_url
 from dotenv import load_dotenv
@@ -181,11 +182,170 @@ LOGOUT_REDIRECT_URL = 'catalog:home'
 LOGIN_URL = 'users:login'
 
 ASGI_APPLICATION = 'inspireai.asgi.application'
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Channel layer: Redis when REDIS_URL is set (required as soon as more than one
+# Daphne worker runs, see `manage.py run_daphne_workers`), in-memory otherwise.
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+                "capacity": int(os.environ.get('CHANNEL_LAYER_CAPACITY', 1000)),
+                "expiry": int(os.environ.get('CHANNEL_LAYER_EXPIRY', 60)),
+                "prefix": os.environ.get('CHANNEL_LAYER_PREFIX', 'inspireai'),
+            },
+        }
     }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
+    }
+
+# Blocking AI provider calls (Imagen, Veo, file uploads...) run in their own
+# thread pool so they never occupy the thread used by database_sync_to_async.
+PROVIDER_EXECUTOR_MAX_WORKERS = int(os.environ.get('PROVIDER_EXECUTOR_MAX_WORKERS', 16))
+PROVIDER_EXECUTOR_MAX_QUEUE = int(os.environ.get('PROVIDER_EXECUTOR_MAX_QUEUE', 64))
+
+# Base64 decoding, format sniffing, validation and EXIF stripping of uploaded
+# media run in a process pool off the event loop (interaction/media_pool.py).
+# Payloads are handed to the workers through temp files in MEDIA_WORK_DIR.
+MEDIA_PROCESS_WORKERS = int(os.environ.get('MEDIA_PROCESS_WORKERS', 2))
+MEDIA_PROCESS_MAX_QUEUE = int(os.environ.get('MEDIA_PROCESS_MAX_QUEUE', 16))
+MEDIA_WORK_DIR = os.environ.get('MEDIA_WORK_DIR', os.path.join(tempfile.gettempdir(), 'inspireai-media'))
+
+# Uploaded images are downscaled to each provider's effective resolution and
+# re-encoded before being sent (interaction/image_variants.py). Variants are
+# stored as attachments keyed by the source image hash and profile.
+IMAGE_VARIANTS_ENABLED = os.environ.get('IMAGE_VARIANTS_ENABLED', 'True') == 'True'
+IMAGE_VARIANT_QUALITY = int(os.environ.get('IMAGE_VARIANT_QUALITY', 85))
+IMAGE_VARIANT_FORMAT = os.environ.get('IMAGE_VARIANT_FORMAT', 'WEBP')  # WEBP or JPEG
+IMAGE_VARIANT_PROFILES = {
+    # OpenAI fits images in 2048x2048, then scales the shorter side to 768 px
+    'openai': {'max_side': 2048, 'max_short_side': 768,
+               'image_format': IMAGE_VARIANT_FORMAT, 'quality': IMAGE_VARIANT_QUALITY},
+    # Gemini bills images by 768 px tiles
+    'gemini': {'max_side': int(os.environ.get('IMAGE_VARIANT_GEMINI_MAX_SIDE', 1536)), 'max_short_side': None,
+               'image_format': IMAGE_VARIANT_FORMAT, 'quality': IMAGE_VARIANT_QUALITY},
+}
+
+# Connection pool limits for the shared provider HTTP clients (interaction/providers.py)
+PROVIDER_HTTP_MAX_CONNECTIONS = int(os.environ.get('PROVIDER_HTTP_MAX_CONNECTIONS', 100))
+PROVIDER_HTTP_MAX_KEEPALIVE = int(os.environ.get('PROVIDER_HTTP_MAX_KEEPALIVE', 20))
+PROVIDER_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('PROVIDER_HTTP_KEEPALIVE_EXPIRY', 60))
+PROVIDER_HTTP_TIMEOUT = float(os.environ.get('PROVIDER_HTTP_TIMEOUT', 600))
+
+# Streamed answers are coalesced into one WebSocket frame per time window,
+# or earlier once the pending text reaches the byte limit.
+CHAT_STREAM_COALESCE_MS = int(os.environ.get('CHAT_STREAM_COALESCE_MS', 30))
+CHAT_STREAM_COALESCE_BYTES = int(os.environ.get('CHAT_STREAM_COALESCE_BYTES', 1024))
+
+# Output token limit of the text answers streamed over SSE (interaction/adapters.py)
+CHAT_MAX_OUTPUT_TOKENS = int(os.environ.get('CHAT_MAX_OUTPUT_TOKENS', 1024))
+
+# Hugging Face endpoints (interaction/huggingface.py): TGI servers are detected
+# and streamed; prompts to plain pipeline endpoints are micro-batched.
+HF_CAPABILITY_TTL = int(os.environ.get('HF_CAPABILITY_TTL', 3600))
+HF_BATCH_WINDOW_MS = int(os.environ.get('HF_BATCH_WINDOW_MS', 20))
+HF_BATCH_MAX_SIZE = int(os.environ.get('HF_BATCH_MAX_SIZE', 8))
+
+# CUSTOM tools point at self-hosted OpenAI-compatible servers (interaction/openai_compatible.py);
+# each endpoint streams at most this many answers at once.
+CUSTOM_ENDPOINT_CONCURRENCY = int(os.environ.get('CUSTOM_ENDPOINT_CONCURRENCY', 16))
+
+# Identical prompts sent to the same tool while an answer is being generated share
+# that answer (interaction/singleflight.py). Only tools whose temperature is set to
+# at most SINGLEFLIGHT_MAX_TEMPERATURE are coalesced.
+SINGLEFLIGHT_ENABLED = os.environ.get('SINGLEFLIGHT_ENABLED', 'True') == 'True'
+SINGLEFLIGHT_MAX_TEMPERATURE = float(os.environ.get('SINGLEFLIGHT_MAX_TEMPERATURE', 0.2))
+
+# Image/video/audio understanding answers are cached by media hash, request type,
+# model and prompt (interaction/result_cache.py): a per-process LRU in front of a
+# database table, each bounded in bytes. Entries expire after the TTL (seconds).
+UNDERSTANDING_CACHE_TIERS = [tier for tier in os.environ.get('UNDERSTANDING_CACHE_TIERS', 'memory,database').split(',') if tier]
+UNDERSTANDING_CACHE_TTL = int(os.environ.get('UNDERSTANDING_CACHE_TTL', 7 * 24 * 3600))
+UNDERSTANDING_CACHE_MEMORY_BYTES = int(os.environ.get('UNDERSTANDING_CACHE_MEMORY_BYTES', 16 * 1024 * 1024))
+UNDERSTANDING_CACHE_DATABASE_BYTES = int(os.environ.get('UNDERSTANDING_CACHE_DATABASE_BYTES', 256 * 1024 * 1024))
+
+# Media larger than this is uploaded with the Gemini Files API instead of sent inline.
+# Uploads are reused by later turns (interaction/gemini_files.py) until shortly before
+# the provider deletes them; a background sweep deletes files unused for the idle TTL.
+GEMINI_INLINE_MAX_BYTES = int(os.environ.get('GEMINI_INLINE_MAX_BYTES', 20 * 1024 * 1024))
+GEMINI_FILES_EXPIRY_MARGIN = int(os.environ.get('GEMINI_FILES_EXPIRY_MARGIN', 3600))
+GEMINI_FILES_IDLE_TTL = int(os.environ.get('GEMINI_FILES_IDLE_TTL', 6 * 3600))
+GEMINI_FILES_SWEEP_INTERVAL = int(os.environ.get('GEMINI_FILES_SWEEP_INTERVAL', 600))
+
+# Media of at least GEMINI_CONTEXT_CACHE_MIN_BYTES is put in a Gemini context cache
+# (interaction/context_cache.py) so later turns about it only send their new text.
+# Caches live for the TTL (seconds), extended while the conversation stays active.
+GEMINI_CONTEXT_CACHE_ENABLED = os.environ.get('GEMINI_CONTEXT_CACHE_ENABLED', 'True') == 'True'
+GEMINI_CONTEXT_CACHE_MIN_BYTES = int(os.environ.get('GEMINI_CONTEXT_CACHE_MIN_BYTES', 1024 * 1024))
+GEMINI_CONTEXT_CACHE_TTL = int(os.environ.get('GEMINI_CONTEXT_CACHE_TTL', 900))
+
+# Alternative Gemini API server (e.g. a local fake provider); empty uses Google's
+GEMINI_BASE_URL = os.environ.get('GEMINI_BASE_URL') or None
+
+# Conversation history sent with each OpenAI/Gemini message (interaction/context.py):
+# the last CHAT_HISTORY_MAX_MESSAGES messages, cut to the model's token budget (by
+# model name prefix, CHAT_HISTORY_BUDGET otherwise); older turns are kept as a
+# rolling summary of at most CHAT_HISTORY_SUMMARY_WORDS words.
+CHAT_HISTORY_MAX_MESSAGES = int(os.environ.get('CHAT_HISTORY_MAX_MESSAGES', 20))
+CHAT_HISTORY_BUDGET = int(os.environ.get('CHAT_HISTORY_BUDGET', 4000))
+CHAT_HISTORY_BUDGETS = {
+    'gpt-4o': 8000,
+    'gemini-1.5': 16000,
+    'gemini-2': 16000,
 }
+CHAT_HISTORY_SUMMARY_WORDS = int(os.environ.get('CHAT_HISTORY_SUMMARY_WORDS', 200))
+
+# Chat sockets stay open for the whole page; one that sends nothing (not even
+# heartbeat pings) for this many seconds while idle is closed by the server.
+CHAT_SOCKET_IDLE_TIMEOUT = int(os.environ.get('CHAT_SOCKET_IDLE_TIMEOUT', 120))
+
+# Chat media is uploaded over HTTP in chunks of at most this size (interaction/uploads.py)
+CHAT_UPLOAD_DIR = os.environ.get('CHAT_UPLOAD_DIR', os.path.join(BASE_DIR, 'media', 'uploads'))
+CHAT_UPLOAD_CHUNK_SIZE = int(os.environ.get('CHAT_UPLOAD_CHUNK_SIZE', 1024 * 1024))
+CHAT_UPLOAD_MAX_SIZE = int(os.environ.get('CHAT_UPLOAD_MAX_SIZE', 200 * 1024 * 1024))
+
+# Attachments in Spaces are private; the attachment view redirects the users
+# allowed to see one to a signed URL valid for this many seconds
+ATTACHMENT_URL_EXPIRY = int(os.environ.get('ATTACHMENT_URL_EXPIRY', 300))
+
+# Veo operations are polled on one shared timer per event loop (interaction/video_jobs.py)
+VEO_POLL_INTERVAL = float(os.environ.get('VEO_POLL_INTERVAL', 10))
+VEO_OPERATION_TIMEOUT = int(os.environ.get('VEO_OPERATION_TIMEOUT', 15 * 60))
+
+# Streamed answers can be resumed after a reconnect (interaction/resumable.py):
+# the last CHAT_RESUME_BUFFER_BYTES are kept per answer, which is checkpointed
+# to a draft message every CHAT_RESUME_CHECKPOINT_TOKENS tokens.
+CHAT_RESUME_BUFFER_BYTES = int(os.environ.get('CHAT_RESUME_BUFFER_BYTES', 64 * 1024))
+CHAT_RESUME_CHECKPOINT_TOKENS = int(os.environ.get('CHAT_RESUME_CHECKPOINT_TOKENS', 200))
+CHAT_RESUME_RETENTION = int(os.environ.get('CHAT_RESUME_RETENTION', 60))
+
+# AI replies, error rows and conversation touches are written in batched
+# transactions by the write-behind queue (interaction/writebehind.py)
+CHAT_WRITE_BEHIND_INTERVAL_MS = int(os.environ.get('CHAT_WRITE_BEHIND_INTERVAL_MS', 50))
+CHAT_WRITE_BEHIND_BATCH = int(os.environ.get('CHAT_WRITE_BEHIND_BATCH', 50))
+
+# Image/video generations run as durable jobs (interaction/jobs.py)
+GENERATION_JOB_CONCURRENCY = int(os.environ.get('GENERATION_JOB_CONCURRENCY', 8))
+GENERATION_JOB_LEASE_SECONDS = int(os.environ.get('GENERATION_JOB_LEASE_SECONDS', 60))
+GENERATION_JOB_MAX_ATTEMPTS = int(os.environ.get('GENERATION_JOB_MAX_ATTEMPTS', 3))
+GENERATION_JOB_SCAN_INTERVAL = float(os.environ.get('GENERATION_JOB_SCAN_INTERVAL', 5))
+
+# Admission control for provider calls (interaction/admission.py). Rates are
+# requests per minute; requests over a limit wait in a queue instead of failing.
+ADMISSION_USER_CONCURRENCY = int(os.environ.get('ADMISSION_USER_CONCURRENCY', 2))
+ADMISSION_USER_BATCH_CONCURRENCY = int(os.environ.get('ADMISSION_USER_BATCH_CONCURRENCY', 2))
+ADMISSION_USER_RATE = float(os.environ.get('ADMISSION_USER_RATE', 30))
+ADMISSION_USER_BURST = int(os.environ.get('ADMISSION_USER_BURST', 10))
+ADMISSION_USER_MAX_QUEUED = int(os.environ.get('ADMISSION_USER_MAX_QUEUED', 20))
+ADMISSION_PROVIDER_CONCURRENCY = int(os.environ.get('ADMISSION_PROVIDER_CONCURRENCY', 32))
+ADMISSION_PROVIDER_RATE = float(os.environ.get('ADMISSION_PROVIDER_RATE', 600))
+ADMISSION_PROVIDER_BURST = int(os.environ.get('ADMISSION_PROVIDER_BURST', 60))
+ADMISSION_BATCH_CONCURRENCY = int(os.environ.get('ADMISSION_BATCH_CONCURRENCY', 4))
 
 # PostHog Configuration
 # Ensure you set these environment variables in your .envrc or deployment environment
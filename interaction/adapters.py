@@ -0,0 +1,179 @@
+"""
+Streaming text adapters, one per ``AITool.api_type``.
+
+Every adapter is an async generator yielding the answer as text deltas, over
+the pooled async clients of providers.py, so callers (the SSE view) never
+hold a thread while a provider generates. Configuration problems (missing key
+or endpoint) raise :class:`AdapterError` before anything is yielded.
+"""
+import json
+import os
+
+from django.conf import settings
+from google.genai import types
+
+from . import singleflight
+from .providers import get_async_openai_client, get_gemini_client, get_http_client
+
+ANTHROPIC_API_URL = 'https://api.anthropic.com/v1/messages'
+ANTHROPIC_VERSION = '2023-06-01'
+
+
+class AdapterError(Exception):
+    """The tool cannot be called (missing API key, endpoint...)."""
+
+
+def max_output_tokens():
+    return getattr(settings, 'CHAT_MAX_OUTPUT_TOKENS', 1024)
+
+
+def system_prompt(tool):
+    return f"You are {tool.name}, an AI assistant by {tool.provider}."
+
+
+def sampling_options(tool):
+    """``temperature`` keyword for the provider call, if the tool sets one."""
+    return {'temperature': tool.temperature} if tool.temperature is not None else {}
+
+
+async def iter_sse(response):
+    """
+    Parse a ``text/event-stream`` response.
+
+    Yields:
+        ``(event, data)`` pairs; ``event`` is None for unnamed events
+    """
+    event, data = None, []
+    async for line in response.aiter_lines():
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event, data = None, []
+        elif line.startswith(':'):
+            continue  # Comment / keep-alive
+        elif line.startswith('event:'):
+            event = line[6:].strip()
+        elif line.startswith('data:'):
+            data.append(line[5:].lstrip())
+    if data:
+        yield event, '\n'.join(data)
+
+
+async def stream_openai(tool, user_message):
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        raise AdapterError("OpenAI API key not found.")
+    client = get_async_openai_client(api_key)
+    stream = await client.chat.completions.create(
+        model=tool.api_model or "gpt-4o",
+        messages=[
+            {"role": "system", "content": system_prompt(tool)},
+            {"role": "user", "content": user_message},
+        ],
+        stream=True,
+        **sampling_options(tool),
+    )
+    try:
+        async for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+    finally:
+        await stream.close()
+
+
+async def stream_gemini(tool, user_message):
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key:
+        raise AdapterError("Gemini API key not found.")
+    client = get_gemini_client(api_key)
+    stream = await client.aio.models.generate_content_stream(
+        model=tool.api_model or "gemini-2.0-flash",
+        contents=[user_message],
+        config=types.GenerateContentConfig(
+            max_output_tokens=max_output_tokens(),
+            temperature=tool.temperature if tool.temperature is not None else 0.7,
+            top_p=0.95,
+            top_k=40,
+        ),
+    )
+    async for chunk in stream:
+        if chunk.text:
+            yield chunk.text
+
+
+async def stream_huggingface(tool, user_message):
+    from .huggingface import stream
+    async for text in stream(tool, user_message):
+        yield text
+
+
+async def stream_anthropic(tool, user_message):
+    api_key = os.environ.get('ANTHROPIC_API_KEY')
+    if not api_key:
+        raise AdapterError("Anthropic API key not found.")
+
+    payload = {
+        "model": tool.api_model or "claude-3-5-haiku-latest",
+        "max_tokens": max_output_tokens(),
+        "system": system_prompt(tool),
+        "messages": [{"role": "user", "content": user_message}],
+        "stream": True,
+        **sampling_options(tool),
+    }
+    headers = {"x-api-key": api_key, "anthropic-version": ANTHROPIC_VERSION}
+    url = tool.api_endpoint or ANTHROPIC_API_URL
+    async with get_http_client().stream('POST', url, headers=headers, json=payload) as response:
+        response.raise_for_status()
+        async for event, data in iter_sse(response):
+            if event == 'content_block_delta':
+                delta = json.loads(data).get('delta', {})
+                if delta.get('type') == 'text_delta' and delta.get('text'):
+                    yield delta['text']
+            elif event == 'error':
+                raise AdapterError(json.loads(data).get('error', {}).get('message', data))
+
+
+async def stream_custom(tool, user_message):
+    from .openai_compatible import stream
+    async for text in stream(tool, user_message):
+        yield text
+
+
+async def stream_fallback(tool, user_message):
+    from .views import fallback_response
+    yield fallback_response(tool, user_message)
+
+
+ADAPTERS = {
+    'OPENAI': stream_openai,
+    'GEMINI': stream_gemini,
+    'GOOGLE': stream_gemini,
+    'HUGGINGFACE': stream_huggingface,
+    'ANTHROPIC': stream_anthropic,
+    'CUSTOM': stream_custom,
+}
+
+
+def stream_text(tool, user_message):
+    """
+    Stream a text answer from ``tool``.
+
+    Args:
+        tool: The AITool object
+        user_message: Text message from the user
+
+    Returns:
+        Async iterator of text deltas
+    """
+    adapter = ADAPTERS.get(tool.api_type, stream_fallback)
+    if adapter is not stream_fallback and singleflight.is_eligible(tool.temperature):
+        # Low-temperature answers are shared with identical requests in flight
+        key = singleflight.make_key(tool, tool.api_model, user_message,
+                                    temperature=tool.temperature, max_tokens=max_output_tokens())
+        return singleflight.stream(key, lambda: adapter(tool, user_message))
+    return adapter(tool, user_message)
+
+
+async def complete_text(tool, user_message):
+    """Collect the whole answer of :func:`stream_text` (for synchronous callers)."""
+    return ''.join([delta async for delta in stream_text(tool, user_message)])
@@ -1,10 +1,11 @@
 from django.contrib import admin
-from .models import Conversation, Message, Favorite
+from .models import Attachment, Conversation, GenerationJob, Message, Favorite, CachedContext, ImageVariant, RemoteFile, UnderstandingResult
 
 class MessageInline(admin.TabularInline):
     model = Message
     extra = 0
     readonly_fields = ('timestamp',)
+    exclude = ('attachments',)
 
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
@@ -20,6 +21,7 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ('is_from_user', 'timestamp')
     search_fields = ('content', 'conversation__user__username')
     readonly_fields = ('timestamp',)
+    raw_id_fields = ('attachments',)
     
     def content_preview(self, obj):
         if len(obj.content) > 50:
@@ -32,3 +34,47 @@ class FavoriteAdmin(admin.ModelAdmin):
     list_display = ('user', 'tool', 'added_at')
     list_filter = ('added_at',)
     search_fields = ('user__username', 'user__email', 'tool__name')
+
+@admin.register(Attachment)
+class AttachmentAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'mime_type', 'size', 'created_at')
+    list_filter = ('mime_type', 'created_at')
+    search_fields = ('sha256',)
+    readonly_fields = ('sha256', 'file', 'mime_type', 'size', 'created_at')
+    raw_id_fields = ('uploaders',)
+
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'state', 'conversation', 'attempts', 'created_at', 'updated_at')
+    list_filter = ('kind', 'state', 'created_at')
+    search_fields = ('id', 'conversation__user__username', 'prompt', 'operation_name')
+    readonly_fields = ('id', 'created_at', 'updated_at')
+    raw_id_fields = ('conversation', 'source_attachment', 'result_attachments', 'message')
+
+@admin.register(UnderstandingResult)
+class UnderstandingResultAdmin(admin.ModelAdmin):
+    list_display = ('content_hash', 'request_type', 'model', 'size', 'created_at', 'last_used_at', 'expires_at')
+    list_filter = ('request_type', 'model')
+    search_fields = ('content_hash', 'key')
+    readonly_fields = ('key', 'content_hash', 'request_type', 'model', 'size', 'created_at', 'last_used_at')
+
+@admin.register(RemoteFile)
+class RemoteFileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'mime_type', 'size', 'created_at', 'last_used_at', 'expires_at')
+    list_filter = ('mime_type',)
+    search_fields = ('sha256', 'name')
+    readonly_fields = ('sha256', 'account', 'name', 'uri', 'mime_type', 'size', 'created_at', 'last_used_at', 'expires_at')
+
+@admin.register(CachedContext)
+class CachedContextAdmin(admin.ModelAdmin):
+    list_display = ('name', 'model', 'token_count', 'created_at', 'last_used_at', 'expires_at')
+    list_filter = ('model',)
+    search_fields = ('sha256', 'name')
+    readonly_fields = ('sha256', 'account', 'model', 'name', 'token_count', 'created_at', 'last_used_at', 'expires_at')
+
+@admin.register(ImageVariant)
+class ImageVariantAdmin(admin.ModelAdmin):
+    list_display = ('source_sha256', 'profile', 'mime_type', 'width', 'height', 'source_size', 'size', 'created_at')
+    list_filter = ('profile', 'mime_type')
+    search_fields = ('source_sha256',)
+    raw_id_fields = ('attachment',)
@@ -0,0 +1,283 @@
+"""
+Admission control for provider calls.
+
+Every streamed answer and every media generation job is admitted here before it
+calls its provider. Each user and each provider (``AITool.api_type``) has a
+concurrency limit and a token bucket refilled at a steady rate. Requests over
+a limit are not rejected: they wait in the queue of their lane and are told
+their position, which is updated as the queue moves.
+
+There are two lanes. ``interactive`` (chat answers) is always served first.
+``batch`` (Imagen/Veo jobs) may only hold ``ADMISSION_BATCH_CONCURRENCY`` of a
+provider's slots, so multi-minute video generations never starve short text
+chats. Per-user concurrency is counted per lane for the same reason: a user's
+running Veo job does not delay their next chat message.
+
+Limits apply per server process, like the event loop they live on.
+"""
+import asyncio
+import contextlib
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+LANE_INTERACTIVE = 'interactive'
+LANE_BATCH = 'batch'
+LANES = (LANE_INTERACTIVE, LANE_BATCH)  # In priority order
+
+
+class AdmissionRejected(Exception):
+    """The user already has too many requests waiting."""
+
+
+def user_concurrency(lane):
+    if lane == LANE_BATCH:
+        return getattr(settings, 'ADMISSION_USER_BATCH_CONCURRENCY', 2)
+    return getattr(settings, 'ADMISSION_USER_CONCURRENCY', 2)
+
+
+def user_rate():
+    """Requests per minute and burst size of each user's token bucket."""
+    return getattr(settings, 'ADMISSION_USER_RATE', 30), getattr(settings, 'ADMISSION_USER_BURST', 10)
+
+
+def provider_concurrency():
+    return getattr(settings, 'ADMISSION_PROVIDER_CONCURRENCY', 32)
+
+
+def provider_rate():
+    """Requests per minute and burst size of each provider's token bucket."""
+    return getattr(settings, 'ADMISSION_PROVIDER_RATE', 600), getattr(settings, 'ADMISSION_PROVIDER_BURST', 60)
+
+
+def batch_concurrency():
+    return getattr(settings, 'ADMISSION_BATCH_CONCURRENCY', 4)
+
+
+def max_queued_per_user():
+    return getattr(settings, 'ADMISSION_USER_MAX_QUEUED', 20)
+
+
+class TokenBucket:
+    """
+    Holds up to ``burst`` tokens, refilled at ``rate_per_minute``.
+
+    Args:
+        rate_per_minute: Refill rate
+        burst: Bucket size (the bucket starts full)
+    """
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Ticket:
+    def __init__(self, user_id, api_type, lane):
+        self.user_id = user_id
+        self.api_type = api_type
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+        self.position = None
+        self.admitted = False
+        self.tick = None
+
+
+class AdmissionController:
+    """
+    Admission queues and limits of one event loop.
+
+    Waiters ``await acquire(...)``; :meth:`_dispatch` runs whenever a slot is
+    released, a token is due or a request arrives, admits every queued request
+    that fits (interactive lane first) and wakes the others whose position
+    changed, so position callbacks run in the waiter's own task.
+    """
+
+    def __init__(self):
+        self._queues = {lane: deque() for lane in LANES}
+        self._user_active = {}  # (user_id, lane) -> running requests
+        self._provider_active = {}  # api_type -> running requests
+        self._batch_active = {}  # api_type -> running batch requests
+        self._user_buckets = {}
+        self._provider_buckets = {}
+        self._timer = None
+
+    def _user_bucket(self, user_id):
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self._user_buckets[user_id] = TokenBucket(*user_rate())
+        return bucket
+
+    def _provider_bucket(self, api_type):
+        bucket = self._provider_buckets.get(api_type)
+        if bucket is None:
+            bucket = self._provider_buckets[api_type] = TokenBucket(*provider_rate())
+        return bucket
+
+    def _wait_time(self, ticket, now):
+        """0 if ``ticket`` can run now, the seconds until a token is due, or None if it needs a free slot."""
+        if self._user_active.get((ticket.user_id, ticket.lane), 0) >= user_concurrency(ticket.lane):
+            return None
+        if self._provider_active.get(ticket.api_type, 0) >= provider_concurrency():
+            return None
+        if ticket.lane == LANE_BATCH and self._batch_active.get(ticket.api_type, 0) >= batch_concurrency():
+            return None
+        return max(self._user_bucket(ticket.user_id).wait_time(now), self._provider_bucket(ticket.api_type).wait_time(now))
+
+    def _admit(self, ticket):
+        self._user_bucket(ticket.user_id).take()
+        self._provider_bucket(ticket.api_type).take()
+        key = (ticket.user_id, ticket.lane)
+        self._user_active[key] = self._user_active.get(key, 0) + 1
+        self._provider_active[ticket.api_type] = self._provider_active.get(ticket.api_type, 0) + 1
+        if ticket.lane == LANE_BATCH:
+            self._batch_active[ticket.api_type] = self._batch_active.get(ticket.api_type, 0) + 1
+        ticket.admitted = True
+        metrics.incr(f'admission.admitted.{ticket.lane}')
+        metrics.observe(f'admission.wait.{ticket.lane}', time.monotonic() - ticket.enqueued_at)
+
+    def _dispatch(self):
+        self._timer = None
+        now = time.monotonic()
+        next_token = None
+        for lane in LANES:
+            queue = self._queues[lane]
+            for ticket in list(queue):
+                wait = self._wait_time(ticket, now)
+                if wait == 0:
+                    queue.remove(ticket)
+                    self._admit(ticket)
+                    self._wake(ticket)
+                elif wait is not None:
+                    next_token = wait if next_token is None else min(next_token, wait)
+            for position, ticket in enumerate(queue, start=1):
+                if ticket.position != position:
+                    ticket.position = position
+                    self._wake(ticket)
+
+        if next_token is not None and next_token != float('inf'):
+            self._timer = asyncio.get_running_loop().call_later(next_token, self._dispatch)
+
+    def _wake(self, ticket):
+        if ticket.tick is not None and not ticket.tick.done():
+            ticket.tick.set_result(None)
+
+    async def acquire(self, user_id, api_type, lane=LANE_INTERACTIVE, on_queued=None):
+        """
+        Wait until a request may call its provider.
+
+        Args:
+            user_id: ID of the requesting user
+            api_type: Provider of the request (``AITool.api_type``)
+            lane: ``LANE_INTERACTIVE`` or ``LANE_BATCH``
+            on_queued: Optional coroutine function called with the queue position
+                whenever the request is queued or moves up
+
+        Returns:
+            The ticket to pass to :meth:`release`
+        """
+        if sum(1 for ticket in self._queues[lane] if ticket.user_id == user_id) >= max_queued_per_user():
+            metrics.incr(f'admission.rejected.{lane}')
+            raise AdmissionRejected("Too many requests are waiting. Please wait for your previous requests to finish.")
+
+        loop = asyncio.get_running_loop()
+        ticket = _Ticket(user_id, api_type, lane)
+        self._queues[lane].append(ticket)
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+        if not ticket.admitted:
+            metrics.incr(f'admission.queued.{lane}')
+        reported = None
+        try:
+            while not ticket.admitted:
+                if on_queued and ticket.position != reported:
+                    reported = ticket.position
+                    await on_queued(ticket.position)
+                    continue  # The queue may have moved while reporting
+                reported = ticket.position
+                ticket.tick = loop.create_future()
+                await ticket.tick
+        except BaseException:
+            if ticket.admitted:
+                self.release(ticket)
+            else:
+                self._queues[lane].remove(ticket)
+                self._dispatch_soon()
+            raise
+        return ticket
+
+    def release(self, ticket):
+        """Free the slot held by an admitted request."""
+        key = (ticket.user_id, ticket.lane)
+        self._user_active[key] -= 1
+        if not self._user_active[key]:
+            del self._user_active[key]
+        self._provider_active[ticket.api_type] -= 1
+        if ticket.lane == LANE_BATCH:
+            self._batch_active[ticket.api_type] -= 1
+        self._dispatch_soon()
+
+    def _dispatch_soon(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_soon(self._dispatch)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user_id, api_type, lane=LANE_INTERACTIVE, on_queued=None):
+        """``async with`` form of :meth:`acquire` / :meth:`release`."""
+        ticket = await self.acquire(user_id, api_type, lane, on_queued)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        return {
+            'queued': {lane: len(queue) for lane, queue in self._queues.items()},
+            'running': dict(self._provider_active),
+            'running_batch': dict(self._batch_active),
+            'users_running': len({user_id for user_id, lane in self._user_active}),
+        }
+
+
+_controllers = weakref.WeakKeyDictionary()
+
+
+def get_controller():
+    """Return the admission controller of the running event loop."""
+    loop = asyncio.get_running_loop()
+    controller = _controllers.get(loop)
+    if controller is None:
+        controller = _controllers[loop] = AdmissionController()
+    return controller
+
+
+def _stats():
+    stats = [controller.stats() for controller in list(_controllers.values())]
+    return stats[0] if len(stats) == 1 else stats
+
+
+metrics.register_collector('admission', _stats)
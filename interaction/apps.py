@@ -6,3 +6,7 @@ class InteractionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'interaction'
     verbose_name = _('AI Interactions')
+
+    def ready(self):
+        # Register signal handlers (tool changes invalidate cached chat socket state)
+        from . import signals  # noqa: F401
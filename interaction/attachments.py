@@ -0,0 +1,161 @@
+"""
+Helpers for the content-addressed attachment store.
+
+Media bytes live in the attachment storage (see ``models.attachment_storage``)
+under their SHA-256; message rows only keep the attachment URL. These helpers
+do blocking file/storage I/O, so async callers should run them with
+``sync_to_async(..., thread_sensitive=False)``.
+"""
+import base64
+import hashlib
+import io
+import mimetypes
+import re
+
+from django.core.files import File
+from django.db import IntegrityError
+from django.db.models import Q
+
+from . import metrics
+from .models import Attachment
+
+HASH_CHUNK_SIZE = 1024 * 1024
+DATA_URL_RE = re.compile(r'data:(?P<mime>[\w.+-]+/[\w.+-]+);base64,(?P<data>[A-Za-z0-9+/=]+)')
+
+
+def is_data_url(value):
+    return isinstance(value, str) and value.startswith('data:')
+
+
+def parse_data_url(data_url):
+    """
+    Split a base64 data URL.
+
+    Returns:
+        Tuple of (mime_type, decoded bytes)
+    """
+    header, encoded = data_url.split(',', 1)
+    mime_type = header.split(':')[1].split(';')[0]
+    return mime_type, base64.b64decode(encoded)
+
+
+def _storage_name(sha256, mime_type):
+    extension = mimetypes.guess_extension(mime_type) or ''
+    return f"{sha256[:2]}/{sha256}{extension}"
+
+
+def store_file(fileobj, mime_type, uploader=None):
+    """
+    Store the contents of a binary file object, deduplicating by SHA-256.
+
+    The file is hashed in chunks, so memory use does not grow with its size.
+
+    Args:
+        fileobj: Binary file object
+        mime_type: MIME type of the contents
+        uploader: User (or user ID) uploading the file, recorded as one of its uploaders
+
+    Returns:
+        The (new or existing) Attachment
+    """
+    attachment = _store_file(fileobj, mime_type)
+    if uploader is not None:
+        attachment.uploaders.add(uploader)
+    return attachment
+
+
+def store_handle(handle, uploader=None):
+    """
+    Store the decoded media of a ``media_pool.MediaHandle`` (see
+    ``MediaProcessor.decode_data_url``); its SHA-256 is already known, so the
+    file is only copied. The handle's temp file is left for the caller to discard.
+
+    Returns:
+        The (new or existing) Attachment
+    """
+    with open(handle.path, 'rb') as f:
+        attachment = _store_file(f, handle.mime_type, handle.sha256, handle.size)
+    if uploader is not None:
+        attachment.uploaders.add(uploader)
+    return attachment
+
+
+def _store_file(fileobj, mime_type, sha256=None, size=None):
+    if sha256 is None:
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in iter(lambda: fileobj.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+        sha256 = digest.hexdigest()
+
+    existing = Attachment.objects.filter(sha256=sha256).first()
+    if existing:
+        metrics.incr('attachments.deduplicated')
+        return existing
+
+    fileobj.seek(0)
+    attachment = Attachment(sha256=sha256, mime_type=mime_type, size=size)
+    attachment.file.save(_storage_name(sha256, mime_type), File(fileobj), save=False)
+    try:
+        attachment.save()
+    except IntegrityError:
+        # The same bytes were stored concurrently
+        metrics.incr('attachments.deduplicated')
+        return Attachment.objects.get(sha256=sha256)
+    metrics.incr('attachments.stored')
+    metrics.incr('attachments.stored_bytes', size)
+    return attachment
+
+
+def store_bytes(data, mime_type, uploader=None):
+    """Store raw bytes. Returns the Attachment."""
+    return store_file(io.BytesIO(data), mime_type, uploader)
+
+
+def store_data_url(data_url, uploader=None):
+    """Store the payload of a base64 data URL. Returns the Attachment."""
+    mime_type, data = parse_data_url(data_url)
+    return store_bytes(data, mime_type, uploader)
+
+
+def get_attachment(sha256):
+    return Attachment.objects.get(sha256=sha256)
+
+
+def user_attachments(user):
+    """
+    Attachments ``user`` may use: the ones they uploaded and the ones referenced
+    by messages of their own conversations. Knowing a SHA-256 is not enough.
+    """
+    return Attachment.objects.filter(
+        Q(uploaders=user) | Q(messages__conversation__user=user)
+    ).distinct()
+
+
+def read_bytes(attachment):
+    with attachment.file.open('rb') as f:
+        return f.read()
+
+
+def to_data_url(attachment):
+    """Load an attachment back as a base64 data URL for provider calls."""
+    encoded = base64.b64encode(read_bytes(attachment)).decode('ascii')
+    return f"data:{attachment.mime_type};base64,{encoded}"
+
+
+def replace_data_urls(text):
+    """
+    Replace every base64 data URL embedded in ``text`` with its attachment URL.
+
+    Returns:
+        Tuple of (new text, list of attachments)
+    """
+    stored = []
+
+    def replace(match):
+        attachment = store_data_url(match.group(0))
+        stored.append(attachment)
+        return attachment.url
+
+    return DATA_URL_RE.sub(replace, text), stored
@@ -1,37 +1,278 @@
 import json
 import os
-import io
-import base64
-import httpx
 import pathlib
 import time
 import re
 import asyncio
+import contextvars
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from openai import AsyncOpenAI
-import google.genai as genai
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from google.genai import types
-from PIL import Image
-from .models import Conversation, Message
+from .models import Attachment, Conversation, GenerationJob, Message
+from .providers import get_async_openai_client, get_gemini_client, get_http_client
+from . import adapters, admission, attachments, context, context_cache, gemini_files, image_variants, jobs, media_pool, metrics, result_cache, resumable, signals, singleflight, writebehind
+from .streaming import DeltaStreamer, estimate_tokens, negotiate_protocol
 from catalog.models import AITool
 
+# Request ID of the chat exchange being handled by the current task. Every frame
+# sent from that task is tagged with it so one socket can carry several exchanges.
+current_request_id = contextvars.ContextVar('current_request_id', default=None)
+# ID of the user message being answered by the current task; the history sent with it stops before it.
+current_message_id = contextvars.ContextVar('current_message_id', default=None)
+
+
+def has_media(url, attachment, kind):
+    """Whether the message carries uploaded media of ``kind``: a stored attachment or an inline data URL."""
+    return media_pool.holds(attachment, kind) or (url or '').startswith('data:' + media_pool.KIND_PREFIXES[kind])
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    Long-lived chat socket for one conversation.
+
+    A chat page keeps a single connection open and sends any number of
+    messages over it, each tagged with a client-chosen ``request_id``. Every
+    exchange runs in its own task and every frame it produces carries that
+    ``request_id``; ``{"type": "cancel", "request_id": ...}`` stops a streaming
+    answer and keeps what was generated so far, and ``{"type": "resume", ...}``
+    reattaches a reconnected client to an answer still streaming (see
+    resumable.py). Clients send ``{"type": "ping"}`` heartbeats; a socket that
+    stays silent for ``CHAT_SOCKET_IDLE_TIMEOUT`` seconds with no exchange in
+    flight is closed with code 4000.
+    """
+
     async def connect(self):
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
         self.room_group_name = f'chat_{self.conversation_id}'
+        self.tasks = {}
+        self.cancel_requested_at = {}
+        self.closed = False
+        self.last_activity = time.monotonic()
+        self.idle_timeout = getattr(settings, 'CHAT_SOCKET_IDLE_TIMEOUT', 120)
         user = self.scope["user"]
+        self.user_id = user.id
         if user.is_anonymous:
             await self.close()
-        else:
-            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-            await self.accept()
+            return
+
+        # The conversation and its tool are loaded and authorized once, and kept
+        # for the socket's lifetime (refreshed by tool_updated, see signals.py)
+        try:
+            self.conversation = await Conversation.objects.select_related('tool').aget(id=self.conversation_id, user=user)
+        except (Conversation.DoesNotExist, ValidationError):
+            await self.close()
+            return
+        self.tool = self.conversation.tool
+        self.tool_group_name = signals.tool_group_name(self.tool.id)
+
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_add(self.tool_group_name, self.channel_name)
+        await self.accept()
+        self.idle_watchdog = asyncio.create_task(self.watch_idle())
+        # No-op once the startup hooks ran; covers servers that run neither lifespan nor asgi.py's Daphne hook
+        jobs.get_worker().start()
+        # A (re)connecting client picks up the jobs it may have missed
+        for event in await database_sync_to_async(jobs.recent_job_events)(self.conversation_id, user):
+            await self.send_event(event)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        self.closed = True
+        watchdog = getattr(self, 'idle_watchdog', None)
+        if watchdog:
+            watchdog.cancel()
+        # In-flight exchanges keep running so their answers are still saved
+        await writebehind.get_queue().flush()
+        if hasattr(self, 'tool_group_name'):
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            await self.channel_layer.group_discard(self.tool_group_name, self.channel_name)
+
+    async def watch_idle(self):
+        """Close the socket once it has been silent for longer than the idle timeout."""
+        interval = max(1, min(30, self.idle_timeout / 2))
+        while not self.closed:
+            await asyncio.sleep(interval)
+            if not self.tasks and time.monotonic() - self.last_activity > self.idle_timeout:
+                metrics.incr('chat_socket.idle_closed')
+                await self.close(code=4000)
+                return
+
+    async def send_event(self, payload):
+        """
+        Tag a protocol frame with the current request ID and send it; frames of a
+        resumable answer go through its stream, to whichever socket is attached now.
+        """
+        request_id = current_request_id.get()
+        if request_id is not None:
+            payload = dict(payload, request_id=request_id)
+            stream = resumable.get_stream(self.user_id, request_id)
+            if stream is not None:
+                await stream.send(payload)
+                return
+        await self.deliver(payload)
+
+    async def deliver(self, payload):
+        """Send one frame on this socket (dropped once it is closed)."""
+        if self.closed:
+            return
+        await self.send(text_data=json.dumps(payload))
+
+    def open_stream(self, streamer, conversation):
+        """Make the answer streamed by ``streamer`` resumable after a reconnect."""
+        return resumable.open_stream(self.user_id, current_request_id.get(), self, streamer, conversation)
+
+    async def resume_exchange(self, request_id, offset):
+        """Attach this socket to an answer that was streaming to a dropped one."""
+        stream = resumable.get_stream(self.user_id, request_id)
+        if stream is None or str(stream.conversation.id) != str(self.conversation_id):
+            metrics.incr('chat.resume_unavailable')
+            await self.deliver({'type': 'resume_unavailable', 'request_id': request_id})
+            return
+        if stream.task is not None and not stream.task.done():
+            # Track it here too, so it can be cancelled and keeps this socket from idling out
+            self.tasks[request_id] = stream.task
+            stream.task.add_done_callback(lambda finished: self.tasks.pop(request_id, None))
+        try:
+            offset = int(offset)
+        except (TypeError, ValueError):
+            offset = None
+        await stream.resume(self, offset)
+
+    async def save_message(self, media=(), **fields):
+        """
+        Save a Message and link its attachments.
+
+        User messages are committed right away. AI answers go through the
+        write-behind queue (see writebehind.py), except the final answer of a
+        resumable stream, which is written into its draft checkpoint row.
+
+        Returns:
+            The Message, or for queued answers a future resolved with it
+        """
+        if not fields.get('is_from_user', True):
+            stream = resumable.get_stream(self.user_id, current_request_id.get())
+            draft_id = await stream.take_draft() if stream is not None else None
+            if draft_id is None:
+                return writebehind.get_queue().write(media, **fields)
+            await Message.objects.filter(id=draft_id).aupdate(is_draft=False, **fields)
+            message = await Message.objects.aget(id=draft_id)
+            writebehind.get_queue().touch(message.conversation_id)
+        else:
+            # The previous answer may still be queued: commit it first so it keeps a lower ID
+            await writebehind.get_queue().settle(fields['conversation'].pk)
+            message = await Message.objects.acreate(**fields)
+            writebehind.get_queue().touch(message.conversation_id)
+        if media:
+            await message.attachments.aadd(*media)
+        return message
+
+    async def enqueue_job(self, conversation, kind, prompt, params=None, source_attachment=None):
+        """Record a generation job for this exchange and acknowledge it to the client."""
+        job = await jobs.enqueue(conversation, kind, prompt, params, source_attachment, request_id=current_request_id.get())
+        await self.send_event(jobs.job_event(job))
+        return job
+
+    async def job_update(self, event):
+        """Relay a generation job update broadcast to the conversation group (see jobs.py)."""
+        await self.send_event(event['job'])
+
+    async def tool_updated(self, event):
+        """
+        Reload the cached tool after its configuration changed (broadcast to the
+        ``tool_<id>`` group by signals.py). Exchanges already running keep the
+        tool they started with.
+        """
+        if event.get('deleted'):
+            await self.close(code=4004)
+            return
+        try:
+            tool = await AITool.objects.aget(id=event['tool_id'])
+        except AITool.DoesNotExist:
+            await self.close(code=4004)
+            return
+        self.conversation.tool = self.tool = tool
+        metrics.incr('chat_socket.tool_reloaded')
 
     async def receive(self, text_data):
+        self.last_activity = time.monotonic()
         data = json.loads(text_data)
+        message_type = data.get('type', 'message')
+
+        if message_type == 'ping':
+            await self.send(text_data=json.dumps({'type': 'pong', 'ts': data.get('ts')}))
+            return
+
+        if message_type == 'cancel':
+            self.cancel_exchange(str(data.get('request_id')))
+            return
+
+        if message_type == 'resume':
+            await self.resume_exchange(str(data.get('request_id')), data.get('offset'))
+            return
+
+        request_id = str(data.get('request_id') or uuid.uuid4())
+        task = asyncio.create_task(self.run_exchange(request_id, data))
+        self.tasks[request_id] = task
+        task.add_done_callback(lambda finished: self.tasks.pop(request_id, None))
+
+    def cancel_exchange(self, request_id):
+        """Cancel the task streaming ``request_id``; it saves the partial answer on its way out."""
+        task = self.tasks.get(request_id)
+        if task is None or task.done():
+            return
+        self.cancel_requested_at[request_id] = time.monotonic()
+        metrics.incr('chat.cancel_requested')
+        task.cancel()
+
+    async def finish_cancelled(self, streamer, conversation, provider_stream=None, **fields):
+        """
+        End a cancelled streaming exchange: close the provider stream so generation
+        stops upstream, save the partial answer as truncated and tell the client.
+        """
+        streamer.close()
+        if provider_stream is not None:
+            close = getattr(provider_stream, 'aclose', None) or getattr(provider_stream, 'close', None)
+            try:
+                await close()
+            except Exception as e:
+                print(f"Warning: could not close provider stream: {e}")
+
+        content = streamer.content
+        if content:
+            await self.save_message(conversation=conversation, is_from_user=False, content=content, is_truncated=True, **fields)
+        await streamer.finish(truncated=True)
+
+        requested_at = self.cancel_requested_at.pop(current_request_id.get(), None)
+        if requested_at is not None:
+            metrics.observe('chat.cancel_latency', time.monotonic() - requested_at)
+        # Tokens saved: what an average completed answer would still have produced
+        generated = estimate_tokens(content)
+        completed = metrics.counter('chat.answers_completed')
+        if completed:
+            average = metrics.counter('chat.answer_tokens') / completed
+            metrics.incr('chat.cancel_tokens_saved', max(0, round(average) - generated))
+        metrics.incr('chat.cancelled')
+        metrics.incr('chat.cancel_tokens_generated', generated)
+
+    def record_answer(self, content):
+        """Count a completed streamed answer (baseline for the tokens-saved estimate)."""
+        metrics.incr('chat.answers_completed')
+        metrics.incr('chat.answer_tokens', estimate_tokens(content))
+
+    async def run_exchange(self, request_id, data):
+        current_request_id.set(request_id)
+        try:
+            await self.handle_chat_message(data)
+        except Exception as e:
+            print(f"Error handling chat message {request_id}: {e}")
+            await self.send_event({'type': 'error', 'content': f"Error processing message: {str(e)}"})
+        finally:
+            await resumable.close_stream(self.user_id, request_id)
+
+    async def handle_chat_message(self, data):
         user_message = data.get('message')
         image_url = data.get('image_url')  # Can be base64 data URL
         pdf_url = data.get('pdf_url')  # Can be base64 data URL or file URL
@@ -45,6 +286,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         is_youtube_url = data.get('is_youtube_url', False)  # Flag for YouTube URL
         is_video_understanding = data.get('is_video_understanding', False)  # Flag for video understanding requests
         is_audio_understanding = data.get('is_audio_understanding', False)  # Flag for audio understanding requests
+        attachment_id = data.get('attachment_id')  # Chunked HTTP upload referenced by ID (see uploads.py)
+        no_cache = data.get('no_cache', False)  # Skip cached understanding results (see result_cache.py)
+        # Streaming protocol version (see streaming.py); per exchange, as several can share the socket
+        protocol = negotiate_protocol(data.get('protocol', 1))
         
         print(f"DEBUG: receive method called with data:")
         print(f"DEBUG: user_message: {user_message}")
@@ -55,13 +300,45 @@ class ChatConsumer(AsyncWebsocketConsumer):
         print(f"DEBUG: is_audio_understanding: {is_audio_understanding}")
         
         user = self.scope["user"]
+        conversation, tool = self.conversation, self.tool
 
-        conversation = await database_sync_to_async(Conversation.objects.get)(id=self.conversation_id, user=user)
-        
-        @database_sync_to_async
-        def get_tool(conversation):
-            return conversation.tool
-        tool = await get_tool(conversation)
+        attachment = None
+        if attachment_id:
+            try:
+                # Only attachments this user uploaded or already has in their own messages
+                attachment = await attachments.user_attachments(user).aget(sha256=attachment_id)
+            except Attachment.DoesNotExist:
+                await self.send_event({'type': 'error', 'content': "Error loading attachment: Attachment not found."})
+                return
+            # No data URL: the media pool reads the file from storage itself (see media_pool.py)
+            media_url = attachment.url
+            mime_type = attachment.mime_type
+            if mime_type.startswith('image/'):
+                image_url = media_url
+            elif mime_type == 'application/pdf':
+                pdf_url = media_url
+                is_pdf_upload = True
+            elif mime_type.startswith('video/'):
+                video_url = media_url
+            elif mime_type.startswith('audio/'):
+                audio_url = media_url
+        else:
+            inline_url = next((url for url in (image_url, pdf_url, video_url, audio_url) if attachments.is_data_url(url)), None)
+            if inline_url:
+                # Decoded and hashed in the media pool; storing the file is plain I/O for a thread
+                try:
+                    handle = await media_pool.decode_data_url(inline_url)
+                except media_pool.MediaError as e:
+                    await self.send_event({'type': 'error', 'content': f"Error loading attachment: {e}"})
+                    return
+                try:
+                    attachment = await sync_to_async(attachments.store_handle, thread_sensitive=False)(handle, user)
+                finally:
+                    handle.discard()
+
+        def stored_url(url):
+            # Message rows keep the attachment URL instead of the base64 payload
+            return attachment.url if attachment and attachments.is_data_url(url) else url
 
         file_type = None
         if image_url:
@@ -73,101 +350,208 @@ class ChatConsumer(AsyncWebsocketConsumer):
         elif audio_url:
             file_type = 'audio'
 
-        await database_sync_to_async(Message.objects.create)(
+        user_row = await self.save_message(
+            media=[attachment] if attachment else [],
             conversation=conversation, 
             is_from_user=True, 
             content=user_message, 
-            image_url=image_url,
-            pdf_url=pdf_url,
-            video_url=video_url,
-            audio_url=audio_url,
+            image_url=stored_url(image_url),
+            pdf_url=stored_url(pdf_url),
+            video_url=stored_url(video_url),
+            audio_url=stored_url(audio_url),
             file_type=file_type
         )
+        current_message_id.set(user_row.id)
 
         if is_video_generation and tool.api_type == 'GEMINI':
-            await self.stream_veo_response(tool, user_message, conversation, user, image_url)
+            await self.start_veo_job(tool, user_message, conversation, user, attachment if image_url else None)
         elif is_image_generation and tool.api_type == 'GEMINI':
-            await self.stream_imagen_response(tool, user_message, conversation, user)
+            await self.start_imagen_job(tool, user_message, conversation, user)
         elif is_image_editing and image_url and tool.api_type == 'GEMINI':
-            await self.stream_gemini_image_edit(tool, user_message, conversation, user, image_url)
-        elif is_image_understanding and image_url and tool.api_type == 'GEMINI':
-            await self.stream_gemini_image_understanding(tool, user_message, conversation, user, image_url)
+            await self.start_gemini_image_edit_job(tool, user_message, conversation, user, image_url, attachment)
+        else:
+            # Media jobs are admitted by the job worker; answers wait for an interactive slot here
+            try:
+                ticket = await admission.get_controller().acquire(user.id, tool.api_type, on_queued=self.send_queue_position)
+            except admission.AdmissionRejected as e:
+                await self.send_event({'type': 'error', 'content': str(e)})
+                return
+            except asyncio.CancelledError:
+                # Stopped while still queued: nothing was generated
+                self.cancel_requested_at.pop(current_request_id.get(), None)
+                metrics.incr('admission.cancelled_while_queued')
+                await DeltaStreamer(self.send_event, protocol=protocol).finish(truncated=True)
+                raise
+            try:
+                await self.answer(tool, user_message, conversation, user, image_url, pdf_url, is_pdf_upload, video_url,
+                                  is_youtube_url, audio_url, attachment, is_image_understanding,
+                                  is_video_understanding, is_audio_understanding, no_cache, protocol)
+            finally:
+                admission.get_controller().release(ticket)
+
+    async def send_queue_position(self, position):
+        """Tell the client where its request waits in the admission queue (see admission.py)."""
+        await self.send_event({'type': 'queued', 'position': position})
+
+    async def answer(self, tool, user_message, conversation, user, image_url, pdf_url, is_pdf_upload, video_url,
+                     is_youtube_url, audio_url, attachment, is_image_understanding, is_video_understanding,
+                     is_audio_understanding, no_cache=False, protocol=1):
+        """Stream the provider's answer to an admitted message."""
+        if is_image_understanding and image_url and tool.api_type == 'GEMINI':
+            await self.stream_gemini_image_understanding(tool, user_message, conversation, user, image_url, attachment, no_cache)
         elif is_video_understanding and video_url and tool.api_type == 'GEMINI':
-            await self.stream_gemini_video_understanding(tool, user_message, conversation, user, video_url, is_youtube_url)
+            await self.stream_gemini_video_understanding(tool, user_message, conversation, user, video_url, is_youtube_url, no_cache,
+                                                         attachment)
         elif is_audio_understanding and audio_url and tool.api_type == 'GEMINI':
-            await self.stream_gemini_audio_understanding(tool, user_message, conversation, user, audio_url)
+            await self.stream_gemini_audio_understanding(tool, user_message, conversation, user, audio_url, attachment, no_cache)
         elif tool.api_type == 'OPENAI':
-            await self.stream_openai_response(tool, user_message, conversation, user, image_url)
+            await self.stream_openai_response(tool, user_message, conversation, user, image_url, attachment, protocol)
         elif tool.api_type == 'GEMINI':
-            await self.stream_gemini_response(tool, user_message, conversation, user, image_url, pdf_url, is_pdf_upload)
+            await self.stream_gemini_response(tool, user_message, conversation, user, image_url, pdf_url, is_pdf_upload,
+                                              attachment, protocol)
         else:
-            from .views import simulate_ai_response
-            ai_response = await database_sync_to_async(simulate_ai_response)(tool, user_message, image_url)
-            await database_sync_to_async(Message.objects.create)(
-                conversation=conversation, is_from_user=False, content=ai_response
-            )
-            await self.send(text_data=json.dumps({'type': 'ai_message', 'content': ai_response, 'done': True}))
+            await self.stream_adapter_response(tool, user_message, conversation, protocol)
 
-    async def stream_openai_response(self, tool, user_message, conversation, user, image_url=None):
+    async def stream_adapter_response(self, tool, user_message, conversation, protocol=1):
+        """Stream a text answer for the other API types (Hugging Face, Anthropic, CUSTOM...) through adapters.py."""
+        streamer = DeltaStreamer(self.send_event, protocol=protocol)
+        self.open_stream(streamer, conversation)
+        deltas = adapters.stream_text(tool, user_message)
+        try:
+            async for delta in deltas:
+                await streamer.push(delta)
+            await streamer.flush()
+            await self.save_message(conversation=conversation, is_from_user=False, content=streamer.content)
+            await streamer.finish()
+            self.record_answer(streamer.content)
+        except asyncio.CancelledError:
+            await self.finish_cancelled(streamer, conversation, deltas)
+            raise
+        except Exception as e:
+            streamer.close()
+            error_message = str(e) if isinstance(e, adapters.AdapterError) else f"Error interacting with {tool.name}: {str(e)}"
+            print(error_message)
+            writebehind.get_queue().write(conversation=conversation, is_from_user=False, content=f"Error: {error_message}")
+            await self.send_event({'type': 'error', 'content': error_message})
+
+    def shared_stream(self, tool, model, user_message, generate, media=None, **params):
+        """
+        Return ``generate()``, shared with identical requests in flight when the
+        tool samples at a low enough temperature (see singleflight.py).
+
+        Args:
+            tool: The AITool object
+            model: Model name sent to the provider
+            user_message: Text message from the user
+            generate: Callable returning the provider's async iterator of text deltas
+            media: Attachment hash or data URL sent along with the message, if any
+            **params: Other generation parameters that change the answer
+
+        Returns:
+            Async iterator of text deltas
+        """
+        if not singleflight.is_eligible(tool.temperature):
+            return generate()
+        key = singleflight.make_key(tool, model, user_message, singleflight.media_hash(media),
+                                    temperature=tool.temperature, **params)
+        return singleflight.stream(key, generate)
+
+    async def load_history(self, tool, conversation, model):
+        """Conversation history preceding the message being answered (see context.py)."""
+        try:
+            # Answers of other exchanges on this socket may still be queued
+            await writebehind.get_queue().settle(conversation.pk)
+            return await context.build_history(conversation, model, current_message_id.get(), tool.api_type)
+        except Exception as e:
+            print(f"Error loading conversation history, answering without it: {e}")
+            return context.History()
+
+    async def stream_openai_response(self, tool, user_message, conversation, user, image_url=None, attachment=None,
+                                     protocol=1):
         api_key = os.environ.get('OPENAI_API_KEY')
         model = tool.api_model or "gpt-4o"
         if not api_key:
-            await self.send(text_data=json.dumps({'type': 'error', 'content': "OpenAI API key not found."}))
+            await self.send_event({'type': 'error', 'content': "OpenAI API key not found."})
             return
-        client = AsyncOpenAI(api_key=api_key)
-        ai_content = ""
-        try:
-            if image_url and image_url.startswith('data:image'):
-                input_content = [
-                    {"type": "text", "text": user_message},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": image_url, "detail": "auto"}
-                    }
-                ]
-                messages = [
-                    {"role": "user", "content": input_content}
-                ]
-                stream = await client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    stream=True
-                )
-            else:
-                messages=[
-                    {"role": "system", "content": f"You are {tool.name}, an AI assistant by {tool.provider}."},
-                    {"role": "user", "content": user_message}
-                ]
-                stream = await client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    stream=True
-                )
+        client = get_async_openai_client(api_key)
+        image = None
+        if has_media(image_url, attachment, 'image'):
+            try:
+                # Downscaled to the resolution OpenAI actually uses (see image_variants.py)
+                image = await image_variants.prepare(image_url, 'openai', attachment)
+                image_data_url = await image.data_url()
+            except Exception as img_err:
+                await self.send_event({'type': 'error', 'content': f"Error processing image: {str(img_err)}"})
+                return
+        streamer = DeltaStreamer(self.send_event, protocol=protocol)
+        self.open_stream(streamer, conversation)
+        started_at = time.monotonic()
+        history = await self.load_history(tool, conversation, model)
+        if image:
+            input_content = [
+                {"type": "text", "text": user_message},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": image_data_url, "detail": "auto"}
+                }
+            ]
+            messages = history.openai_messages() + [
+                {"role": "user", "content": input_content}
+            ]
+        else:
+            messages = [
+                {"role": "system", "content": f"You are {tool.name}, an AI assistant by {tool.provider}."},
+                *history.openai_messages(),
+                {"role": "user", "content": user_message}
+            ]
+
+        async def generate():
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                **adapters.sampling_options(tool)
+            )
+            try:
+                async for event in stream:
+                    if hasattr(event, "choices") and event.choices:
+                        delta = event.choices[0].delta
+                        if hasattr(delta, "content") and delta.content:
+                            yield delta.content
+            finally:
+                await stream.close()
 
-            async for event in stream:
-                if hasattr(event, "choices") and event.choices:
-                    delta = event.choices[0].delta
-                    if hasattr(delta, "content") and delta.content:
-                        ai_content += delta.content
-                        await self.send(text_data=json.dumps({'type': 'ai_message', 'content': ai_content, 'done': False}))
+        deltas = self.shared_stream(tool, model, user_message, generate, image.sha256 if image else None,
+                                    history=history.digest())
+        try:
+            async for delta in deltas:
+                if not streamer.content:
+                    metrics.observe('openai.ttft', time.monotonic() - started_at)
+                await streamer.push(delta)
 
-            await database_sync_to_async(Message.objects.create)(
-                conversation=conversation, is_from_user=False, content=ai_content, image_url=None
+            await streamer.flush()
+            await self.save_message(
+                conversation=conversation, is_from_user=False, content=streamer.content, image_url=None
             )
-            await self.send(text_data=json.dumps({'type': 'ai_message', 'content': ai_content, 'done': True}))
+            await streamer.finish()
+            self.record_answer(streamer.content)
 
+        except asyncio.CancelledError:
+            await self.finish_cancelled(streamer, conversation, deltas)
+            raise
         except Exception as e:
+            streamer.close()
             error_message = f"Error interacting with OpenAI API: {str(e)}"
             print(error_message)
-            await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
+            await self.send_event({'type': 'error', 'content': error_message})
 
-    async def stream_imagen_response(self, tool, user_message, conversation, user):
+    async def start_imagen_job(self, tool, user_message, conversation, user):
         """
-        Generate images using Imagen 3 and stream the results back to the client.
+        Queue an Imagen 3 generation; the result arrives as ``job_update`` frames (see jobs.py).
         """
         api_key = os.environ.get('GEMINI_API_KEY')
         if not api_key:
-            await self.send(text_data=json.dumps({'type': 'error', 'content': "Gemini API key not found."}))
+            await self.send_event({'type': 'error', 'content': "Gemini API key not found."})
             return
 
         try:
@@ -197,121 +581,42 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         prompt_lines.append(part)
                 prompt = "\n".join(prompt_lines)
             
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': "Generating images based on your prompt...", 
-                'done': False
-            }))
-            
-            from .views import generate_imagen_image
-            result = await database_sync_to_async(generate_imagen_image)(tool, prompt, **params)
-            
-            if isinstance(result, dict) and "error" in result:
-                error_message = f"Image generation error: {result['error']}"
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=error_message
-                )
-                await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
-                return
-            
-            response_content = "Generated images based on your prompt:\n\n"
-            image_urls = []
-            
-            for i, img in enumerate(result):
-                if isinstance(img, dict) and "image_data" in img:
-                    image_data = img.get("image_data", "")
-                    image_urls.append(image_data)
-                    response_content += f"Image {i+1}: {image_data}\n\n"
-            
-            first_image_url = image_urls[0] if image_urls else None
-            await database_sync_to_async(Message.objects.create)(
-                conversation=conversation, is_from_user=False, content=response_content, image_url=first_image_url
-            )
-            
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': response_content, 
-                'done': True
-            }))
+            await self.enqueue_job(conversation, GenerationJob.KIND_IMAGEN, prompt, params)
             
         except Exception as e:
             error_message = f"Error generating images with Imagen: {str(e)}"
             print(error_message)
-            try:
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=f"Error: {error_message}"
-                )
-            except Exception as db_err:
-                print(f"Error saving error message to DB: {db_err}")
-            await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
+            await self.send_event({'type': 'error', 'content': error_message})
     
-    async def stream_gemini_image_edit(self, tool, user_message, conversation, user, image_url):
+    async def start_gemini_image_edit_job(self, tool, user_message, conversation, user, image_url, attachment):
         """
-        Edit images using Gemini and stream the results back to the client.
+        Queue a Gemini image edit of the stored ``attachment``; the result arrives as ``job_update`` frames.
         """
         api_key = os.environ.get('GEMINI_API_KEY')
         if not api_key:
-            await self.send(text_data=json.dumps({'type': 'error', 'content': "Gemini API key not found."}))
+            await self.send_event({'type': 'error', 'content': "Gemini API key not found."})
             return
 
         try:
-            if not image_url or not image_url.startswith('data:image'):
-                await self.send(text_data=json.dumps({'type': 'error', 'content': "Invalid image data for editing."}))
+            if not media_pool.holds(attachment, 'image'):
+                await self.send_event({'type': 'error', 'content': "Invalid image data for editing."})
                 return
             
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': "Editing image based on your prompt...", 
-                'done': False
-            }))
-            
-            from .views import generate_gemini_image_edit
-            result = await database_sync_to_async(generate_gemini_image_edit)(tool, user_message, image_url)
-            
-            if isinstance(result, dict) and "error" in result:
-                error_message = f"Image editing error: {result['error']}"
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=error_message
-                )
-                await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
-                return
-            
-            response_text = result.get("text", "")
-            image_urls = result.get("images", [])
-            
-            response_content = response_text + "\n\n"
-            for i, img_url in enumerate(image_urls):
-                response_content += f"Edited image {i+1}: {img_url}\n\n"
-            
-            first_image_url = image_urls[0] if image_urls else None
-            await database_sync_to_async(Message.objects.create)(
-                conversation=conversation, is_from_user=False, content=response_content, image_url=first_image_url
-            )
-            
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': response_content, 
-                'done': True
-            }))
+            await self.enqueue_job(conversation, GenerationJob.KIND_IMAGE_EDIT, user_message, source_attachment=attachment)
             
         except Exception as e:
             error_message = f"Error editing image with Gemini: {str(e)}"
             print(error_message)
-            try:
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=f"Error: {error_message}"
-                )
-            except Exception as db_err:
-                print(f"Error saving error message to DB: {db_err}")
-            await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
+            await self.send_event({'type': 'error', 'content': error_message})
     
-    async def stream_veo_response(self, tool, user_message, conversation, user, image_url=None):
+    async def start_veo_job(self, tool, user_message, conversation, user, attachment=None):
         """
-        Generate videos using Veo and stream the results back to the client.
+        Queue a Veo generation (image-to-video when ``attachment`` is an image); the
+        result and progress arrive as ``job_update`` frames.
         """
         api_key = os.environ.get('GEMINI_API_KEY')
         if not api_key:
-            await self.send(text_data=json.dumps({'type': 'error', 'content': "Gemini API key not found."}))
+            await self.send_event({'type': 'error', 'content': "Gemini API key not found."})
             return
 
         try:
@@ -348,180 +653,181 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         prompt_lines.append(part)
                 prompt = "\n".join(prompt_lines)
             
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': "Generating videos based on your prompt... This may take 2-3 minutes.", 
-                'done': False
-            }))
-            
-            from .views import generate_veo_video
-            result = await database_sync_to_async(generate_veo_video)(tool, prompt, image_url, **params)
-            
-            if isinstance(result, dict) and "error" in result:
-                error_message = f"Video generation error: {result['error']}"
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=error_message
-                )
-                await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
-                return
-            
-            response_content = "Generated videos based on your prompt:\n\n"
-            video_urls = []
-            
-            for i, video in enumerate(result):
-                if isinstance(video, dict) and "video_data" in video:
-                    video_data = video.get("video_data", "")
-                    video_urls.append(video_data)
-                    response_content += f"Video {i+1}: {video_data}\n\n"
-            
-            first_video_url = video_urls[0] if video_urls else None
-            await database_sync_to_async(Message.objects.create)(
-                conversation=conversation, is_from_user=False, content=response_content, image_url=first_video_url
-            )
-            
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': response_content, 
-                'done': True
-            }))
+            source = attachment if attachment and attachment.mime_type.startswith('image/') else None
+            await self.enqueue_job(conversation, GenerationJob.KIND_VEO, prompt, params, source_attachment=source)
             
         except Exception as e:
             error_message = f"Error generating videos with Veo: {str(e)}"
             print(error_message)
-            try:
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=f"Error: {error_message}"
-                )
-            except Exception as db_err:
-                print(f"Error saving error message to DB: {db_err}")
-            await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
+            await self.send_event({'type': 'error', 'content': error_message})
 
-    async def stream_gemini_response(self, tool, user_message, conversation, user, image_url=None, pdf_url=None, is_pdf_upload=False):
+    async def stream_gemini_response(self, tool, user_message, conversation, user, image_url=None, pdf_url=None, is_pdf_upload=False, attachment=None,
+                                     protocol=1):
         api_key = os.environ.get('GEMINI_API_KEY')
         model_name = tool.api_model or "gemini-2.0-flash"
 
         if not api_key:
-            await self.send(text_data=json.dumps({'type': 'error', 'content': "Gemini API key not found."}))
+            await self.send_event({'type': 'error', 'content': "Gemini API key not found."})
             return
 
+        streamer = DeltaStreamer(self.send_event, protocol=protocol)
+        self.open_stream(streamer, conversation)
+        deltas = None
         try:
-            client = genai.Client(api_key=api_key)
+            client = get_gemini_client(api_key)
             contents = []
-            pil_image = None
+            image = None
             pdf_data = None
-            file_obj = None
+            cached_media = None  # Large stable prefix worth a context cache
 
-            if image_url and image_url.startswith('data:image'):
+            if has_media(image_url, attachment, 'image'):
                 try:
-                    header, encoded = image_url.split(',', 1)
-                    decoded_bytes = base64.b64decode(encoded)
-                    pil_image = Image.open(io.BytesIO(decoded_bytes))
-                    contents.append(pil_image)
+                    # Decoded in a worker process and downscaled for Gemini (see image_variants.py)
+                    image = await image_variants.prepare(image_url, 'gemini', attachment)
+                    contents.append(types.Part.from_bytes(data=image.data, mime_type=image.mime_type))
                 except Exception as img_err:
-                    await self.send(text_data=json.dumps({'type': 'error', 'content': f"Error processing image: {str(img_err)}"}))
+                    await self.send_event({'type': 'error', 'content': f"Error processing image: {str(img_err)}"})
                     return
 
             if pdf_url:
                 try:
-                    await self.send(text_data=json.dumps({
+                    await self.send_event({
                         'type': 'ai_message', 
                         'content': "Processing PDF document...", 
                         'done': False
-                    }))
+                    })
 
-                    if pdf_url.startswith('data:application/pdf'):
-                        header, encoded = pdf_url.split(',', 1)
-                        pdf_bytes = base64.b64decode(encoded)
+                    if has_media(pdf_url, attachment, 'pdf'):
+                        pdf = await media_pool.process(pdf_url, 'pdf', attachment)
+                        try:
+                            pdf_bytes = await pdf.read()
+                        finally:
+                            pdf.discard()
                         
-                        if len(pdf_bytes) < 20 * 1024 * 1024:  # 20MB
+                        pdf_sha256 = pdf.sha256
+                        if len(pdf_bytes) <= gemini_files.inline_max_bytes():
                             pdf_data = types.Part.from_bytes(
                                 data=pdf_bytes,
                                 mime_type='application/pdf'
                             )
-                            contents.append(pdf_data)
                         else:
-                            pdf_io = io.BytesIO(pdf_bytes)
-                            file_obj = await database_sync_to_async(client.files.upload)(
-                                file=pdf_io,
-                                config=dict(mime_type='application/pdf')
-                            )
-                            contents.append(file_obj)
+                            # Large PDFs are uploaded once and reused by follow-up questions
+                            pdf_data = await gemini_files.get_file_part(client, api_key, pdf_bytes, 'application/pdf', pdf_sha256)
+                        contents.append(pdf_data)
+                        cached_media = context_cache.Media(pdf_data, pdf_sha256, len(pdf_bytes))
                     elif pdf_url.startswith('http'):
-                        await self.send(text_data=json.dumps({
+                        await self.send_event({
                             'type': 'ai_message', 
                             'content': "Downloading PDF from URL...", 
                             'done': False
-                        }))
+                        })
                         
-                        response = await database_sync_to_async(httpx.get)(pdf_url)
+                        response = await get_http_client().get(pdf_url)
                         pdf_bytes = response.content
                         
-                        if len(pdf_bytes) < 20 * 1024 * 1024:  # 20MB
+                        pdf_sha256 = await sync_to_async(result_cache.content_hash, thread_sensitive=False)(pdf_bytes)
+                        if len(pdf_bytes) <= gemini_files.inline_max_bytes():
                             pdf_data = types.Part.from_bytes(
                                 data=pdf_bytes,
                                 mime_type='application/pdf'
                             )
-                            contents.append(pdf_data)
                         else:
-                            pdf_io = io.BytesIO(pdf_bytes)
-                            file_obj = await database_sync_to_async(client.files.upload)(
-                                file=pdf_io,
-                                config=dict(mime_type='application/pdf')
-                            )
-                            contents.append(file_obj)
+                            pdf_data = await gemini_files.get_file_part(client, api_key, pdf_bytes, 'application/pdf', pdf_sha256)
+                        contents.append(pdf_data)
+                        cached_media = context_cache.Media(pdf_data, pdf_sha256, len(pdf_bytes))
                 except Exception as pdf_err:
-                    await self.send(text_data=json.dumps({'type': 'error', 'content': f"Error processing PDF: {str(pdf_err)}"}))
+                    await self.send_event({'type': 'error', 'content': f"Error processing PDF: {str(pdf_err)}"})
                     return
 
-            contents.append(user_message)
+            contents.append(types.Part(text=user_message))
+            history = await self.load_history(tool, conversation, model_name)
+            # Earlier turns first, then this message with its media as one user turn
+            request_contents = history.gemini_contents() + [types.Content(role='user', parts=contents)]
+
+            # Use the native async client so each chunk is forwarded as soon as it arrives
+            started_at = time.monotonic()
+            temperature = tool.temperature if tool.temperature is not None else 0.7
 
-            response_stream = await database_sync_to_async(client.models.generate_content_stream)(
-                model=model_name,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    max_output_tokens=2048,
-                    temperature=0.7,
-                    top_p=0.95,
-                    top_k=40
+            async def generate():
+                # A PDF asked about again is served from its context cache (see context_cache.py)
+                response_stream = context_cache.generate_content_stream(
+                    client, api_key, model_name, request_contents,
+                    dict(max_output_tokens=2048, temperature=temperature, top_p=0.95, top_k=40),
+                    cached_media
                 )
-            )
-            
-            ai_content = ""
-            response_iter = await database_sync_to_async(lambda: list(response_stream))()
-            
-            for chunk in response_iter:
-                if hasattr(chunk, 'text') and chunk.text:
-                    ai_content += chunk.text
-                    await self.send(text_data=json.dumps({'type': 'ai_message', 'content': ai_content, 'done': False}))
-                    await asyncio.sleep(0.01)
+                async for chunk in response_stream:
+                    if hasattr(chunk, 'text') and chunk.text:
+                        yield chunk.text
 
-            if file_obj:
-                try:
-                    await database_sync_to_async(client.files.delete)(file_obj.name)
-                except Exception as del_err:
-                    print(f"Warning: Could not delete temporary file: {str(del_err)}")
+            media = attachment.sha256 if attachment else (image.sha256 if image else None) or pdf_url
+            deltas = self.shared_stream(tool, model_name, user_message, generate, media, max_tokens=2048,
+                                        history=history.digest())
+            async for delta in deltas:
+                if not streamer.content:
+                    metrics.observe('gemini.ttft', time.monotonic() - started_at)
+                await streamer.push(delta)
+            await streamer.flush()
 
-            await database_sync_to_async(Message.objects.create)(
+            stored_pdf = attachment if is_pdf_upload and attachment and attachment.mime_type == 'application/pdf' else None
+            await self.save_message(
+                media=[stored_pdf] if stored_pdf else [],
                 conversation=conversation, 
                 is_from_user=False, 
-                content=ai_content, 
+                content=streamer.content, 
                 image_url=None,
-                pdf_url=pdf_url if is_pdf_upload else None,
+                pdf_url=(stored_pdf.url if stored_pdf else pdf_url) if is_pdf_upload else None,
                 file_type='pdf' if is_pdf_upload else None
             )
-            await self.send(text_data=json.dumps({'type': 'ai_message', 'content': ai_content, 'done': True}))
+            await streamer.finish()
+            self.record_answer(streamer.content)
 
+        except asyncio.CancelledError:
+            await self.finish_cancelled(streamer, conversation, deltas)
+            raise
         except Exception as e:
+            streamer.close()
             error_message = f"Error interacting with Gemini API: {str(e)}"
             print(error_message)
-            try:
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=f"Error: {error_message}"
-                )
-            except Exception as db_err:
-                 print(f"Error saving error message to DB: {db_err}")
-            await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
-    async def stream_gemini_image_understanding(self, tool, user_message, conversation, user, image_url):
+            writebehind.get_queue().write(conversation=conversation, is_from_user=False, content=f"Error: {error_message}")
+            await self.send_event({'type': 'error', 'content': error_message})
+    async def understand(self, client, model_name, contents, media_hash, request_type, prompt, processing_message,
+                         no_cache=False, cached_media=None):
+        """
+        Run a Gemini understanding request through the result cache (see result_cache.py).
+
+        Args:
+            client: Gemini client
+            model_name: Gemini model
+            contents: Media parts and prompt sent to the model
+            media_hash: SHA-256 of the media (or of its URL)
+            request_type: Kind of request, e.g. ``image_caption``
+            prompt: Prompt sent with the media
+            processing_message: Progress message shown while the model runs
+            no_cache: Skip the cache lookup (the fresh answer is still stored)
+            cached_media: Large media part worth a Gemini context cache (see context_cache.py)
+
+        Returns:
+            The model's text ('' if it answered nothing)
+        """
+        cache = result_cache.get_cache()
+        key = result_cache.make_key(media_hash, request_type, model_name, prompt)
+        if not no_cache:
+            text = await cache.get(key)
+            if text is not None:
+                return text
+
+        await self.send_event({'type': 'ai_message', 'content': processing_message, 'done': False})
+        response = await context_cache.generate_content(
+            client, os.environ.get('GEMINI_API_KEY'), model_name, contents,
+            dict(max_output_tokens=2048, temperature=0.2, top_p=0.95, top_k=40),
+            cached_media
+        )
+        text = response.text if hasattr(response, 'text') and response.text else ''
+        await cache.set(key, text, media_hash, request_type, model_name)
+        return text
+
+    async def stream_gemini_image_understanding(self, tool, user_message, conversation, user, image_url, attachment=None,
+                                                no_cache=False):
         """
         Process images using Gemini for understanding tasks (captioning, object detection, segmentation).
         
@@ -531,30 +837,29 @@ class ChatConsumer(AsyncWebsocketConsumer):
             conversation: The Conversation object
             user: The User object
             image_url: Base64 encoded image data
+            attachment: Stored Attachment for the image, used for the overlay image source
+            no_cache: Ask the model again even if the answer is cached
         """
         api_key = os.environ.get('GEMINI_API_KEY')
         model_name = "gemini-1.5-flash"  # Use the Gemini 1.5 model that supports images
 
         if not api_key:
-            await self.send(text_data=json.dumps({'type': 'error', 'content': "Gemini API key not found."}))
+            await self.send_event({'type': 'error', 'content': "Gemini API key not found."})
             return
 
         try:
-            client = genai.Client(api_key=api_key)
+            client = get_gemini_client(api_key)
             contents = []
-            pil_image = None
 
-            if not image_url or not image_url.startswith('data:image'):
-                await self.send(text_data=json.dumps({'type': 'error', 'content': "Invalid image data for understanding."}))
+            if not has_media(image_url, attachment, 'image'):
+                await self.send_event({'type': 'error', 'content': "Invalid image data for understanding."})
                 return
 
             try:
-                header, encoded = image_url.split(',', 1)
-                decoded_bytes = base64.b64decode(encoded)
-                pil_image = Image.open(io.BytesIO(decoded_bytes))
-                contents.append(pil_image)
+                image = await image_variants.prepare(image_url, 'gemini', attachment)
+                contents.append(types.Part.from_bytes(data=image.data, mime_type=image.mime_type))
             except Exception as img_err:
-                await self.send(text_data=json.dumps({'type': 'error', 'content': f"Error processing image: {str(img_err)}"}))
+                await self.send_event({'type': 'error', 'content': f"Error processing image: {str(img_err)}"})
                 return
 
             request_type = "caption"  # Default to captioning
@@ -573,29 +878,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 prompt = user_message if user_message else "Caption this image in detail. Describe what you see."
                 contents.append(prompt)
 
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': f"Processing image for {request_type}...", 
-                'done': False
-            }))
-
-            response = await database_sync_to_async(client.models.generate_content)(
-                model=model_name,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    max_output_tokens=2048,
-                    temperature=0.2,
-                    top_p=0.95,
-                    top_k=40
-                )
-            )
-
-            ai_content = ""
+            media_hash = image.sha256
+            ai_content = await self.understand(client, model_name, contents, media_hash, f"image_{request_type}", prompt,
+                                               f"Processing image for {request_type}...", no_cache)
             bounding_boxes = []
             segmentation = []
+            display_url = attachment.url if attachment else image_url
 
-            if hasattr(response, 'text') and response.text:
-                ai_content = response.text
+            if ai_content:
 
                 if request_type == "detect" and "[" in ai_content and "]" in ai_content:
                     try:
@@ -603,7 +893,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         bounding_boxes = json.loads(json_text)
                         
                         box_html = "<div class='bounding-box-container' style='position: relative; display: inline-block;'>"
-                        box_html += f"<img src='{image_url}' style='max-width: 100%; height: auto;' />"
+                        box_html += f"<img src='{display_url}' style='max-width: 100%; height: auto;' />"
                         
                         for box in bounding_boxes:
                             if "box_2d" in box and "label" in box:
@@ -656,7 +946,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         segmentation = json.loads(json_text)
                         
                         segment_html = "<div class='segmentation-container' style='position: relative; display: inline-block;'>"
-                        segment_html += f"<img src='{image_url}' style='max-width: 100%; height: auto;' />"
+                        segment_html += f"<img src='{display_url}' style='max-width: 100%; height: auto;' />"
                         
                         for i, segment in enumerate(segmentation):
                             if "box_2d" in segment and "label" in segment and "mask" in segment:
@@ -705,26 +995,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     except json.JSONDecodeError:
                         pass  # Not valid JSON, just use the text response
 
-            await database_sync_to_async(Message.objects.create)(
+            await self.save_message(
                 conversation=conversation,
                 is_from_user=False,
                 content=ai_content,
                 image_url=None
             )
             
-            await self.send(text_data=json.dumps({'type': 'ai_message', 'content': ai_content, 'done': True}))
+            await self.send_event({'type': 'ai_message', 'content': ai_content, 'done': True})
 
         except Exception as e:
             error_message = f"Error processing image understanding request: {str(e)}"
             print(error_message)
-            try:
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=f"Error: {error_message}"
-                )
-            except Exception as db_err:
-                print(f"Error saving error message to DB: {db_err}")
-            await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
-    async def stream_gemini_video_understanding(self, tool, user_message, conversation, user, video_url, is_youtube_url=False):
+            writebehind.get_queue().write(conversation=conversation, is_from_user=False, content=f"Error: {error_message}")
+            await self.send_event({'type': 'error', 'content': error_message})
+    async def stream_gemini_video_understanding(self, tool, user_message, conversation, user, video_url, is_youtube_url=False,
+                                                no_cache=False, attachment=None):
         """
         Process videos using Gemini for understanding tasks (description, timestamps, transcription).
         
@@ -735,6 +1021,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             user: The User object
             video_url: Base64 encoded video data, file URL, or YouTube URL
             is_youtube_url: Whether the video_url is a YouTube URL
+            no_cache: Ask the model again even if the answer is cached
+            attachment: The stored Attachment of the video, if any
         """
         print(f"DEBUG: stream_gemini_video_understanding called with is_youtube_url={is_youtube_url}")
         print(f"DEBUG: video_url starts with: {video_url[:50]}...")
@@ -743,37 +1031,49 @@ class ChatConsumer(AsyncWebsocketConsumer):
         model_name = "gemini-1.5-flash"  # Use the Gemini 1.5 model that supports video
         
         if not api_key:
-            await self.send(text_data=json.dumps({'type': 'error', 'content': "Gemini API key not found."}))
+            await self.send_event({'type': 'error', 'content': "Gemini API key not found."})
             return
         
         try:
-            client = genai.Client(api_key=api_key)
+            client = get_gemini_client(api_key)
             contents = []
+            cached_media = None  # Uploaded video, worth a context cache when asked about again
             
             if is_youtube_url:
                 if not video_url or not (video_url.startswith('http://') or video_url.startswith('https://')):
-                    await self.send(text_data=json.dumps({'type': 'error', 'content': "Invalid YouTube URL for video understanding."}))
+                    await self.send_event({'type': 'error', 'content': "Invalid YouTube URL for video understanding."})
                     return
                     
                 # Create file_data content for YouTube URL
                 contents.append(types.Part(
                     file_data=types.FileData(file_uri=video_url)
                 ))
+                media_hash = result_cache.content_hash(video_url)
                 
-            elif video_url and video_url.startswith('data:video'):
+            elif has_media(video_url, attachment, 'video'):
                 try:
-                    header, encoded = video_url.split(',', 1)
-                    decoded_bytes = base64.b64decode(encoded)
+                    video = await media_pool.process(video_url, 'video', attachment)
+                    try:
+                        decoded_bytes = await video.read()
+                    finally:
+                        video.discard()
                     
-                    mime_type = header.split(':')[1].split(';')[0]
-                    contents.append(types.Part(
-                        inline_data=types.Blob(data=decoded_bytes, mime_type=mime_type)
-                    ))
+                    mime_type = video.mime_type
+                    media_hash = video.sha256
+                    if len(decoded_bytes) <= gemini_files.inline_max_bytes():
+                        video_part = types.Part(
+                            inline_data=types.Blob(data=decoded_bytes, mime_type=mime_type)
+                        )
+                    else:
+                        # Large videos are uploaded once and reused by follow-up questions
+                        video_part = await gemini_files.get_file_part(client, api_key, decoded_bytes, mime_type, media_hash)
+                    contents.append(video_part)
+                    cached_media = context_cache.Media(video_part, media_hash, len(decoded_bytes))
                 except Exception as video_err:
-                    await self.send(text_data=json.dumps({'type': 'error', 'content': f"Error processing video: {str(video_err)}"}))
+                    await self.send_event({'type': 'error', 'content': f"Error processing video: {str(video_err)}"})
                     return
             else:
-                await self.send(text_data=json.dumps({'type': 'error', 'content': "Invalid video data for understanding."}))
+                await self.send_event({'type': 'error', 'content': "Invalid video data for understanding."})
                 return
             
             request_type = "describe"
@@ -796,27 +1096,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 
             contents.append(types.Part(text=prompt))
             
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': f"Processing video for {request_type}...", 
-                'done': False
-            }))
+            ai_content = await self.understand(client, model_name, contents, media_hash, f"video_{request_type}", prompt,
+                                               f"Processing video for {request_type}...", no_cache, cached_media)
             
-            response = await database_sync_to_async(client.models.generate_content)(
-                model=model_name,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    max_output_tokens=2048,
-                    temperature=0.2,
-                    top_p=0.95,
-                    top_k=40
-                )
-            )
-            
-            ai_content = ""
-            
-            if hasattr(response, 'text') and response.text:
-                ai_content = response.text
+            if ai_content:
                 
                 # Add video playback if it's a YouTube URL
                 if is_youtube_url:
@@ -830,7 +1113,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     """
                     ai_content = video_embed + ai_content
             
-            await database_sync_to_async(Message.objects.create)(
+            await self.save_message(
                 conversation=conversation,
                 is_from_user=False,
                 content=ai_content,
@@ -838,20 +1121,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 file_type='video'
             )
             
-            await self.send(text_data=json.dumps({'type': 'ai_message', 'content': ai_content, 'done': True}))
+            await self.send_event({'type': 'ai_message', 'content': ai_content, 'done': True})
         
         except Exception as e:
             error_message = f"Error processing video understanding request: {str(e)}"
             print(error_message)
-            try:
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=f"Error: {error_message}"
-                )
-            except Exception as db_err:
-                print(f"Error saving error message to DB: {db_err}")
-            await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
+            writebehind.get_queue().write(conversation=conversation, is_from_user=False, content=f"Error: {error_message}")
+            await self.send_event({'type': 'error', 'content': error_message})
             
-    async def stream_gemini_audio_understanding(self, tool, user_message, conversation, user, audio_url):
+    async def stream_gemini_audio_understanding(self, tool, user_message, conversation, user, audio_url, attachment=None,
+                                                no_cache=False):
         """
         Process audio using Gemini for understanding tasks (description, transcription, timestamp analysis).
         
@@ -861,6 +1140,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             conversation: The Conversation object
             user: The User object
             audio_url: Base64 encoded audio data or file URL
+            attachment: Stored Attachment for the audio, used for the player and the saved message
+            no_cache: Ask the model again even if the answer is cached
         """
         print(f"DEBUG: stream_gemini_audio_understanding called")
         print(f"DEBUG: audio_url starts with: {audio_url[:50]}...")
@@ -869,38 +1150,39 @@ class ChatConsumer(AsyncWebsocketConsumer):
         model_name = "gemini-2.0-flash"  # Use the Gemini 2.0 model that supports audio
         
         if not api_key:
-            await self.send(text_data=json.dumps({'type': 'error', 'content': "Gemini API key not found."}))
+            await self.send_event({'type': 'error', 'content': "Gemini API key not found."})
             return
         
         try:
-            client = genai.Client(api_key=api_key)
+            client = get_gemini_client(api_key)
             contents = []
             
-            is_large_file = False
+            cached_media = None
             
-            if audio_url and audio_url.startswith('data:audio'):
+            if has_media(audio_url, attachment, 'audio'):
                 try:
-                    header, encoded = audio_url.split(',', 1)
-                    decoded_bytes = base64.b64decode(encoded)
-                    
-                    if len(decoded_bytes) > 20 * 1024 * 1024:
-                        is_large_file = True
-                        
-                        await self.send(text_data=json.dumps({
-                            'type': 'error', 
-                            'content': "Audio file is too large (>20MB). Please use a smaller file."
-                        }))
-                        return
+                    audio = await media_pool.process(audio_url, 'audio', attachment)
+                    try:
+                        decoded_bytes = await audio.read()
+                    finally:
+                        audio.discard()
                     
-                    mime_type = header.split(':')[1].split(';')[0]
-                    contents.append(types.Part(
-                        inline_data=types.Blob(data=decoded_bytes, mime_type=mime_type)
-                    ))
+                    mime_type = audio.mime_type
+                    media_hash = audio.sha256
+                    if len(decoded_bytes) > gemini_files.inline_max_bytes():
+                        # Too large to send inline: uploaded once and reused by follow-up questions
+                        audio_part = await gemini_files.get_file_part(client, api_key, decoded_bytes, mime_type, media_hash)
+                    else:
+                        audio_part = types.Part(
+                            inline_data=types.Blob(data=decoded_bytes, mime_type=mime_type)
+                        )
+                    contents.append(audio_part)
+                    cached_media = context_cache.Media(audio_part, media_hash, len(decoded_bytes))
                 except Exception as audio_err:
-                    await self.send(text_data=json.dumps({'type': 'error', 'content': f"Error processing audio: {str(audio_err)}"}))
+                    await self.send_event({'type': 'error', 'content': f"Error processing audio: {str(audio_err)}"})
                     return
             else:
-                await self.send(text_data=json.dumps({'type': 'error', 'content': "Invalid audio data for understanding."}))
+                await self.send_event({'type': 'error', 'content': "Invalid audio data for understanding."})
                 return
             
             request_type = "describe"
@@ -929,29 +1211,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 
             contents.append(types.Part(text=prompt))
             
-            await self.send(text_data=json.dumps({
-                'type': 'ai_message', 
-                'content': f"Processing audio for {request_type}...", 
-                'done': False
-            }))
-            
-            response = await database_sync_to_async(client.models.generate_content)(
-                model=model_name,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    max_output_tokens=2048,
-                    temperature=0.2,
-                    top_p=0.95,
-                    top_k=40
-                )
-            )
-            
-            ai_content = ""
+            ai_content = await self.understand(client, model_name, contents, media_hash, f"audio_{request_type}", prompt,
+                                               f"Processing audio for {request_type}...", no_cache, cached_media)
             
-            if hasattr(response, 'text') and response.text:
-                ai_content = response.text
+            if ai_content:
                 
-                if audio_url and audio_url.startswith('data:audio'):
+                if has_media(audio_url, attachment, 'audio'):
                     audio_embed = f"""
                     <div class="audio-container my-3" style="max-width: 100%; border-radius: 8px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); padding: 10px; background-color: #f8f9fa;">
                         <div class="d-flex align-items-center mb-2">
@@ -959,30 +1224,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
                             <span class="fw-bold">Audio Analysis</span>
                         </div>
                         <audio controls style="width: 100%;">
-                            <source src="{audio_url}" type="{audio_url.split(';')[0].split(':')[1]}">
+                            <source src="{attachment.url if attachment else audio_url}" type="{mime_type}">
                             Your browser does not support the audio element.
                         </audio>
                     </div>
                     """
                     ai_content = audio_embed + ai_content
             
-            await database_sync_to_async(Message.objects.create)(
+            await self.save_message(
+                media=[attachment] if attachment else [],
                 conversation=conversation,
                 is_from_user=False,
                 content=ai_content,
-                audio_url=audio_url,
+                audio_url=attachment.url if attachment else audio_url,
                 file_type='audio'
             )
             
-            await self.send(text_data=json.dumps({'type': 'ai_message', 'content': ai_content, 'done': True}))
+            await self.send_event({'type': 'ai_message', 'content': ai_content, 'done': True})
         
         except Exception as e:
             error_message = f"Error processing audio understanding request: {str(e)}"
             print(error_message)
-            try:
-                await database_sync_to_async(Message.objects.create)(
-                    conversation=conversation, is_from_user=False, content=f"Error: {error_message}"
-                )
-            except Exception as db_err:
-                print(f"Error saving error message to DB: {db_err}")
-            await self.send(text_data=json.dumps({'type': 'error', 'content': error_message}))
+            writebehind.get_queue().write(conversation=conversation, is_from_user=False, content=f"Error: {error_message}")
+            await self.send_event({'type': 'error', 'content': error_message})
@@ -0,0 +1,250 @@
+"""
+Conversation history sent along with each chat message.
+
+Providers only see what a request contains, so :func:`build_history` gives them
+the conversation so far within a token budget:
+
+* Only the last ``CHAT_HISTORY_MAX_MESSAGES`` messages are loaded, with their
+  text columns only (the media URL columns, which may hold old base64 payloads,
+  are deferred).
+* Tokens are counted locally with tiktoken (a requirement); if its encoding
+  cannot be loaded they are estimated at about four characters per token.
+* The newest turns are kept while they fit the model's budget
+  (``CHAT_HISTORY_BUDGETS``, by model name prefix, or ``CHAT_HISTORY_BUDGET``).
+* Older turns are represented by a rolling summary stored on the
+  Conversation. It is written once, then extended in the background with only
+  the messages that fell out of the window since (``summary_until``); it is
+  never recomputed from scratch.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import re
+
+from django.conf import settings
+from google.genai import types
+
+from . import metrics
+from .models import Conversation, Message
+from .providers import get_async_openai_client, get_gemini_client
+from .streaming import estimate_tokens
+
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+SUMMARY_OPENAI_MODEL = 'gpt-4o-mini'
+SUMMARY_GEMINI_MODEL = 'gemini-2.0-flash'
+# Characters of each message passed to the summarizer
+SUMMARY_MESSAGE_CHARS = 2000
+# Messages folded into the summary per update; a long backlog is caught up over several turns
+SUMMARY_BATCH = 40
+
+
+def max_messages():
+    return getattr(settings, 'CHAT_HISTORY_MAX_MESSAGES', 20)
+
+
+def budget(model):
+    """History token budget of ``model``: the longest matching prefix of CHAT_HISTORY_BUDGETS."""
+    budgets = getattr(settings, 'CHAT_HISTORY_BUDGETS', {})
+    prefixes = [prefix for prefix in budgets if (model or '').startswith(prefix)]
+    if prefixes:
+        return budgets[max(prefixes, key=len)]
+    return getattr(settings, 'CHAT_HISTORY_BUDGET', 4000)
+
+
+def summary_words():
+    return getattr(settings, 'CHAT_HISTORY_SUMMARY_WORDS', 200)
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Not an OpenAI model: its own tokenizer is close enough for budgeting
+            return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        # The encoding files are downloaded on first use
+        print(f"Could not load a tiktoken encoding for {model!r}, estimating tokens: {e}")
+        return None
+
+
+def count_tokens(text, model=''):
+    """Number of tokens of ``text`` for ``model`` (tiktoken, or an estimate if it is unavailable)."""
+    encoding = _encoding(model or '')
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_text(message):
+    # Understanding answers embed HTML overlays and players; the model only needs the text
+    return HTML_TAG_RE.sub('', message.content or '').strip()
+
+
+class History:
+    """Summary and recent turns of a conversation, oldest first."""
+
+    def __init__(self, summary='', turns=(), tokens=0):
+        self.summary = summary
+        self.turns = list(turns)  # (role, text) with role 'user' or 'assistant'
+        self.tokens = tokens
+
+    def openai_messages(self):
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": SUMMARY_PREFIX + self.summary})
+        messages.extend({"role": role, "content": text} for role, text in self.turns)
+        return messages
+
+    def gemini_contents(self):
+        contents = []
+        if self.summary:
+            contents.append(types.Content(role='user', parts=[types.Part(text=SUMMARY_PREFIX + self.summary)]))
+        contents.extend(
+            types.Content(role='model' if role == 'assistant' else 'user', parts=[types.Part(text=text)])
+            for role, text in self.turns
+        )
+        return contents
+
+    def digest(self):
+        """Hash of the history, so identical prompts in different conversations are not mixed up."""
+        material = json.dumps([self.summary, self.turns])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+async def build_history(conversation, model, before_id=None, api_type=None):
+    """
+    Load the history preceding a message, fitted to the budget of ``model``.
+
+    Args:
+        conversation: The Conversation object
+        model: Model the history is sent to
+        before_id: ID of the message being answered; only older messages are included
+        api_type: ``AITool.api_type`` used to extend the summary when turns fall out of the budget
+
+    Returns:
+        :class:`History`
+    """
+    row = await Conversation.objects.filter(pk=conversation.pk).values('summary', 'summary_until').afirst()
+    summary, summary_until = (row['summary'], row['summary_until'] or 0) if row else ('', 0)
+
+    messages = Message.objects.filter(conversation_id=conversation.pk, is_draft=False, id__gt=summary_until)
+    if before_id is not None:
+        messages = messages.filter(id__lt=before_id)
+    recent = [message async for message in messages.only('id', 'is_from_user', 'content').order_by('-id')[:max_messages()]]
+
+    limit = budget(model)
+    used = count_tokens(summary, model) if summary else 0
+    turns = []
+    first_kept = before_id
+    for message in recent:
+        text = message_text(message)
+        if not text or (not message.is_from_user and text.startswith('Error:')):
+            first_kept = message.id
+            continue
+        tokens = count_tokens(text, model)
+        if used + tokens > limit:
+            break
+        used += tokens
+        turns.append(('user' if message.is_from_user else 'assistant', text))
+        first_kept = message.id
+    turns.reverse()
+    metrics.incr('history.builds')
+    metrics.incr('history.tokens', used)
+
+    if first_kept is not None and api_type and await messages.filter(id__lt=first_kept).aexists():
+        # Some turns no longer fit: fold them into the summary for the next messages
+        schedule_summary(conversation.pk, api_type, first_kept)
+    return History(summary, turns, used)
+
+
+async def summarize(api_type, previous, transcript):
+    """
+    Extend ``previous`` with ``transcript`` using a small model of the tool's provider.
+
+    Returns:
+        The new summary, or None if the provider has no summarizer
+    """
+    prompt = (
+        "Update the summary of a conversation between a user and an AI assistant with the new messages below. "
+        "Keep names, facts, decisions and open questions. "
+        f"Answer with the summary only, in at most {summary_words()} words.\n\n"
+        f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"
+    )
+    max_tokens = summary_words() * 2
+    if api_type == 'OPENAI' and os.environ.get('OPENAI_API_KEY'):
+        client = get_async_openai_client(os.environ['OPENAI_API_KEY'])
+        response = await client.chat.completions.create(
+            model=SUMMARY_OPENAI_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            temperature=0.2,
+        )
+        return (response.choices[0].message.content or '').strip() or None
+    if api_type in ('GEMINI', 'GOOGLE') and os.environ.get('GEMINI_API_KEY'):
+        client = get_gemini_client(os.environ['GEMINI_API_KEY'])
+        response = await client.aio.models.generate_content(
+            model=SUMMARY_GEMINI_MODEL,
+            contents=[prompt],
+            config=types.GenerateContentConfig(max_output_tokens=max_tokens, temperature=0.2),
+        )
+        return (response.text or '').strip() or None
+    return None
+
+
+async def update_summary(conversation_id, api_type, until_id):
+    """Fold the messages older than ``until_id`` that are not summarized yet into the summary."""
+    row = await Conversation.objects.filter(pk=conversation_id).values('summary', 'summary_until').afirst()
+    if row is None:
+        return
+    since = row['summary_until'] or 0
+    messages = [
+        message async for message in Message.objects.filter(
+            conversation_id=conversation_id, is_draft=False, id__gt=since, id__lt=until_id
+        ).only('id', 'is_from_user', 'content').order_by('id')[:SUMMARY_BATCH]
+    ]
+    if not messages:
+        return
+    transcript = '\n'.join(
+        f"{'User' if message.is_from_user else 'Assistant'}: {message_text(message)[:SUMMARY_MESSAGE_CHARS]}"
+        for message in messages if message_text(message)
+    )
+    summary = await summarize(api_type, row['summary'], transcript)
+    if not summary:
+        return
+    # Only if nobody extended the summary meanwhile
+    await Conversation.objects.filter(pk=conversation_id, summary_until=row['summary_until']).aupdate(
+        summary=summary, summary_until=messages[-1].id
+    )
+    metrics.incr('history.summaries')
+    metrics.incr('history.summarized_messages', len(messages))
+
+
+_summarizing = {}  # conversation ID -> summary task
+
+
+def schedule_summary(conversation_id, api_type, until_id):
+    """Run :func:`update_summary` in the background (once at a time per conversation)."""
+    if conversation_id in _summarizing:
+        return
+
+    async def run():
+        try:
+            await update_summary(conversation_id, api_type, until_id)
+        except Exception as e:
+            print(f"Error summarizing conversation {conversation_id}: {e}")
+            metrics.incr('history.summary_errors')
+
+    task = _summarizing[conversation_id] = asyncio.ensure_future(run())
+    task.add_done_callback(lambda finished: _summarizing.pop(conversation_id, None))
+
+
+metrics.register_collector('history', lambda: {'summarizing': len(_summarizing)})
@@ -0,0 +1,260 @@
+"""
+Gemini context caching for conversations about one large file.
+
+Every follow-up question about the same PDF, video or audio file sends the whole
+file again as input tokens. Media of at least ``GEMINI_CONTEXT_CACHE_MIN_BYTES``
+is instead placed in a provider-side cached content (``client.aio.caches``) the
+first time it is used, and later turns only send their new text with
+``cached_content`` set. Caches are recorded as ``CachedContext`` rows keyed by
+media hash, model and API key, so every worker reuses them. They live
+``GEMINI_CONTEXT_CACHE_TTL`` seconds, and their TTL is extended while turns keep
+using them.
+
+When a cache has expired on the provider's side, or cannot be created (for
+instance media under the model's minimum token count), the request is sent
+uncached as before. Per-turn latency and input tokens are recorded separately
+for cached and uncached turns; ``manage.py bench_context_cache`` compares both
+against a local fake provider.
+"""
+import asyncio
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+from google.genai import errors, types
+
+from . import metrics
+from .gemini_files import account_id
+from .models import CachedContext
+
+# Media the provider refused to cache is not retried for this long
+UNCACHEABLE_RETRY_SECONDS = 3600
+# Bound on remembered refusals; the oldest are forgotten first
+UNCACHEABLE_MAX_ENTRIES = 10000
+# Caches closer than this to their expiry are not used any more
+EXPIRY_MARGIN = timedelta(seconds=30)
+# Errors meaning the cached content is gone or unusable: retry without it
+CACHE_ERROR_CODES = (400, 403, 404)
+
+
+def enabled():
+    return getattr(settings, 'GEMINI_CONTEXT_CACHE_ENABLED', True)
+
+
+def min_bytes():
+    return getattr(settings, 'GEMINI_CONTEXT_CACHE_MIN_BYTES', 1024 * 1024)
+
+
+def ttl():
+    return getattr(settings, 'GEMINI_CONTEXT_CACHE_TTL', 900)
+
+
+class Media:
+    """The large, stable part of a prompt (a PDF, video or audio part) and its identity."""
+
+    def __init__(self, part, sha256, size):
+        self.part = part
+        self.sha256 = sha256
+        self.size = size
+
+
+_uncacheable = {}  # (account, sha256, model) -> monotonic time after which caching is tried again, oldest first
+_creating = {}  # (account, sha256, model) -> create task, shared by concurrent turns
+
+
+def _mark_uncacheable(key):
+    now = time.monotonic()
+    # Every entry lives as long, so insertion order is expiry order
+    for stale in list(_uncacheable):
+        if _uncacheable[stale] > now and len(_uncacheable) < UNCACHEABLE_MAX_ENTRIES:
+            break
+        del _uncacheable[stale]
+    _uncacheable.pop(key, None)
+    _uncacheable[key] = now + UNCACHEABLE_RETRY_SECONDS
+
+
+def _is_uncacheable(key):
+    until = _uncacheable.get(key)
+    if until is None:
+        return False
+    if until <= time.monotonic():
+        del _uncacheable[key]
+        return False
+    return True
+
+
+async def _create(client, key, model, media):
+    account, sha256, model = key
+    try:
+        cache = await client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(contents=[media.part], ttl=f"{ttl()}s"),
+        )
+    except Exception as e:
+        print(f"Could not create a Gemini context cache for {model}: {e}")
+        metrics.incr('gemini.context_cache.create_failed')
+        _mark_uncacheable(key)
+        return None
+
+    now = timezone.now()
+    usage = getattr(cache, 'usage_metadata', None)
+    try:
+        await CachedContext.objects.aupdate_or_create(account=account, sha256=sha256, model=model, defaults={
+            'name': cache.name,
+            'token_count': (usage.total_token_count or 0) if usage else 0,
+            'last_used_at': now,
+            'expires_at': cache.expire_time or now + timedelta(seconds=ttl()),
+        })
+    except IntegrityError:
+        pass  # Another worker recorded its own cache meanwhile; ours simply expires
+    metrics.incr('gemini.context_cache.created')
+    return cache.name
+
+
+async def _refresh(client, entry, now):
+    try:
+        cache = await client.aio.caches.update(
+            name=entry.name,
+            config=types.UpdateCachedContentConfig(ttl=f"{ttl()}s"),
+        )
+    except Exception as e:
+        print(f"Could not refresh Gemini context cache {entry.name}: {e}")
+        await CachedContext.objects.filter(pk=entry.pk).adelete()
+        return None
+    await CachedContext.objects.filter(pk=entry.pk).aupdate(
+        last_used_at=now, expires_at=cache.expire_time or now + timedelta(seconds=ttl())
+    )
+    metrics.incr('gemini.context_cache.refreshed')
+    return entry.name
+
+
+async def cache_name(client, api_key, model, media):
+    """
+    Return the name of a cached content holding ``media``, creating it if
+    needed, or None when the request should be sent uncached.
+    """
+    if media is None or not enabled() or media.size < min_bytes():
+        return None
+    key = (account_id(api_key), media.sha256, model)
+    if _is_uncacheable(key):
+        return None
+
+    now = timezone.now()
+    entry = await CachedContext.objects.filter(account=key[0], sha256=media.sha256, model=model,
+                                               expires_at__gt=now + EXPIRY_MARGIN).afirst()
+    if entry is not None:
+        metrics.incr('gemini.context_cache.reused')
+        if entry.expires_at - now < timedelta(seconds=ttl() / 2):
+            # The conversation is still active: keep the cache alive for another TTL
+            return await _refresh(client, entry, now)
+        await CachedContext.objects.filter(pk=entry.pk).aupdate(last_used_at=now)
+        return entry.name
+
+    task = _creating.get(key)
+    if task is None:
+        task = _creating[key] = asyncio.ensure_future(_create(client, key, model, media))
+        task.add_done_callback(lambda finished: _creating.pop(key, None))
+    return await asyncio.shield(task)
+
+
+def _without(contents, part):
+    # The part may be passed on its own or inside the user turn's Content
+    result = []
+    for content in contents:
+        if content is part:
+            continue
+        if isinstance(content, types.Content) and any(p is part for p in content.parts or []):
+            content = types.Content(role=content.role, parts=[p for p in content.parts if p is not part])
+        result.append(content)
+    return result
+
+
+def _request(model, contents, config, media, name):
+    if name:
+        contents = _without(contents, media.part)
+        config = dict(config, cached_content=name)
+    return {'model': model, 'contents': contents, 'config': types.GenerateContentConfig(**config)}
+
+
+async def _with_fallback(client, api_key, model, media, send):
+    name = await cache_name(client, api_key, model, media)
+    started_at = time.monotonic()
+    if name:
+        try:
+            return await send(name), True, started_at
+        except errors.APIError as e:
+            if e.code not in CACHE_ERROR_CODES:
+                raise
+            print(f"Gemini context cache {name} is unusable, sending the full request: {e}")
+            metrics.incr('gemini.context_cache.fallbacks')
+            await CachedContext.objects.filter(name=name).adelete()
+            started_at = time.monotonic()
+    return await send(None), False, started_at
+
+
+def _record(cached, latency, usage):
+    label = 'cached' if cached else 'uncached'
+    metrics.incr(f'gemini.turns.{label}')
+    metrics.observe(f'gemini.turn_latency.{label}', latency)
+    if usage is not None:
+        metrics.incr(f'gemini.input_tokens.{label}', usage.prompt_token_count or 0)
+        metrics.incr('gemini.cached_input_tokens', usage.cached_content_token_count or 0)
+
+
+async def generate_content(client, api_key, model, contents, config, media=None):
+    """
+    ``client.aio.models.generate_content`` with ``media`` served from a context cache when possible.
+
+    Args:
+        client: Gemini client
+        api_key: The API key of ``client``
+        model: Gemini model
+        contents: Full request contents, including ``media.part``
+        config: Keyword arguments of ``types.GenerateContentConfig``
+        media: The :class:`Media` to cache, if any
+
+    Returns:
+        The response
+    """
+    async def send(name):
+        return await client.aio.models.generate_content(**_request(model, contents, config, media, name))
+
+    response, cached, started_at = await _with_fallback(client, api_key, model, media, send)
+    _record(cached, time.monotonic() - started_at, response.usage_metadata)
+    return response
+
+
+async def generate_content_stream(client, api_key, model, contents, config, media=None):
+    """
+    Streaming variant of :func:`generate_content`.
+
+    Yields:
+        Response chunks
+    """
+    async def send(name):
+        # Wait for the first chunk, so an expired cache is detected before anything is yielded
+        stream = await client.aio.models.generate_content_stream(**_request(model, contents, config, media, name))
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        return first, stream
+
+    (first, stream), cached, started_at = await _with_fallback(client, api_key, model, media, send)
+    usage = None
+    if first is not None:
+        usage = first.usage_metadata
+        yield first
+        async for chunk in stream:
+            usage = chunk.usage_metadata or usage
+            yield chunk
+    _record(cached, time.monotonic() - started_at, usage)
+
+
+def _stats():
+    return {'creating': len(_creating), 'uncacheable': len(_uncacheable)}
+
+
+metrics.register_collector('context_cache', _stats)
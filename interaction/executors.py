@@ -0,0 +1,154 @@
+"""
+Dedicated thread pool for blocking AI provider calls.
+
+``database_sync_to_async`` is thread-sensitive: every call made through it runs
+on the one thread that also serves the ORM. Provider SDK calls (Imagen, Veo
+polling, file uploads, HTTP downloads...) can block for minutes, so they run on
+this bounded pool instead and database access never waits behind them.
+"""
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import lifespan, metrics
+
+
+class ProviderExecutor:
+    """
+    Bounded thread pool with queue-depth accounting.
+
+    At most ``max_workers`` calls run at once and at most ``max_queue`` more wait
+    for a free thread. Callers beyond that wait asynchronously (on the event
+    loop, without holding a thread) until a slot frees up.
+    """
+
+    def __init__(self, max_workers, max_queue):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='provider')
+        self._slots = None
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._queued = 0
+        self._active = 0
+        self._completed = 0
+        self._failed = 0
+
+    def _get_slots(self):
+        # Created lazily so the semaphore binds to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+        return self._slots
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run ``func(*args, **kwargs)`` on the pool and await its result.
+
+        The slot and the queue/active counters follow the call, not the awaiting
+        task: if the task is cancelled, a call that has not started yet is
+        dropped, and one already running keeps its slot until its thread is done.
+        """
+        slots = self._get_slots()
+        with self._lock:
+            self._waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+        queued_at = time.monotonic()
+
+        def call():
+            started_at = time.monotonic()
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+            metrics.observe('provider_executor.queue_wait', started_at - queued_at)
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                with self._lock:
+                    self._failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+                metrics.observe('provider_executor.run_time', time.monotonic() - started_at)
+            return result
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._queued += 1
+        try:
+            future = self._pool.submit(call)
+        except BaseException:
+            with self._lock:
+                self._queued -= 1
+            slots.release()
+            raise
+
+        def done(finished):
+            # Called from the worker thread, or from whoever cancelled the call before it started
+            if finished.cancelled():
+                with self._lock:
+                    self._queued -= 1
+            try:
+                loop.call_soon_threadsafe(slots.release)
+            except RuntimeError:
+                pass  # The loop is closed: nobody is waiting for the slot any more
+
+        future.add_done_callback(done)
+        # Cancelling the awaiting task cancels the call only if it has not started
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'active': self._active,
+                'queued': self._queued,
+                'waiting_for_slot': self._waiting,
+                'completed': self._completed,
+                'failed': self._failed,
+            }
+
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_provider_executor():
+    """Return the process-wide provider executor, creating it on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProviderExecutor(
+                    max_workers=getattr(settings, 'PROVIDER_EXECUTOR_MAX_WORKERS', 16),
+                    max_queue=getattr(settings, 'PROVIDER_EXECUTOR_MAX_QUEUE', 64),
+                )
+                metrics.register_collector('provider_executor', _executor.stats)
+                lifespan.on_sync_shutdown(_executor.shutdown)
+    return _executor
+
+
+def provider_sync_to_async(func):
+    """
+    Counterpart of ``database_sync_to_async`` for blocking provider calls.
+
+    Usage: ``result = await provider_sync_to_async(generate_imagen_image)(tool, prompt)``
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await get_provider_executor().run(func, *args, **kwargs)
+    return wrapper
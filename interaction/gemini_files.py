@@ -0,0 +1,211 @@
+"""
+Gemini Files API uploads, reused across turns.
+
+Media over ``GEMINI_INLINE_MAX_BYTES`` cannot be sent inline and has to be
+uploaded with the Files API. Uploads are recorded as ``RemoteFile`` rows keyed
+by the media SHA-256 (and the API key owning them), so a follow-up question
+about the same PDF, video or audio references the file already on the
+provider's side instead of uploading it again. The provider deletes files
+``FILE_TTL`` after their upload; rows are only trusted until
+``GEMINI_FILES_EXPIRY_MARGIN`` seconds before that.
+
+Nothing is deleted while answering: the :class:`FileSweeper` drops expired rows
+and deletes files unused for ``GEMINI_FILES_IDLE_TTL`` seconds in the
+background, every ``GEMINI_FILES_SWEEP_INTERVAL`` seconds. It is started by
+the lifespan startup hook or, under Daphne, by the first :func:`get_file_part`.
+"""
+import asyncio
+import hashlib
+import io
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+from google.genai import types
+
+from . import lifespan, metrics
+from .executors import provider_sync_to_async
+from .models import RemoteFile
+from .providers import get_gemini_client
+
+FILE_TTL = timedelta(hours=48)
+PROCESSING_POLL_INTERVAL = 2
+PROCESSING_TIMEOUT = 5 * 60
+
+
+def inline_max_bytes():
+    return getattr(settings, 'GEMINI_INLINE_MAX_BYTES', 20 * 1024 * 1024)
+
+
+def expiry_margin():
+    return timedelta(seconds=getattr(settings, 'GEMINI_FILES_EXPIRY_MARGIN', 3600))
+
+
+def idle_ttl():
+    return timedelta(seconds=getattr(settings, 'GEMINI_FILES_IDLE_TTL', 6 * 3600))
+
+
+def sweep_interval():
+    return getattr(settings, 'GEMINI_FILES_SWEEP_INTERVAL', 600)
+
+
+def account_id(api_key):
+    """Short fingerprint of an API key: files are only visible to the key that uploaded them."""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def _file_part(remote):
+    return types.Part.from_uri(file_uri=remote.uri, mime_type=remote.mime_type)
+
+
+async def _wait_until_active(client, file):
+    # Videos and audio are processed before they can be used in a prompt
+    waited = 0
+    while file.state and file.state.name == 'PROCESSING':
+        if waited >= PROCESSING_TIMEOUT:
+            raise TimeoutError(f"Gemini did not finish processing {file.name} within {PROCESSING_TIMEOUT} seconds.")
+        await asyncio.sleep(PROCESSING_POLL_INTERVAL)
+        waited += PROCESSING_POLL_INTERVAL
+        file = await client.aio.files.get(name=file.name)
+    if file.state and file.state.name == 'FAILED':
+        raise RuntimeError(f"Gemini could not process {file.name}.")
+    return file
+
+
+async def _upload(client, account, sha256, data, mime_type):
+    file = await provider_sync_to_async(client.files.upload)(
+        file=io.BytesIO(data),
+        config=dict(mime_type=mime_type)
+    )
+    file = await _wait_until_active(client, file)
+    metrics.incr('gemini_files.uploaded')
+    metrics.incr('gemini_files.uploaded_bytes', len(data))
+
+    now = timezone.now()
+    expires_at = file.expiration_time or now + FILE_TTL
+    try:
+        remote, created = await RemoteFile.objects.aupdate_or_create(account=account, sha256=sha256, defaults={
+            'name': file.name,
+            'uri': file.uri,
+            'mime_type': file.mime_type or mime_type,
+            'size': len(data),
+            'last_used_at': now,
+            'expires_at': expires_at,
+        })
+    except IntegrityError:
+        # Uploaded concurrently by another worker: keep its row, ours expires on its own
+        remote = await RemoteFile.objects.aget(account=account, sha256=sha256)
+    return remote
+
+
+_uploads = {}  # (account, sha256) -> upload task, shared by concurrent requests for the same media
+
+
+async def get_file_part(client, api_key, data, mime_type, sha256=None):
+    """
+    Return a prompt part referencing ``data`` as a Gemini file, uploading it
+    only if no live upload of the same bytes exists.
+
+    Args:
+        client: Gemini client
+        api_key: The API key of ``client``
+        data: Media bytes
+        mime_type: MIME type of the media
+        sha256: SHA-256 of ``data`` if already known (e.g. ``Attachment.sha256``)
+
+    Returns:
+        ``types.Part`` to append to the request contents
+    """
+    # Daphne has no lifespan startup, so the first file request starts the sweeper
+    _sweeper.start()
+    sha256 = sha256 or hashlib.sha256(data).hexdigest()
+    account = account_id(api_key)
+    now = timezone.now()
+    remote = await RemoteFile.objects.filter(account=account, sha256=sha256,
+                                             expires_at__gt=now + expiry_margin()).afirst()
+    if remote is not None:
+        await RemoteFile.objects.filter(pk=remote.pk).aupdate(last_used_at=now)
+        metrics.incr('gemini_files.reused')
+        metrics.incr('gemini_files.reused_bytes', remote.size)
+        return _file_part(remote)
+
+    key = (account, sha256)
+    task = _uploads.get(key)
+    if task is None:
+        task = _uploads[key] = asyncio.ensure_future(_upload(client, account, sha256, data, mime_type))
+        task.add_done_callback(lambda finished: _uploads.pop(key, None))
+    remote = await asyncio.shield(task)
+    return _file_part(remote)
+
+
+class FileSweeper:
+    """Background cleanup of expired and idle uploads."""
+
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        """Start sweeping on the running event loop if it is not running yet."""
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Error sweeping Gemini files: {e}")
+            await asyncio.sleep(sweep_interval())
+
+    async def sweep(self):
+        now = timezone.now()
+        expired, _ = await RemoteFile.objects.filter(expires_at__lte=now).adelete()
+        if expired:
+            metrics.incr('gemini_files.expired', expired)
+
+        api_key = os.environ.get('GEMINI_API_KEY')
+        if not api_key:
+            return
+        client = get_gemini_client(api_key)
+        idle = RemoteFile.objects.filter(account=account_id(api_key), last_used_at__lte=now - idle_ttl())
+        async for remote in idle:
+            # Forget the row first (unless it was used meanwhile) so no new turn picks the file up
+            deleted, _ = await RemoteFile.objects.filter(pk=remote.pk, last_used_at__lte=now - idle_ttl()).adelete()
+            if not deleted:
+                continue
+            try:
+                await client.aio.files.delete(name=remote.name)
+                metrics.incr('gemini_files.deleted')
+            except Exception as e:
+                # Probably already gone on the provider's side
+                print(f"Could not delete Gemini file {remote.name}: {e}")
+
+
+_sweeper = FileSweeper()
+
+
+def get_sweeper():
+    return _sweeper
+
+
+async def start_sweeper():
+    _sweeper.start()
+
+
+def _stats():
+    return {'uploading': len(_uploads)}
+
+
+metrics.register_collector('gemini_files', _stats)
+lifespan.on_startup(start_sweeper)
+lifespan.on_shutdown(_sweeper.stop)
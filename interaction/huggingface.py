@@ -0,0 +1,218 @@
+"""
+Hugging Face Inference adapter.
+
+Endpoints come in two flavours, detected once per endpoint and cached for
+``HF_CAPABILITY_TTL`` seconds:
+
+* Text Generation Inference (TGI) servers, recognised by their ``GET /info``
+  route. Answers are streamed token by token over TGI's SSE protocol.
+* Plain pipeline endpoints, which only return the whole ``generated_text``.
+  Prompts sent to the same endpoint within ``HF_BATCH_WINDOW_MS`` are
+  micro-batched into a single request with an ``inputs`` list (at most
+  ``HF_BATCH_MAX_SIZE`` prompts), so concurrent users share one round trip.
+
+All requests go through the shared, pooled ``httpx.AsyncClient`` of
+providers.py. ``manage.py run_hf_stub`` serves both protocols locally for
+testing.
+"""
+import asyncio
+import json
+import os
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+
+from . import metrics
+from .adapters import AdapterError, iter_sse, max_output_tokens
+from .providers import get_http_client
+
+KIND_TGI = 'tgi'
+KIND_PIPELINE = 'pipeline'
+PROBE_TIMEOUT = 5
+
+
+def capability_ttl():
+    return getattr(settings, 'HF_CAPABILITY_TTL', 3600)
+
+
+def batch_window():
+    return getattr(settings, 'HF_BATCH_WINDOW_MS', 20) / 1000
+
+
+def batch_max_size():
+    return getattr(settings, 'HF_BATCH_MAX_SIZE', 8)
+
+
+def _headers(api_key):
+    return {"Authorization": f"Bearer {api_key}"}
+
+
+def _generation_parameters(temperature=None):
+    parameters = {"max_new_tokens": max_output_tokens(), "return_full_text": False}
+    if temperature is not None:
+        # TGI only accepts strictly positive temperatures; 0 means greedy decoding
+        parameters.update({"temperature": temperature} if temperature > 0 else {"do_sample": False})
+    return parameters
+
+
+_capabilities = {}  # endpoint -> (kind, expires_at)
+
+
+async def probe(endpoint, api_key):
+    """Return ``KIND_TGI`` or ``KIND_PIPELINE`` for ``endpoint`` (cached)."""
+    cached = _capabilities.get(endpoint)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    kind = KIND_PIPELINE
+    try:
+        response = await get_http_client().get(endpoint.rstrip('/') + '/info', headers=_headers(api_key),
+                                               timeout=PROBE_TIMEOUT)
+        if response.status_code == 200 and 'model_id' in response.json():
+            kind = KIND_TGI
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Hugging Face capability probe of {endpoint} failed, assuming a pipeline endpoint: {e}")
+    _capabilities[endpoint] = (kind, time.monotonic() + capability_ttl())
+    metrics.incr(f'huggingface.probed.{kind}')
+    return kind
+
+
+def _generated_text(result):
+    # Single inputs answer [{"generated_text": ...}]; batched ones [[{...}], ...] or [{...}, ...]
+    if isinstance(result, list):
+        result = result[0] if result else {}
+    return result.get('generated_text') if isinstance(result, dict) else None
+
+
+class PromptBatcher:
+    """
+    Collects prompts for one pipeline endpoint and sends them as one request.
+
+    A batch is sent when the window opened by its first prompt closes or as
+    soon as it is full; each caller gets its own ``generated_text`` back.
+    """
+
+    def __init__(self, endpoint, api_key, temperature=None):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.temperature = temperature
+        self._pending = []
+        self._timer = None
+        self._sending = set()
+
+    async def submit(self, prompt):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((prompt, future))
+        if len(self._pending) >= batch_max_size():
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(batch_window(), self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch):
+        prompts = [prompt for prompt, future in batch]
+        payload = {
+            "inputs": prompts[0] if len(prompts) == 1 else prompts,
+            "parameters": _generation_parameters(self.temperature),
+        }
+        started_at = time.monotonic()
+        try:
+            response = await get_http_client().post(self.endpoint, headers=_headers(self.api_key), json=payload)
+            response.raise_for_status()
+            results = response.json()
+            if len(prompts) == 1:
+                results = [results]
+            if not isinstance(results, list) or len(results) != len(prompts):
+                raise AdapterError("Hugging Face returned an unexpected batch response.")
+        except Exception as e:
+            for prompt, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        metrics.incr('huggingface.batches')
+        metrics.incr('huggingface.batched_prompts', len(prompts))
+        metrics.observe('huggingface.batch_latency', time.monotonic() - started_at)
+        for (prompt, future), result in zip(batch, results):
+            if not future.done():
+                text = _generated_text(result)
+                if text:
+                    future.set_result(text)
+                else:
+                    future.set_exception(AdapterError("Hugging Face returned no generated text."))
+
+
+_batchers = weakref.WeakKeyDictionary()  # event loop -> {(endpoint, api_key, temperature): PromptBatcher}
+
+
+def get_batcher(endpoint, api_key, temperature=None):
+    """Return the batcher of ``endpoint`` for the running event loop (prompts sharing parameters)."""
+    batchers = _batchers.setdefault(asyncio.get_running_loop(), {})
+    batcher = batchers.get((endpoint, api_key, temperature))
+    if batcher is None:
+        batcher = batchers[(endpoint, api_key, temperature)] = PromptBatcher(endpoint, api_key, temperature)
+    return batcher
+
+
+async def stream_tgi(endpoint, api_key, prompt, temperature=None):
+    """Stream tokens from a TGI server."""
+    payload = {"inputs": prompt, "stream": True, "parameters": _generation_parameters(temperature)}
+    async with get_http_client().stream('POST', endpoint, headers=_headers(api_key), json=payload) as response:
+        response.raise_for_status()
+        if not response.headers.get('content-type', '').startswith('text/event-stream'):
+            # The server answered in one piece after all
+            text = _generated_text(json.loads(await response.aread()))
+            if not text:
+                raise AdapterError("Hugging Face returned no generated text.")
+            yield text
+            return
+        async for event, data in iter_sse(response):
+            message = json.loads(data)
+            if message.get('error'):
+                raise AdapterError(f"Hugging Face error: {message['error']}")
+            token = message.get('token') or {}
+            if token.get('text') and not token.get('special'):
+                yield token['text']
+
+
+async def stream(tool, user_message):
+    """
+    Stream an answer from the Hugging Face endpoint of ``tool``.
+
+    Yields:
+        Text deltas (a single one for pipeline endpoints)
+    """
+    api_key = os.environ.get('HUGGINGFACE_API_KEY')
+    if not api_key:
+        raise AdapterError("Hugging Face API key not found.")
+    if not tool.api_endpoint:
+        raise AdapterError("Hugging Face model endpoint not configured for this tool.")
+
+    if await probe(tool.api_endpoint, api_key) == KIND_TGI:
+        async for text in stream_tgi(tool.api_endpoint, api_key, user_message, tool.temperature):
+            yield text
+    else:
+        yield await get_batcher(tool.api_endpoint, api_key, tool.temperature).submit(user_message)
+
+
+def _stats():
+    return {
+        'endpoints': {endpoint: kind for endpoint, (kind, expires_at) in list(_capabilities.items())},
+        'pending_prompts': sum(len(batcher._pending) for batchers in list(_batchers.values())
+                               for batcher in batchers.values()),
+    }
+
+
+metrics.register_collector('huggingface', _stats)
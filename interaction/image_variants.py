@@ -0,0 +1,174 @@
+"""
+Provider-aware downscaling of images before they are sent.
+
+Providers downsample large images anyway: OpenAI fits them in 2048x2048 and
+then scales the shorter side to 768 px, and Gemini bills images by 768 px
+tiles. Sending a 12 MP phone photo as the browser gave it only costs upload
+time and input tokens, so images are resized to the provider's effective
+resolution and re-encoded (WebP by default) first, using the profiles of
+``IMAGE_VARIANT_PROFILES``.
+
+Resizing runs in the media process pool (see media_pool.py). Variants are
+stored as attachments and recorded as ``ImageVariant`` rows keyed by the source
+SHA-256 and the profile, so a later message with the same image (or a follow-up
+answer from the same upload) reuses the variant without decoding anything. The
+bytes saved are counted per provider in ``image_variants.*`` metrics.
+"""
+import base64
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+
+from . import attachments, media_pool, metrics
+from .models import ImageVariant
+
+DEFAULT_PROFILES = {
+    'openai': {'max_side': 2048, 'max_short_side': 768, 'image_format': 'WEBP', 'quality': 85},
+    'gemini': {'max_side': 1536, 'max_short_side': None, 'image_format': 'WEBP', 'quality': 85},
+}
+
+
+def enabled():
+    return getattr(settings, 'IMAGE_VARIANTS_ENABLED', True)
+
+
+def get_profile(provider):
+    return getattr(settings, 'IMAGE_VARIANT_PROFILES', DEFAULT_PROFILES).get(provider)
+
+
+def profile_key(provider, profile):
+    # Part of the cache key: changing a profile produces new variants
+    return (f"{provider}:{profile['max_side']}:{profile.get('max_short_side') or 0}:"
+            f"{profile.get('image_format', 'WEBP')}:{profile.get('quality', 85)}")
+
+
+class PreparedImage:
+    """Image bytes ready to be sent to a provider."""
+
+    def __init__(self, data, mime_type, sha256, source_size):
+        self.data = data
+        self.mime_type = mime_type
+        self.sha256 = sha256  # SHA-256 of the uploaded image
+        self.source_size = source_size
+
+    @property
+    def bytes_saved(self):
+        return max(0, self.source_size - len(self.data))
+
+    async def data_url(self):
+        """The image as a base64 data URL (for OpenAI ``image_url`` parts)."""
+        encoded = await sync_to_async(base64.b64encode, thread_sensitive=False)(self.data)
+        return f"data:{self.mime_type};base64,{encoded.decode('ascii')}"
+
+
+async def _lookup(source_sha256, key, original=None):
+    """
+    Return the recorded row (or None) and the image to send, if it can be read
+    without processing: the stored variant, or the ``original`` attachment when
+    the row says it is sent as it is.
+    """
+    variant = await ImageVariant.objects.select_related('attachment').filter(
+        source_sha256=source_sha256, profile=key
+    ).afirst()
+    if variant is None:
+        return None, None
+    stored = variant.attachment or original
+    if stored is None:
+        return variant, None
+    try:
+        data = await sync_to_async(attachments.read_bytes, thread_sensitive=False)(stored)
+    except OSError:
+        # The file is gone: prepare the image again
+        await ImageVariant.objects.filter(pk=variant.pk).adelete()
+        return None, None
+    return variant, PreparedImage(data, variant.mime_type, source_sha256, variant.source_size)
+
+
+async def _remember(key, prepared, image, store):
+    # Without a stored copy, the row means "send the uploaded original as it is"
+    attachment = None
+    if store:
+        attachment = await sync_to_async(attachments.store_bytes, thread_sensitive=False)(
+            prepared.data, prepared.mime_type
+        )
+    try:
+        await ImageVariant.objects.acreate(
+            source_sha256=prepared.sha256,
+            profile=key,
+            attachment=attachment,
+            mime_type=prepared.mime_type,
+            width=image.width,
+            height=image.height,
+            source_size=prepared.source_size,
+            size=len(prepared.data),
+        )
+    except IntegrityError:
+        pass  # Prepared concurrently by another request
+
+
+def _record(provider, prepared, hit):
+    metrics.incr('image_variants.hits' if hit else 'image_variants.misses')
+    metrics.incr(f'image_variants.source_bytes.{provider}', prepared.source_size)
+    metrics.incr(f'image_variants.sent_bytes.{provider}', len(prepared.data))
+    metrics.incr(f'image_variants.bytes_saved.{provider}', prepared.bytes_saved)
+    return prepared
+
+
+async def prepare(data_url, provider, attachment=None):
+    """
+    Return an uploaded image sized for ``provider``.
+
+    Args:
+        data_url: Base64 data URL of the image as uploaded, used when there is no stored attachment
+        provider: Profile name in IMAGE_VARIANT_PROFILES ('openai', 'gemini')
+        attachment: The stored Attachment of the image, if any
+
+    Returns:
+        :class:`PreparedImage`
+
+    Raises:
+        media_pool.MediaError: If the data URL is not a valid image
+    """
+    source_sha256 = attachment.sha256 if media_pool.holds(attachment, 'image') else None
+    profile = get_profile(provider) if enabled() else None
+    key = profile_key(provider, profile) if profile else None
+    known = None
+    if key and source_sha256:
+        known, prepared = await _lookup(source_sha256, key, attachment)
+        if prepared is not None:
+            return _record(provider, prepared, hit=True)
+
+    handle = await media_pool.process(data_url, 'image', attachment)
+    variant = None
+    try:
+        source_size = handle.size + handle.stripped_bytes
+        if key and known is None and not source_sha256:
+            known, prepared = await _lookup(handle.sha256, key)
+            if prepared is not None:
+                return _record(provider, prepared, hit=True)
+        if key is None:
+            return PreparedImage(await handle.read(), handle.mime_type, handle.sha256, source_size)
+
+        if known is None:
+            try:
+                variant = await media_pool.get_media_processor().resize_image(handle, **profile)
+            except Exception as e:
+                print(f"Could not resize image for {provider}, sending the original: {e}")
+                return PreparedImage(await handle.read(), handle.mime_type, handle.sha256, source_size)
+        if variant is not None:
+            prepared = PreparedImage(await variant.read(), variant.mime_type, handle.sha256, source_size)
+        else:
+            prepared = PreparedImage(await handle.read(), handle.mime_type, handle.sha256, source_size)
+        if known is None:
+            try:
+                # Metadata-stripped originals are stored too, so the uploaded file is only sent as it is when clean
+                await _remember(key, prepared, variant or handle, store=variant is not None or handle.stripped_bytes > 0)
+            except Exception as e:
+                print(f"Could not record image variant: {e}")
+        return _record(provider, prepared, hit=known is not None)
+    finally:
+        # Temp files left unread on early returns, errors or cancellation
+        handle.discard()
+        if variant is not None:
+            variant.discard()
@@ -0,0 +1,450 @@
+"""
+Durable media generation jobs.
+
+Imagen, image-edit and Veo requests are recorded as ``GenerationJob`` rows and
+run by the :class:`JobWorker` instead of inside the requesting socket's task, so
+a closed tab or a server restart does not lose the result. The worker claims
+jobs with a renewable lease: a job whose worker died becomes claimable again
+once its lease expires, and Veo jobs resume polling their stored provider
+operation instead of paying for a new generation.
+
+Progress and results are broadcast to the conversation's channel layer group
+(``chat_<conversation_id>``) as ``job_update`` events, so any socket open for
+the conversation at that moment receives them.
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+
+import httpx
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import admission, attachments, lifespan, metrics, video_jobs
+from .executors import provider_sync_to_async
+from .models import GenerationJob, Message
+from .providers import get_gemini_client
+
+# Finished jobs are still reported to sockets that connect this long afterwards
+RECENT_JOB_SECONDS = 10 * 60
+RETRY_BACKOFF_SECONDS = 30
+
+STATUS_MESSAGES = {
+    GenerationJob.KIND_IMAGEN: "Generating images based on your prompt...",
+    GenerationJob.KIND_IMAGE_EDIT: "Editing image based on your prompt...",
+    GenerationJob.KIND_VEO: "Generating videos based on your prompt... This may take 2-3 minutes.",
+}
+
+
+# HTTP status codes of provider errors worth retrying: timeouts, rate limits, server errors
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class JobError(Exception):
+    """
+    A job attempt failed with a message for the user.
+
+    Args:
+        message: The error message
+        retriable: The failure is transient (rate limit, timeout, server error)
+            and the job may be attempted again; otherwise retrying would not help
+    """
+
+    def __init__(self, message, retriable=False):
+        super().__init__(message)
+        self.retriable = retriable
+
+
+def is_transient(error):
+    """Whether a provider call failing with ``error`` may succeed if retried later."""
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    # google.genai's APIError carries the HTTP status code
+    return getattr(error, 'code', None) in TRANSIENT_STATUS_CODES
+
+
+def lease_seconds():
+    return getattr(settings, 'GENERATION_JOB_LEASE_SECONDS', 60)
+
+
+def max_attempts():
+    return getattr(settings, 'GENERATION_JOB_MAX_ATTEMPTS', 3)
+
+
+def scan_interval():
+    return getattr(settings, 'GENERATION_JOB_SCAN_INTERVAL', 5)
+
+
+def worker_concurrency():
+    return getattr(settings, 'GENERATION_JOB_CONCURRENCY', 8)
+
+
+def job_event(job, content=None, **extra):
+    """The ``job_update`` payload sent to clients for ``job``."""
+    payload = {
+        'type': 'job_update',
+        'job_id': str(job.id),
+        'kind': job.kind,
+        'state': job.state,
+        'request_id': job.request_id,
+        'content': content if content is not None else STATUS_MESSAGES.get(job.kind, ''),
+    }
+    payload.update(extra)
+    return payload
+
+
+async def notify(job, content=None, **extra):
+    """Broadcast a job update to every socket open on the job's conversation."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        await channel_layer.group_send(f'chat_{job.conversation_id}', {
+            'type': 'job_update',
+            'job': job_event(job, content, **extra),
+        })
+    except Exception as e:
+        print(f"Error notifying job {job.id}: {e}")
+
+
+def create_job(conversation, kind, prompt, params=None, source_attachment=None, request_id=''):
+    return GenerationJob.objects.create(
+        conversation=conversation,
+        kind=kind,
+        prompt=prompt,
+        params=params or {},
+        source_attachment=source_attachment,
+        request_id=request_id or '',
+    )
+
+
+async def enqueue(conversation, kind, prompt, params=None, source_attachment=None, request_id=''):
+    """
+    Record a new job and wake the worker.
+
+    Returns:
+        The GenerationJob
+    """
+    job = await database_sync_to_async(create_job)(conversation, kind, prompt, params, source_attachment, request_id)
+    metrics.incr(f'jobs.enqueued.{kind}')
+    worker = get_worker()
+    worker.start()
+    worker.wake()
+    return job
+
+
+def recent_job_events(conversation_id, user):
+    """
+    Status of the conversation's active jobs and of the ones that finished recently,
+    for a socket that has just (re)connected.
+    """
+    cutoff = timezone.now() - timedelta(seconds=RECENT_JOB_SECONDS)
+    jobs = GenerationJob.objects.filter(conversation_id=conversation_id, conversation__user=user).filter(
+        Q(state__in=GenerationJob.ACTIVE_STATES) | Q(updated_at__gte=cutoff)
+    ).select_related('message')
+    events = []
+    for job in jobs:
+        if job.state == GenerationJob.STATE_SUCCEEDED and job.message:
+            events.append(job_event(job, job.message.content))
+        elif job.state == GenerationJob.STATE_FAILED:
+            events.append(job_event(job, job.error))
+        else:
+            events.append(job_event(job))
+    return events
+
+
+def _claimable():
+    return Q(state__in=GenerationJob.ACTIVE_STATES) & (
+        Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=timezone.now())
+    )
+
+
+def _claim_jobs(worker_id, limit):
+    """Lease up to ``limit`` claimable jobs to ``worker_id``. Returns the claimed jobs."""
+    candidates = list(GenerationJob.objects.filter(_claimable()).values_list('id', flat=True)[:limit])
+    claimed = []
+    for job_id in candidates:
+        # The conditional update makes the claim atomic across processes
+        updated = GenerationJob.objects.filter(_claimable(), id=job_id).update(
+            state=GenerationJob.STATE_RUNNING,
+            worker=worker_id,
+            lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds()),
+            attempts=F('attempts') + 1,
+        )
+        if updated:
+            claimed.append(job_id)
+    return list(GenerationJob.objects.filter(id__in=claimed).select_related('conversation__tool', 'source_attachment'))
+
+
+def _renew_lease(job_id, worker_id):
+    return GenerationJob.objects.filter(id=job_id, worker=worker_id, state=GenerationJob.STATE_RUNNING).update(
+        lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds())
+    )
+
+
+def _release_jobs(worker_id):
+    """Hand this worker's unfinished jobs back without counting the interrupted attempt."""
+    return GenerationJob.objects.filter(worker=worker_id, state=GenerationJob.STATE_RUNNING).update(
+        state=GenerationJob.STATE_PENDING, lease_expires_at=None, attempts=F('attempts') - 1
+    )
+
+
+def _finish(job, **fields):
+    """
+    Move ``job`` out of RUNNING if this worker still holds its lease.
+
+    The conditional update locks the row until the surrounding transaction ends,
+    so a worker that lost its lease (and the job to another worker) writes nothing.
+
+    Returns:
+        True if the job was updated
+    """
+    updated = GenerationJob.objects.filter(
+        pk=job.pk, worker=job.worker, state=GenerationJob.STATE_RUNNING, lease_expires_at__gt=timezone.now()
+    ).update(updated_at=timezone.now(), **fields)
+    if not updated:
+        print(f"Generation job {job.id} lost its lease; discarding this attempt's result")
+        metrics.incr('jobs.lease_lost')
+    return bool(updated)
+
+
+def _save_result(job, content, media, **fields):
+    """Post the result message and mark the job succeeded. Returns the message, or None if the lease was lost."""
+    with transaction.atomic():
+        if not _finish(job, state=GenerationJob.STATE_SUCCEEDED, lease_expires_at=None):
+            return None
+        message = Message.objects.create(conversation=job.conversation, is_from_user=False, content=content, **fields)
+        if media:
+            message.attachments.add(*media)
+            job.result_attachments.add(*media)
+        GenerationJob.objects.filter(pk=job.pk).update(message=message)
+    job.state = GenerationJob.STATE_SUCCEEDED
+    job.message = message
+    job.lease_expires_at = None
+    return message
+
+
+def _save_failure(job, error):
+    """Post the error message and mark the job failed. Returns False if the lease was lost."""
+    with transaction.atomic():
+        if not _finish(job, state=GenerationJob.STATE_FAILED, error=error, lease_expires_at=None):
+            return False
+        Message.objects.create(conversation=job.conversation, is_from_user=False, content=error)
+    job.state = GenerationJob.STATE_FAILED
+    job.error = error
+    job.lease_expires_at = None
+    return True
+
+
+def _save_retry(job, error, delay):
+    """Hand the job back for a later attempt. Returns False if the lease was lost."""
+    # Not claimable again until the backoff has passed
+    retry_at = timezone.now() + timedelta(seconds=delay)
+    if not _finish(job, state=GenerationJob.STATE_PENDING, error=error, lease_expires_at=retry_at):
+        return False
+    job.state = GenerationJob.STATE_PENDING
+    job.error = error
+    job.lease_expires_at = retry_at
+    return True
+
+
+async def _store_media(data_urls):
+    store = sync_to_async(attachments.store_data_url, thread_sensitive=False)
+    return [await store(data_url) for data_url in data_urls]
+
+
+async def run_imagen(job):
+    from .views import generate_imagen_image
+    result = await provider_sync_to_async(generate_imagen_image)(job.conversation.tool, job.prompt, **job.params)
+    if isinstance(result, dict) and "error" in result:
+        raise JobError(f"Image generation error: {result['error']}", retriable=result.get('retriable', False))
+
+    images = await _store_media([img.get("image_data", "") for img in result if isinstance(img, dict) and "image_data" in img])
+    content = "Generated images based on your prompt:\n\n"
+    for i, image in enumerate(images):
+        content += f"Image {i+1}: ![Image {i+1}]({image.url})\n\n"
+    return content, images, {'image_url': images[0].url if images else None}
+
+
+async def run_image_edit(job):
+    from .views import generate_gemini_image_edit
+    if job.source_attachment is None:
+        raise JobError("Invalid image data for editing.")
+    image_data = await sync_to_async(attachments.to_data_url, thread_sensitive=False)(job.source_attachment)
+    result = await provider_sync_to_async(generate_gemini_image_edit)(job.conversation.tool, job.prompt, image_data)
+    if isinstance(result, dict) and "error" in result:
+        raise JobError(f"Image editing error: {result['error']}", retriable=result.get('retriable', False))
+
+    images = await _store_media(result.get("images", []))
+    content = result.get("text", "") + "\n\n"
+    for i, image in enumerate(images):
+        content += f"Edited image {i+1}: ![Edited image {i+1}]({image.url})\n\n"
+    return content, images, {'image_url': images[0].url if images else None}
+
+
+async def run_veo(job):
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key:
+        raise JobError("Video generation error: Gemini API key not found.")
+    client = get_gemini_client(api_key)
+
+    if job.operation_name:
+        # Started by an earlier attempt: keep waiting on the same provider operation
+        operation = video_jobs.resume_operation(job.operation_name)
+        metrics.incr('jobs.veo_resumed')
+    else:
+        image_data = None
+        if job.source_attachment is not None:
+            image_data = await sync_to_async(attachments.to_data_url, thread_sensitive=False)(job.source_attachment)
+        operation = await video_jobs.start_generation(client, job.prompt, image_data, **job.params)
+        job.operation_name = operation.name or ''
+        await database_sync_to_async(job.save)(update_fields=['operation_name', 'updated_at'])
+
+    async def report_progress(elapsed):
+        await notify(job, f"Generating videos based on your prompt... ({int(elapsed)}s elapsed, usually 2-3 minutes)",
+                     elapsed=int(elapsed))
+
+    result = await video_jobs.collect_videos(api_key, client, operation, report_progress)
+    if isinstance(result, dict) and "error" in result:
+        raise JobError(f"Video generation error: {result['error']}")
+
+    content = "Generated videos based on your prompt:\n\n"
+    for i, video in enumerate(result):
+        content += f"Video {i+1}: <video controls src=\"{video.url}\" style=\"max-width: 100%;\"></video>\n\n"
+    return content, result, {'video_url': result[0].url if result else None, 'file_type': 'video' if result else None}
+
+
+RUNNERS = {
+    GenerationJob.KIND_IMAGEN: run_imagen,
+    GenerationJob.KIND_IMAGE_EDIT: run_image_edit,
+    GenerationJob.KIND_VEO: run_veo,
+}
+
+
+class JobWorker:
+    """
+    Claims generation jobs from the database and runs them on the event loop.
+
+    One worker runs per process. It scans for claimable jobs every
+    ``GENERATION_JOB_SCAN_INTERVAL`` seconds (or right away when woken by
+    :func:`enqueue`) and runs at most ``GENERATION_JOB_CONCURRENCY`` jobs at once.
+    """
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._task = None
+        self._wakeup = None
+        self._running = {}
+
+    def start(self):
+        """Start the worker on the running event loop if it is not running yet."""
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        for task in list(self._running.values()):
+            task.cancel()
+        await asyncio.gather(self._task, *self._running.values(), return_exceptions=True)
+        self._task = None
+        try:
+            await database_sync_to_async(_release_jobs)(self.worker_id)
+        except Exception as e:
+            print(f"Error releasing generation jobs: {e}")
+
+    def stats(self):
+        return {'worker_id': self.worker_id, 'running': len(self._running)}
+
+    async def _run(self):
+        while True:
+            free = worker_concurrency() - len(self._running)
+            if free > 0:
+                try:
+                    claimed = await database_sync_to_async(_claim_jobs)(self.worker_id, free)
+                except Exception as e:
+                    print(f"Error claiming generation jobs: {e}")
+                    claimed = []
+                for job in claimed:
+                    task = asyncio.create_task(self._execute(job))
+                    self._running[job.id] = task
+                    task.add_done_callback(lambda finished, job_id=job.id: self._running.pop(job_id, None))
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=scan_interval())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _keep_lease(self, job):
+        while True:
+            await asyncio.sleep(lease_seconds() / 3)
+            await database_sync_to_async(_renew_lease)(job.id, self.worker_id)
+
+    async def _execute(self, job):
+        started_at = time.monotonic()
+        keep_lease = asyncio.create_task(self._keep_lease(job))
+        try:
+            await notify(job)
+
+            async def report_position(position):
+                await notify(job, f"Waiting in queue (position {position})...", queue_position=position)
+
+            # Jobs share the provider with chat answers through the lower-priority batch lane
+            conversation = job.conversation
+            async with admission.get_controller().admit(conversation.user_id, conversation.tool.api_type,
+                                                        admission.LANE_BATCH, report_position):
+                content, media, fields = await RUNNERS[job.kind](job)
+            message = await database_sync_to_async(_save_result)(job, content, media, **fields)
+            if message is None:
+                return  # Another worker owns the job now
+            metrics.incr(f'jobs.succeeded.{job.kind}')
+            metrics.observe(f'jobs.run_time.{job.kind}', time.monotonic() - started_at)
+            await notify(job, message.content)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error_message = str(e) if isinstance(e, JobError) else f"Error running {job.get_kind_display().lower()}: {e}"
+            print(f"Generation job {job.id} failed (attempt {job.attempts}): {error_message}")
+            retriable = e.retriable if isinstance(e, JobError) else True
+            if retriable and job.attempts < max_attempts():
+                if await database_sync_to_async(_save_retry)(job, error_message, RETRY_BACKOFF_SECONDS * job.attempts):
+                    metrics.incr(f'jobs.retried.{job.kind}')
+                    await notify(job, "Temporary error, retrying...")
+            else:
+                if await database_sync_to_async(_save_failure)(job, error_message):
+                    metrics.incr(f'jobs.failed.{job.kind}')
+                    await notify(job, error_message)
+        finally:
+            keep_lease.cancel()
+
+
+_worker = JobWorker()
+metrics.register_collector('generation_jobs', _worker.stats)
+
+
+def get_worker():
+    return _worker
+
+
+async def start_worker():
+    _worker.start()
+
+
+lifespan.on_startup(start_worker)
+lifespan.on_shutdown(_worker.stop)
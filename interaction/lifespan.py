@@ -0,0 +1,93 @@
+"""
+ASGI lifespan handling for the interaction app.
+
+Components register startup/shutdown coroutines here; ``inspireai.asgi`` routes
+the ``lifespan`` scope to :func:`lifespan_app`. Servers that do not implement
+the lifespan protocol (Daphne) run the startup hooks through
+:func:`start_without_lifespan` once their event loop runs, and still get the
+synchronous shutdown hooks through ``atexit``.
+"""
+import asyncio
+import atexit
+
+_startup_hooks = []
+_shutdown_hooks = []
+_sync_shutdown_hooks = []
+_started = False
+_tasks = set()
+
+
+def on_startup(coroutine_function):
+    """Register a coroutine function to run on lifespan startup."""
+    _startup_hooks.append(coroutine_function)
+    return coroutine_function
+
+
+def on_shutdown(coroutine_function):
+    """Register a coroutine function to run on lifespan shutdown."""
+    _shutdown_hooks.append(coroutine_function)
+    return coroutine_function
+
+
+def on_sync_shutdown(function):
+    """Register a plain function to run on shutdown or, failing that, at interpreter exit."""
+    _sync_shutdown_hooks.append(function)
+    return function
+
+
+def _run_sync_shutdown_hooks():
+    while _sync_shutdown_hooks:
+        function = _sync_shutdown_hooks.pop()
+        try:
+            function()
+        except Exception as e:
+            print(f"Error in shutdown hook {function.__name__}: {e}")
+
+
+atexit.register(_run_sync_shutdown_hooks)
+
+
+async def startup():
+    """Run the startup hooks, once per process."""
+    global _started
+    if _started:
+        return
+    _started = True
+    for hook in _startup_hooks:
+        await hook()
+
+
+async def _startup_without_lifespan():
+    try:
+        await startup()
+    except Exception as e:
+        print(f"Error in startup hooks: {e}")
+
+
+def start_without_lifespan():
+    """Run the startup hooks in the background on the running event loop (servers without lifespan events)."""
+    task = asyncio.get_running_loop().create_task(_startup_without_lifespan())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def lifespan_app(scope, receive, send):
+    """ASGI application for the ``lifespan`` scope."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await startup()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for hook in reversed(_shutdown_hooks):
+                try:
+                    await hook()
+                except Exception as e:
+                    print(f"Error in shutdown hook {hook.__name__}: {e}")
+            _run_sync_shutdown_hooks()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
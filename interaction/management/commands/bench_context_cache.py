@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+import re
+import statistics
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand, CommandError
+from google.genai import types
+
+from interaction import context_cache, metrics
+from interaction.gemini_files import account_id
+from interaction.models import CachedContext
+from interaction.providers import get_gemini_client
+
+BENCH_API_KEY = 'bench-context-cache'
+MODEL = 'gemini-2.0-flash'
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Gemini API: ``cachedContents`` create/update and (streaming)
+    ``generateContent``. Latency grows with the input tokens not served from a
+    cache, like the provider's prefill.
+    """
+
+    bytes_per_token = 64
+    base_latency = 0.05
+    token_latency = 0.00002
+    caches = {}  # name -> token count
+
+    def count_tokens(self, contents):
+        tokens = 0
+        for content in contents or []:
+            for part in content.get('parts', []):
+                if 'text' in part:
+                    tokens += max(1, len(part['text']) // 4)
+                elif 'inlineData' in part:
+                    tokens += len(part['inlineData'].get('data', '')) * 3 // 4 // self.bytes_per_token
+        return tokens
+
+    def expire_time(self, ttl):
+        seconds = float(str(ttl or '3600s').rstrip('s'))
+        return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat().replace('+00:00', 'Z')
+
+    def do_POST(self):
+        payload = self.read_json()
+        if self.path.rstrip('/').endswith('/cachedContents'):
+            name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+            self.caches[name] = self.count_tokens(payload.get('contents'))
+            self.send_json({
+                'name': name,
+                'model': payload.get('model'),
+                'expireTime': self.expire_time(payload.get('ttl')),
+                'usageMetadata': {'totalTokenCount': self.caches[name]},
+            })
+            return
+
+        match = re.search(r':(generateContent|streamGenerateContent)', self.path)
+        if not match:
+            self.send_json({'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}}, status=404)
+            return
+        cached_name = payload.get('cachedContent')
+        if cached_name and cached_name not in self.caches:
+            self.send_json({'error': {'code': 403, 'message': 'CachedContent not found', 'status': 'PERMISSION_DENIED'}},
+                           status=403)
+            return
+        cached_tokens = self.caches.get(cached_name, 0)
+        new_tokens = self.count_tokens(payload.get('contents'))
+        time.sleep(self.base_latency + new_tokens * self.token_latency)
+
+        body = {
+            'candidates': [{'content': {'role': 'model', 'parts': [{'text': 'Stub answer.'}]}, 'finishReason': 'STOP'}],
+            'usageMetadata': {
+                'promptTokenCount': cached_tokens + new_tokens,
+                'cachedContentTokenCount': cached_tokens,
+                'candidatesTokenCount': 3,
+            },
+        }
+        if match.group(1) == 'streamGenerateContent':
+            data = f"data: {json.dumps(body)}\r\n\r\n".encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(body)
+
+    def do_PATCH(self):
+        payload = self.read_json()
+        name = re.search(r'(cachedContents/[\w-]+)', self.path).group(1)
+        if name not in self.caches:
+            self.send_json({'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}}, status=404)
+            return
+        self.send_json({'name': name, 'expireTime': self.expire_time(payload.get('ttl'))})
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Measures per-turn latency and input tokens of a multi-turn conversation about one document, '
+            'with and without Gemini context caching, against a local fake Gemini server.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--turns',
+            type=int,
+            default=5,
+            help='Questions asked about the document in each run (default: 5)'
+        )
+        parser.add_argument(
+            '--size-kb',
+            type=int,
+            default=4096,
+            help='Size of the fake PDF in KB (default: 4096)'
+        )
+        parser.add_argument(
+            '--bytes-per-token',
+            type=int,
+            default=64,
+            help='Document bytes counted as one input token by the fake server (default: 64)'
+        )
+
+    def handle(self, *args, **options):
+        if options['size_kb'] * 1024 < context_cache.min_bytes():
+            raise CommandError(
+                f"--size-kb is below GEMINI_CONTEXT_CACHE_MIN_BYTES ({context_cache.min_bytes() // 1024} KB); "
+                f"the document would never be cached."
+            )
+        handler = type('Handler', (FakeGeminiHandler,), {
+            'bytes_per_token': options['bytes_per_token'],
+            'caches': {},
+        })
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        self.stdout.write(f"Fake Gemini server on {url}")
+        try:
+            results = asyncio.run(self.run(url, options['turns'], options['size_kb'] * 1024))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        for label, turns in results.items():
+            latencies = [latency for latency, tokens, cached in turns]
+            self.stdout.write(
+                f"{label:>8}: mean latency {statistics.mean(latencies) * 1000:7.1f} ms, "
+                f"input tokens per turn {statistics.mean(tokens for latency, tokens, cached in turns):9.0f}, "
+                f"of which cached {statistics.mean(cached for latency, tokens, cached in turns):9.0f}"
+            )
+        for name, value in sorted(metrics.snapshot().get('counters', {}).items()):
+            if name.startswith('gemini.'):
+                self.stdout.write(f"  {name}: {value}")
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    async def run(self, url, turns, size):
+        client = get_gemini_client(BENCH_API_KEY, base_url=url)
+        document = hashlib.sha256(b'bench').digest() * (size // 32)
+        media = context_cache.Media(
+            types.Part.from_bytes(data=document, mime_type='application/pdf'),
+            hashlib.sha256(document).hexdigest(),
+            len(document),
+        )
+        await CachedContext.objects.filter(account=account_id(BENCH_API_KEY)).adelete()
+
+        results = {}
+        try:
+            for label, cached_media in (('uncached', None), ('cached', media)):
+                results[label] = []
+                for turn in range(turns):
+                    contents = [media.part, f"Question {turn + 1} about the document?"]
+                    started_at = time.monotonic()
+                    usage = None
+                    async for chunk in context_cache.generate_content_stream(
+                            client, BENCH_API_KEY, MODEL, contents, dict(max_output_tokens=256), cached_media):
+                        usage = chunk.usage_metadata or usage
+                    results[label].append((
+                        time.monotonic() - started_at,
+                        usage.prompt_token_count or 0,
+                        usage.cached_content_token_count or 0,
+                    ))
+        finally:
+            await CachedContext.objects.filter(account=account_id(BENCH_API_KEY)).adelete()
+        return results
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import re
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from google.genai import types
+
+from interaction import context_cache
+from interaction.executors import provider_sync_to_async
+from interaction.providers import get_gemini_client
+
+BENCH_API_KEY = 'bench-gemini-ttft'
+MODEL = 'gemini-2.0-flash'
+
+
+class StreamingGeminiHandler(BaseHTTPRequestHandler):
+    """Minimal ``streamGenerateContent`` endpoint emitting ``chunks`` chunks ``chunk_delay`` seconds apart."""
+
+    chunks = 40
+    chunk_delay = 0.025
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if not re.search(r':streamGenerateContent', self.path):
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        for i in range(self.chunks):
+            time.sleep(self.chunk_delay)
+            body = {'candidates': [{'content': {'role': 'model', 'parts': [{'text': f"word{i} "}]}}]}
+            if i == self.chunks - 1:
+                body['candidates'][0]['finishReason'] = 'STOP'
+            self.wfile.write(f"data: {json.dumps(body)}\r\n\r\n".encode('utf-8'))
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Measures time to first chunk of a streamed Gemini answer, consuming the stream as it arrives '
+            '(as ChatConsumer does) and collecting it in a worker thread first (as it did before), '
+            'against a local fake Gemini server.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=5,
+            help='Answers streamed in each mode (default: 5)'
+        )
+        parser.add_argument(
+            '--chunks',
+            type=int,
+            default=40,
+            help='Chunks in each answer (default: 40)'
+        )
+        parser.add_argument(
+            '--chunk-delay-ms',
+            type=int,
+            default=25,
+            help='Delay of the fake server before each chunk, in milliseconds (default: 25)'
+        )
+
+    def handle(self, *args, **options):
+        handler = type('Handler', (StreamingGeminiHandler,), {
+            'chunks': options['chunks'],
+            'chunk_delay': options['chunk_delay_ms'] / 1000,
+        })
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        self.stdout.write(f"Fake Gemini server on {url}")
+        try:
+            results = asyncio.run(self.run(url, options['requests']))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        for label, timings in results.items():
+            self.stdout.write(
+                f"{label:>8}: first chunk after {statistics.median(first for first, total in timings) * 1000:7.1f} ms, "
+                f"whole answer after {statistics.median(total for first, total in timings) * 1000:7.1f} ms (median)"
+            )
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    async def run(self, url, requests):
+        client = get_gemini_client(BENCH_API_KEY, base_url=url)
+        config = dict(max_output_tokens=256)
+        results = {'buffered': [], 'streamed': []}
+        for _ in range(requests):
+            # Before: the sync iterator was drained in a worker thread, then forwarded
+            started_at = time.monotonic()
+            await provider_sync_to_async(lambda: list(client.models.generate_content_stream(
+                model=MODEL, contents=['Question?'], config=types.GenerateContentConfig(**config)
+            )))()
+            first = total = time.monotonic() - started_at
+            results['buffered'].append((first, total))
+
+            # Now: chunks are forwarded from the async stream as they arrive
+            started_at = time.monotonic()
+            first = None
+            async for chunk in context_cache.generate_content_stream(client, BENCH_API_KEY, MODEL, ['Question?'], config):
+                if first is None and chunk.text:
+                    first = time.monotonic() - started_at
+            results['streamed'].append((first, time.monotonic() - started_at))
+        return results
@@ -0,0 +1,175 @@
+import asyncio
+import multiprocessing
+import queue
+import socket
+import statistics
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+GROUP = 'channel_layer_check'
+
+
+def _redis_layer(redis_url, prefix):
+    from channels_redis.core import RedisChannelLayer
+    return RedisChannelLayer(hosts=[redis_url], capacity=10000, expiry=60, prefix=prefix)
+
+
+def _subscriber(index, redis_url, prefix, expected, timeout, ready, results):
+    """Child process: join the group, collect ``expected`` messages and report their latencies."""
+    import django
+    django.setup()
+
+    async def run():
+        layer = _redis_layer(redis_url, prefix)
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP, channel)
+        ready.put(index)
+        received = {}
+        try:
+            while len(received) < expected:
+                message = await asyncio.wait_for(layer.receive(channel), timeout)
+                received[message['seq']] = time.time() - message['sent_at']
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await layer.group_discard(GROUP, channel)
+            await layer.close_pools()
+        return received
+
+    results.put((index, asyncio.run(run())))
+
+
+class Command(BaseCommand):
+    help = ('Checks that channel layer group messages fan out across processes and measures their latency. '
+            'Uses REDIS_URL, or an in-process fakeredis server with --fake-redis.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--redis-url',
+            default=getattr(settings, 'REDIS_URL', None),
+            help='Redis server to test (default: REDIS_URL)'
+        )
+        parser.add_argument(
+            '--fake-redis',
+            action='store_true',
+            help='Start a local Redis-compatible fakeredis TCP server instead (pip install "fakeredis[lua]")'
+        )
+        parser.add_argument(
+            '--subscribers',
+            type=int,
+            default=3,
+            help='Number of subscriber processes (default: 3)'
+        )
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=200,
+            help='Number of group messages to send (default: 200)'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='Milliseconds between messages (default: 5)'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=10,
+            help='Seconds a subscriber waits for the next message (default: 10)'
+        )
+
+    def handle(self, *args, **options):
+        redis_url = options['redis_url']
+        if options['fake_redis']:
+            redis_url = self.start_fake_redis()
+        if not redis_url:
+            raise CommandError('No Redis server: set REDIS_URL, pass --redis-url or use --fake-redis.')
+
+        self.stdout.write(f"Testing {redis_url} with {options['subscribers']} subscriber processes")
+        context = multiprocessing.get_context('spawn')
+        # A prefix of its own per run: no flush is needed afterwards, which could drop messages
+        # subscribers have not read yet, and leftover keys expire with the layer expiry
+        prefix = f'channel_layer_check_{uuid.uuid4().hex}'
+        ready = context.Queue()
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=_subscriber,
+                args=(index, redis_url, prefix, options['messages'], options['timeout'], ready, results),
+            )
+            for index in range(options['subscribers'])
+        ]
+        for process in processes:
+            process.start()
+
+        try:
+            for _ in processes:
+                ready.get(timeout=60)
+        except queue.Empty:
+            for process in processes:
+                process.terminate()
+            raise CommandError('Subscribers did not join the group in time.')
+
+        asyncio.run(self.publish(redis_url, prefix, options['messages'], options['interval'] / 1000))
+
+        collected = {}
+        for _ in processes:
+            index, received = results.get(timeout=options['timeout'] + 60)
+            collected[index] = received
+        for process in processes:
+            process.join()
+
+        self.report(collected, options['messages'])
+
+    def start_fake_redis(self):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError('fakeredis is not installed: pip install "fakeredis[lua]"')
+
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.stdout.write(f'Started fakeredis on 127.0.0.1:{port}')
+        return f'redis://127.0.0.1:{port}/0'
+
+    async def publish(self, redis_url, prefix, count, interval):
+        layer = _redis_layer(redis_url, prefix)
+        for seq in range(count):
+            await layer.group_send(GROUP, {'type': 'layer.check', 'seq': seq, 'sent_at': time.time()})
+            if interval:
+                await asyncio.sleep(interval)
+        await layer.close_pools()
+
+    def report(self, collected, expected):
+        failures = 0
+        all_latencies = []
+        for index in sorted(collected):
+            latencies = sorted(collected[index].values())
+            all_latencies.extend(latencies)
+            missing = expected - len(latencies)
+            line = f'Subscriber {index}: {len(latencies)}/{expected} messages'
+            if latencies:
+                line += (f', latency p50 {statistics.median(latencies) * 1000:.2f} ms'
+                         f', p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.2f} ms'
+                         f', max {latencies[-1] * 1000:.2f} ms')
+            if missing:
+                failures += 1
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+
+        if all_latencies:
+            all_latencies.sort()
+            self.stdout.write(f'Overall latency p50 {statistics.median(all_latencies) * 1000:.2f} ms, '
+                              f'p95 {all_latencies[int(len(all_latencies) * 0.95) - 1] * 1000:.2f} ms')
+        if failures:
+            raise CommandError(f'{failures} subscriber(s) missed group messages.')
+        self.stdout.write(self.style.SUCCESS('Group fan-out across processes OK.'))
@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from interaction import attachments
+from interaction.models import Message
+
+MEDIA_FIELDS = ('image_url', 'pdf_url', 'video_url', 'audio_url')
+
+
+class Command(BaseCommand):
+    help = 'Moves base64 media stored inline in messages into the content-addressed attachment store'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Number of messages converted per transaction (default: 50)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count the messages that still hold inline media'
+        )
+
+    def handle(self, *args, **options):
+        inline = Q(content__contains='data:')
+        for field in MEDIA_FIELDS:
+            inline |= Q(**{f'{field}__startswith': 'data:'})
+        # Only IDs are loaded up front; the (large) rows are fetched batch by batch
+        message_ids = list(Message.objects.filter(inline).order_by('id').values_list('id', flat=True))
+        self.stdout.write(f'{len(message_ids)} messages with inline media.')
+        if options['dry_run'] or not message_ids:
+            return
+
+        batch_size = max(1, options['batch_size'])
+        converted = 0
+        for start in range(0, len(message_ids), batch_size):
+            batch = message_ids[start:start + batch_size]
+            with transaction.atomic():
+                for message in Message.objects.select_for_update().filter(id__in=batch):
+                    if self.convert(message):
+                        converted += 1
+            self.stdout.write(f'Processed {min(start + batch_size, len(message_ids))}/{len(message_ids)}')
+
+        self.stdout.write(self.style.SUCCESS(f'Converted {converted} messages.'))
+
+    def convert(self, message):
+        """Replace inline data URLs on one message with attachment URLs. Returns True if changed."""
+        stored = []
+        updated_fields = []
+        for field in MEDIA_FIELDS:
+            value = getattr(message, field)
+            if attachments.is_data_url(value):
+                try:
+                    attachment = attachments.store_data_url(value)
+                except (ValueError, IndexError) as e:
+                    self.stdout.write(self.style.WARNING(f'Message {message.id}: invalid {field}: {e}'))
+                    continue
+                setattr(message, field, attachment.url)
+                stored.append(attachment)
+                updated_fields.append(field)
+
+        content, content_attachments = attachments.replace_data_urls(message.content)
+        if content_attachments:
+            message.content = content
+            stored.extend(content_attachments)
+            updated_fields.append('content')
+
+        if not updated_fields:
+            return False
+        message.save(update_fields=updated_fields)
+        message.attachments.add(*stored)
+        return True
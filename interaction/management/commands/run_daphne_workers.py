@@ -0,0 +1,102 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+IN_MEMORY_BACKEND = 'channels.layers.InMemoryChannelLayer'
+
+
+class Command(BaseCommand):
+    help = 'Runs several Daphne worker processes that share one listening socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Number of Daphne processes (default: $WEB_CONCURRENCY, else the CPU count with '
+                 'a Redis channel layer and 1 with the in-memory one)'
+        )
+        parser.add_argument(
+            '--bind',
+            default='0.0.0.0',
+            help='Address to listen on (default: 0.0.0.0)'
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=int(os.environ.get('PORT', 8080)),
+            help='Port to listen on (default: $PORT or 8080)'
+        )
+        parser.add_argument(
+            '--application',
+            default='inspireai.asgi:application',
+            help='ASGI application path (default: inspireai.asgi:application)'
+        )
+
+    def handle(self, *args, **options):
+        backend = settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND')
+        workers = options['workers']
+        if workers is None:
+            default = 1 if backend == IN_MEMORY_BACKEND else (os.cpu_count() or 1)
+            workers = int(os.environ.get('WEB_CONCURRENCY', default))
+        workers = max(1, workers)
+        if workers > 1 and backend == IN_MEMORY_BACKEND:
+            raise CommandError(
+                'The in-memory channel layer cannot deliver group messages between processes. '
+                'Set REDIS_URL or run with --workers 1.'
+            )
+
+        # One socket for all workers: the kernel spreads incoming connections between them
+        listener = socket.socket(socket.AF_INET6 if ':' in options['bind'] else socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((options['bind'], options['port']))
+        listener.listen(1024)
+        listener.set_inheritable(True)
+        fd = listener.fileno()
+
+        command = [sys.executable, '-m', 'daphne', '--fd', str(fd), '--proxy-headers', options['application']]
+        self.stdout.write(f"Listening on {options['bind']}:{options['port']} with {workers} Daphne workers ({backend})")
+
+        processes = {}
+        stopping = False
+
+        def spawn(index):
+            processes[index] = subprocess.Popen(command, pass_fds=(fd,))
+            self.stdout.write(f'Started worker {index} (pid {processes[index].pid})')
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for process in processes.values():
+                if process.poll() is None:
+                    process.send_signal(signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for index in range(workers):
+            spawn(index)
+
+        try:
+            while not stopping:
+                time.sleep(1)
+                for index, process in list(processes.items()):
+                    if process.poll() is not None and not stopping:
+                        self.stdout.write(self.style.WARNING(
+                            f'Worker {index} (pid {process.pid}) exited with {process.returncode}, restarting'
+                        ))
+                        spawn(index)
+        finally:
+            deadline = time.monotonic() + 30
+            for process in processes.values():
+                try:
+                    process.wait(timeout=max(0, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            listener.close()
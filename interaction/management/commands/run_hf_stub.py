@@ -0,0 +1,103 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers like a TGI server (``--mode tgi``) or a pipeline endpoint (``--mode pipeline``)."""
+
+    mode = 'tgi'
+    token_delay = 0.05
+    log = print
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/info' and self.mode == 'tgi':
+            self.send_json({'model_id': 'stub/tgi', 'max_total_tokens': 2048})
+        else:
+            self.send_json({'error': 'Not Found'}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        inputs = payload.get('inputs', '')
+
+        if self.mode == 'tgi' and payload.get('stream'):
+            self.log(f"TGI stream request: {inputs!r}")
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            words = self.answer(inputs).split(' ')
+            for i, word in enumerate(words):
+                text = word if i == 0 else ' ' + word
+                event = {'token': {'id': i, 'text': text, 'special': False}, 'generated_text': None}
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(self.token_delay)
+            return
+
+        if isinstance(inputs, list):
+            self.log(f"Pipeline batch of {len(inputs)} prompts")
+            self.send_json([[{'generated_text': self.answer(prompt)}] for prompt in inputs])
+        else:
+            self.log("Pipeline request with 1 prompt")
+            self.send_json([{'generated_text': self.answer(inputs)}])
+
+    def answer(self, prompt):
+        return f"Stub answer to: {prompt}"
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Runs a local stub of a Hugging Face endpoint (TGI streaming or batched pipeline) '
+            'to test the Hugging Face adapter. Point a tool\'s api_endpoint at it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=8090,
+            help='Port to listen on (default: 8090)'
+        )
+        parser.add_argument(
+            '--mode',
+            choices=['tgi', 'pipeline'],
+            default='tgi',
+            help='Serve the TGI streaming protocol or a plain pipeline endpoint (default: tgi)'
+        )
+        parser.add_argument(
+            '--token-delay',
+            type=float,
+            default=50,
+            help='Milliseconds between streamed tokens (default: 50)'
+        )
+
+    def handle(self, *args, **options):
+        handler = type('Handler', (StubHandler,), {
+            'mode': options['mode'],
+            'token_delay': options['token_delay'] / 1000,
+            'log': lambda handler, message: self.stdout.write(message),
+        })
+        server = ThreadingHTTPServer(('127.0.0.1', options['port']), handler)
+        self.stdout.write(self.style.SUCCESS(
+            f"Hugging Face {options['mode']} stub listening on http://127.0.0.1:{options['port']}/ "
+            f"(set HUGGINGFACE_API_KEY to any value)"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
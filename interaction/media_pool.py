@@ -0,0 +1,599 @@
+"""
+Process pool for CPU-bound media work.
+
+Decoding a multi-megabyte base64 payload, hashing it and opening it with PIL
+holds the GIL for tens of milliseconds, which stalls every other socket served
+by the event loop (and a thread would still compete for the GIL). That work
+runs in a ``ProcessPoolExecutor`` instead:
+
+* Inline data URLs of a new message are decoded and hashed by a worker before
+  they are stored as attachments (:meth:`MediaProcessor.decode_data_url`).
+* Stored attachments are read by the worker straight from their storage path
+  (remote storages are copied to ``MEDIA_WORK_DIR`` first, in a thread).
+  Inline data URLs are written as base64 text to a temp file in
+  ``MEDIA_WORK_DIR`` (in a thread, it is plain I/O). Only paths cross the
+  process boundary.
+* A worker decodes the payload if needed, sniffs the real format from its
+  magic bytes, checks it matches the expected kind, validates images with PIL
+  and strips their EXIF/XMP metadata (after applying the EXIF orientation),
+  hashes the original bytes and writes the result to a temp file.
+* The consumer gets a :class:`MediaHandle` with the metadata; the bytes are
+  only read back (in a thread) when a provider request needs them.
+* Images can then be downscaled and re-encoded for a provider by the same
+  workers (:meth:`MediaProcessor.resize_image`, used by image_variants.py).
+
+At most ``MEDIA_PROCESS_WORKERS`` payloads are processed at once and at most
+``MEDIA_PROCESS_MAX_QUEUE`` more wait for a worker; callers beyond that wait
+asynchronously for a slot, without writing their temp file yet.
+
+Worker functions only use the standard library and PIL, so spawned workers do
+not need Django.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import lifespan, metrics
+
+KIND_PREFIXES = {
+    'image': 'image/',
+    'pdf': 'application/pdf',
+    'video': 'video/',
+    'audio': 'audio/',
+}
+COPY_BUFFER_SIZE = 1024 * 1024
+# Images re-encoded when they carry metadata; other formats are passed through
+REENCODABLE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+
+class MediaError(ValueError):
+    """The payload is not valid media of the expected kind."""
+
+
+def work_dir():
+    return getattr(settings, 'MEDIA_WORK_DIR', os.path.join(tempfile.gettempdir(), 'inspireai-media'))
+
+
+def sniff_mime_type(data):
+    """MIME type of ``data`` from its magic bytes, or None if unknown."""
+    head = data[:16]
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head.startswith(b'RIFF') and head[8:12] == b'WAVE':
+        return 'audio/wav'
+    if head.startswith(b'%PDF-'):
+        return 'application/pdf'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'M4A ', b'M4B '):
+            return 'audio/mp4'
+        if brand.startswith(b'qt'):
+            return 'video/quicktime'
+        if brand in (b'heic', b'heix', b'mif1'):
+            return 'image/heic'
+        return 'video/mp4'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm'
+    if head.startswith(b'OggS'):
+        return 'audio/ogg'
+    if head.startswith(b'fLaC'):
+        return 'audio/flac'
+    if head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0):
+        return 'audio/mpeg'
+    return None
+
+
+def _clean_image(data):
+    # Imported here: PIL is only needed in the workers
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        raise MediaError(f"Invalid image: {e}") from e
+
+    info = {'width': image.width, 'height': image.height}
+    has_metadata = bool(image.getexif()) or 'xmp' in image.info or 'XML:com.adobe.xmp' in image.info
+    if not has_metadata or image.format not in REENCODABLE_FORMATS or getattr(image, 'n_frames', 1) > 1:
+        return data, info
+
+    image_format = image.format
+    icc_profile = image.info.get('icc_profile')
+    image = ImageOps.exif_transpose(image)
+    output = io.BytesIO()
+    options = {'icc_profile': icc_profile} if icc_profile else {}
+    if image_format in ('JPEG', 'WEBP'):
+        options['quality'] = 95
+    image.save(output, format=image_format, **options)
+    info.update(width=image.width, height=image.height, stripped_bytes=len(data) - output.tell())
+    return output.getvalue(), info
+
+
+def _validate(data, kind, declared_mime_type, output_path):
+    if not data:
+        raise MediaError("Empty media payload.")
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    mime_type = sniff_mime_type(data) or declared_mime_type or 'application/octet-stream'
+    prefix = KIND_PREFIXES.get(kind)
+    if prefix and not mime_type.startswith(prefix):
+        raise MediaError(f"Expected {kind} data, got {mime_type}.")
+
+    info = {}
+    if mime_type.startswith('image/') and mime_type != 'image/heic':
+        data, info = _clean_image(data)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return dict(info, path=output_path, mime_type=mime_type, size=len(data), sha256=sha256)
+
+
+def process_file(input_path, kind=None, declared_mime_type=None):
+    """
+    Worker side: decode the base64 payload at ``input_path`` and validate it.
+
+    Args:
+        input_path: Temp file holding the base64 text (removed once read)
+        kind: Expected kind ('image', 'pdf', 'video' or 'audio'), or None to accept anything
+        declared_mime_type: MIME type from the data URL header, used when sniffing fails
+
+    Returns:
+        Dict with ``path``, ``mime_type``, ``size``, ``sha256`` and, for images, ``width`` and ``height``
+    """
+    try:
+        with open(input_path, 'rb') as f:
+            encoded = f.read()
+    finally:
+        os.remove(input_path)
+    try:
+        data = base64.b64decode(encoded)
+    except ValueError as e:
+        raise MediaError(f"Invalid base64 data: {e}") from e
+    return _validate(data, kind, declared_mime_type, input_path + '.out')
+
+
+def process_path(path, output_path, kind=None, declared_mime_type=None):
+    """
+    Worker side: validate the raw media file at ``path`` (left untouched).
+
+    Args:
+        path: Media file, e.g. an attachment in local storage
+        output_path: Temp file to write the processed bytes to
+        kind: Expected kind ('image', 'pdf', 'video' or 'audio'), or None to accept anything
+        declared_mime_type: Recorded MIME type, used when sniffing fails
+
+    Returns:
+        Same as :func:`process_file`
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    return _validate(data, kind, declared_mime_type, output_path)
+
+
+def decode_file(input_path, output_path):
+    """
+    Worker side: decode the base64 payload at ``input_path`` as it is, without validating it.
+
+    Args:
+        input_path: Temp file holding the base64 text (removed once read)
+        output_path: File to write the decoded bytes to
+
+    Returns:
+        Dict with ``path``, ``size``, ``sha256`` and the sniffed ``mime_type`` (or None)
+    """
+    try:
+        with open(input_path, 'rb') as f:
+            encoded = f.read()
+    finally:
+        os.remove(input_path)
+    try:
+        data = base64.b64decode(encoded)
+    except ValueError as e:
+        raise MediaError(f"Invalid base64 data: {e}") from e
+    if not data:
+        raise MediaError("Empty media payload.")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return {'path': output_path, 'mime_type': sniff_mime_type(data), 'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest()}
+
+
+def resize_file(input_path, max_side, max_short_side=None, image_format='WEBP', quality=85):
+    """
+    Worker side: write a downscaled, re-encoded copy of the image at ``input_path``.
+
+    Returns:
+        Dict with ``path``, ``mime_type``, ``size``, ``width`` and ``height`` of
+        the copy, or None when it would not be smaller than the original
+    """
+    from PIL import Image
+
+    with Image.open(input_path) as image:
+        if getattr(image, 'n_frames', 1) > 1:
+            return None  # Animations are sent as they are
+        source_size = os.path.getsize(input_path)
+        scale = min(1.0, max_side / max(image.size))
+        if max_short_side:
+            scale = min(scale, max_short_side / min(image.size))
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+
+        image.load()
+        if image_format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha and image_format != 'JPEG' else 'RGB')
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        output_path = f"{input_path}.{image_format.lower()}"
+        image.save(output_path, format=image_format, quality=quality)
+
+    variant_size = os.path.getsize(output_path)
+    if variant_size >= source_size:
+        os.remove(output_path)
+        return None
+    return {
+        'path': output_path,
+        'mime_type': Image.MIME[image_format],
+        'size': variant_size,
+        'width': size[0],
+        'height': size[1],
+    }
+
+
+def _write_input(directory, data_url):
+    header, encoded = data_url.split(',', 1)
+    declared_mime_type = header.split(':')[1].split(';')[0] if ':' in header else None
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, uuid.uuid4().hex)
+    with open(path, 'w', encoding='ascii') as f:
+        f.write(encoded)
+    return path, declared_mime_type
+
+
+def _spool(fieldfile, path):
+    # Copy a remotely stored file to local disk in chunks (no base64, no full copy in memory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with fieldfile.open('rb') as source, open(path, 'wb') as target:
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+
+
+def _read_output(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _discard_result(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    if isinstance(result, dict) and result.get('path'):
+        _remove(result['path'])
+
+
+class MediaHandle:
+    """
+    Processed media waiting in a temp file.
+
+    ``sha256`` is the hash of the bytes as uploaded (like ``Attachment.sha256``),
+    so caches keyed by it are not affected by metadata stripping.
+    """
+
+    def __init__(self, path, mime_type, size, sha256, width=None, height=None, stripped_bytes=0):
+        self.path = path
+        self.mime_type = mime_type
+        self.size = size
+        self.sha256 = sha256
+        self.width = width
+        self.height = height
+        self.stripped_bytes = stripped_bytes
+
+    async def read(self):
+        """Return the processed bytes and remove the temp file (a handle is read once)."""
+        return await sync_to_async(_read_output, thread_sensitive=False)(self.path)
+
+    def discard(self):
+        """Remove the temp file without reading it (a no-op once it was read)."""
+        _remove(self.path)
+
+
+class MediaProcessor:
+    """
+    Bounded process pool with queue-depth accounting, like
+    :class:`~interaction.executors.ProviderExecutor` for threads.
+    """
+
+    def __init__(self, max_workers, max_queue):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._active = 0
+        self._completed = 0
+        self._failed = 0
+
+    def _get_pool(self):
+        # Spawned rather than forked: the server process runs threads and an event loop
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _get_slots(self):
+        # Created lazily so the semaphore binds to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+        return self._slots
+
+    async def _acquire(self):
+        slots = self._get_slots()
+        with self._lock:
+            self._waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        return slots
+
+    async def _execute(self, func, *args):
+        # Run a worker function and account for it; the caller holds a slot
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._active += 1
+        started_at = time.monotonic()
+        future = None
+        try:
+            future = self._get_pool().submit(func, *args)
+            return await asyncio.wrap_future(future, loop=loop)
+        except asyncio.CancelledError:
+            with self._lock:
+                self._failed += 1
+            if future is not None:
+                # The worker may still finish: remove the file nobody will read
+                future.add_done_callback(_discard_result)
+            raise
+        except BrokenProcessPool:
+            # A worker died (out of memory on a huge image...): start a new pool next time
+            with self._lock:
+                self._pool = None
+                self._failed += 1
+            raise MediaError("Media processing failed.")
+        except BaseException:
+            with self._lock:
+                self._failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._completed += 1
+            metrics.observe('media_pool.run_time', time.monotonic() - started_at)
+
+    async def process_data_url(self, data_url, kind=None):
+        """
+        Decode and validate a base64 data URL in a worker process.
+
+        Args:
+            data_url: ``data:<mime>;base64,<payload>``
+            kind: Expected kind ('image', 'pdf', 'video' or 'audio')
+
+        Returns:
+            :class:`MediaHandle`
+
+        Raises:
+            MediaError: If the payload is not valid media of that kind
+        """
+        slots = await self._acquire()
+        try:
+            input_path, declared_mime_type = await sync_to_async(_write_input, thread_sensitive=False)(
+                work_dir(), data_url
+            )
+            try:
+                result = await self._execute(process_file, input_path, kind, declared_mime_type)
+            except BaseException:
+                _remove(input_path)
+                raise
+        finally:
+            slots.release()
+
+        return self._handle(result)
+
+    async def decode_data_url(self, data_url):
+        """
+        Decode a base64 data URL in a worker process, keeping the bytes as uploaded
+        (to be stored as an attachment; see :func:`attachments.store_handle`).
+
+        Returns:
+            :class:`MediaHandle` with the declared MIME type (the sniffed one if
+            the header has none)
+
+        Raises:
+            MediaError: If the payload is not valid base64
+        """
+        slots = await self._acquire()
+        try:
+            input_path, declared_mime_type = await sync_to_async(_write_input, thread_sensitive=False)(
+                work_dir(), data_url
+            )
+            try:
+                result = await self._execute(decode_file, input_path, input_path + '.out')
+            except BaseException:
+                _remove(input_path)
+                raise
+        finally:
+            slots.release()
+        result['mime_type'] = declared_mime_type or result['mime_type'] or 'application/octet-stream'
+        metrics.incr('media_pool.decoded_bytes', result['size'])
+        return MediaHandle(**result)
+
+    def _handle(self, result):
+        handle = MediaHandle(**result)
+        metrics.incr('media_pool.processed_bytes', handle.size)
+        if handle.stripped_bytes:
+            metrics.incr('media_pool.metadata_stripped')
+        return handle
+
+    async def process_attachment(self, attachment, kind=None):
+        """
+        Validate a stored attachment in a worker process.
+
+        Local files are read by the worker straight from storage; files on a
+        remote storage are first copied to ``MEDIA_WORK_DIR`` in a thread.
+
+        Args:
+            attachment: The Attachment
+            kind: Expected kind ('image', 'pdf', 'video' or 'audio')
+
+        Returns:
+            :class:`MediaHandle`
+
+        Raises:
+            MediaError: If the file is not valid media of that kind
+        """
+        output_path = os.path.join(work_dir(), uuid.uuid4().hex + '.out')
+        try:
+            path, spooled = attachment.file.path, False
+        except NotImplementedError:
+            path, spooled = output_path[:-len('.out')], True
+
+        slots = await self._acquire()
+        try:
+            if spooled:
+                await sync_to_async(_spool, thread_sensitive=False)(attachment.file, path)
+            try:
+                result = await self._execute(process_path, path, output_path, kind, attachment.mime_type)
+            finally:
+                if spooled:
+                    _remove(path)
+        finally:
+            slots.release()
+        return self._handle(result)
+
+    async def resize_image(self, handle, max_side, max_short_side=None, image_format='WEBP', quality=85):
+        """
+        Downscale and re-encode the image of ``handle`` in a worker process.
+
+        ``handle`` is left untouched, so the original can still be read.
+
+        Args:
+            handle: :class:`MediaHandle` of a validated image
+            max_side: Maximum width and height
+            max_short_side: Maximum size of the shorter side, if the provider has one
+            image_format: 'WEBP' or 'JPEG'
+            quality: Encoder quality (1-100)
+
+        Returns:
+            :class:`MediaHandle` of the variant, or None if it would not be smaller than the original
+        """
+        slots = await self._acquire()
+        try:
+            result = await self._execute(resize_file, handle.path, max_side, max_short_side, image_format, quality)
+        finally:
+            slots.release()
+        if result is None:
+            return None
+        return MediaHandle(sha256=handle.sha256, **result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'active': self._active,
+                'waiting_for_slot': self._waiting,
+                'completed': self._completed,
+                'failed': self._failed,
+            }
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=not wait)
+
+
+_processor = None
+_processor_lock = threading.Lock()
+
+
+def get_media_processor():
+    """Return the process-wide media processor, creating it on first use."""
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = MediaProcessor(
+                    max_workers=getattr(settings, 'MEDIA_PROCESS_WORKERS', 2),
+                    max_queue=getattr(settings, 'MEDIA_PROCESS_MAX_QUEUE', 16),
+                )
+                metrics.register_collector('media_pool', _processor.stats)
+                lifespan.on_sync_shutdown(_processor.shutdown)
+    return _processor
+
+
+def holds(attachment, kind):
+    """Whether ``attachment`` is media of ``kind`` ('image', 'pdf', 'video' or 'audio')."""
+    return attachment is not None and attachment.mime_type.startswith(KIND_PREFIXES[kind])
+
+
+async def process(data_url, kind, attachment=None):
+    """
+    Process a message's media: straight from the stored ``attachment`` when it
+    holds media of ``kind``, from the inline ``data_url`` otherwise.
+
+    Returns:
+        :class:`MediaHandle`
+    """
+    if holds(attachment, kind):
+        return await get_media_processor().process_attachment(attachment, kind)
+    return await get_media_processor().process_data_url(data_url, kind)
+
+
+async def process_data_url(data_url, kind=None):
+    """Shortcut for ``get_media_processor().process_data_url(data_url, kind)``."""
+    return await get_media_processor().process_data_url(data_url, kind)
+
+
+async def decode_data_url(data_url):
+    """Shortcut for ``get_media_processor().decode_data_url(data_url)``."""
+    return await get_media_processor().decode_data_url(data_url)
+
+
+async def process_attachment(attachment, kind=None):
+    """Shortcut for ``get_media_processor().process_attachment(attachment, kind)``."""
+    return await get_media_processor().process_attachment(attachment, kind)
@@ -0,0 +1,68 @@
+"""
+Minimal in-process metrics registry for the interaction app.
+
+Counters and timings are kept per process and exposed as JSON through the
+staff-only ``interaction:metrics`` view. Components that already track their
+own state (thread pools, connection pools, caches...) register a collector
+callable instead of pushing values.
+"""
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_timings = {}
+_collectors = {}
+
+
+def incr(name, value=1):
+    """Increase the counter ``name`` by ``value``."""
+    with _lock:
+        _counters[name] += value
+
+
+def counter(name):
+    """Current value of the counter ``name`` (0 if never increased)."""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def observe(name, seconds):
+    """Record a duration (in seconds) for the timing ``name``."""
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+
+
+def register_collector(name, collector):
+    """
+    Register a callable returning a dict of current values.
+
+    Collectors are evaluated lazily on every snapshot, so they should be cheap.
+    """
+    with _lock:
+        _collectors[name] = collector
+
+
+def snapshot():
+    """Return all counters, timings and collector values as a plain dict."""
+    with _lock:
+        counters = dict(_counters)
+        timings = {
+            name: dict(values, avg=values['total'] / values['count'] if values['count'] else 0.0)
+            for name, values in _timings.items()
+        }
+        collectors = dict(_collectors)
+
+    collected = {}
+    for name, collector in collectors.items():
+        try:
+            collected[name] = collector()
+        except Exception as e:
+            collected[name] = {'error': str(e)}
+
+    return {'counters': counters, 'timings': timings, 'collectors': collected}
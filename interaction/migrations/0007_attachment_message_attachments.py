@@ -0,0 +1,30 @@
+# Generated by Django 5.1.7 on 2026-10-18 10:00
+
+import interaction.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("interaction", "0006_message_audio_url"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Attachment",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("sha256", models.CharField(max_length=64, unique=True)),
+                ("file", models.FileField(max_length=255, storage=interaction.models.attachment_storage, upload_to="attachments/")),
+                ("mime_type", models.CharField(max_length=100)),
+                ("size", models.PositiveBigIntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="attachments",
+            field=models.ManyToManyField(blank=True, related_name="messages", to="interaction.attachment"),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.7 on 2026-10-18 10:30
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("interaction", "0007_attachment_message_attachments"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GenerationJob",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ("kind", models.CharField(choices=[("imagen", "Image generation"), ("image_edit", "Image editing"), ("veo", "Video generation")], max_length=20)),
+                ("state", models.CharField(choices=[("pending", "Pending"), ("running", "Running"), ("succeeded", "Succeeded"), ("failed", "Failed")], default="pending", max_length=20)),
+                ("prompt", models.TextField()),
+                ("params", models.JSONField(blank=True, default=dict)),
+                ("request_id", models.CharField(blank=True, max_length=64)),
+                ("operation_name", models.CharField(blank=True, max_length=255)),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                ("worker", models.CharField(blank=True, max_length=100)),
+                ("lease_expires_at", models.DateTimeField(blank=True, null=True)),
+                ("error", models.TextField(blank=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("conversation", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="generation_jobs", to="interaction.conversation")),
+                ("message", models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to="interaction.message")),
+                ("result_attachments", models.ManyToManyField(blank=True, related_name="generation_jobs", to="interaction.attachment")),
+                ("source_attachment", models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to="interaction.attachment")),
+            ],
+            options={
+                "ordering": ["created_at"],
+                "indexes": [models.Index(fields=["state", "lease_expires_at"], name="generationjob_claim_idx")],
+            },
+        ),
+    ]
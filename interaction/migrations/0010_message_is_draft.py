@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("interaction", "0009_message_is_truncated"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="is_draft",
+            field=models.BooleanField(default=False),
+        ),
+    ]
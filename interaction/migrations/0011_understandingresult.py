@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("interaction", "0010_message_is_draft"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UnderstandingResult",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("key", models.CharField(max_length=64, unique=True)),
+                ("content_hash", models.CharField(db_index=True, max_length=64)),
+                ("request_type", models.CharField(max_length=20)),
+                ("model", models.CharField(max_length=100)),
+                ("text", models.TextField()),
+                ("size", models.PositiveIntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("last_used_at", models.DateTimeField(db_index=True)),
+                ("expires_at", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("interaction", "0012_remotefile"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CachedContext",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("sha256", models.CharField(max_length=64)),
+                ("account", models.CharField(max_length=16)),
+                ("model", models.CharField(max_length=100)),
+                ("name", models.CharField(max_length=255)),
+                ("token_count", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("last_used_at", models.DateTimeField()),
+                ("expires_at", models.DateTimeField(db_index=True)),
+            ],
+            options={
+                "unique_together": {("account", "sha256", "model")},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("interaction", "0013_cachedcontext"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="summary",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="summary_until",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
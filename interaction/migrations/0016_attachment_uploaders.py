@@ -0,0 +1,20 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("interaction", "0015_imagevariant"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="attachment",
+            name="uploaders",
+            field=models.ManyToManyField(blank=True, related_name="uploaded_attachments", to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -1,8 +1,28 @@
 from django.db import models
 from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.urls import reverse
+from django.utils.module_loading import import_string
 from catalog.models import AITool
 import uuid
 
+
+def attachment_storage():
+    """
+    Storage for attachment bytes: the configured S3/Spaces storage when credentials
+    are set, local disk under MEDIA_ROOT otherwise.
+
+    Unlike the catalog images, attachments are private objects (whatever
+    AWS_DEFAULT_ACL says), only reachable through signed, expiring URLs.
+    """
+    if getattr(settings, 'AWS_ACCESS_KEY_ID', None) and getattr(settings, 'AWS_SECRET_ACCESS_KEY', None):
+        return import_string(settings.DEFAULT_FILE_STORAGE)(
+            default_acl='private',
+            querystring_auth=True,
+            querystring_expire=getattr(settings, 'ATTACHMENT_URL_EXPIRY', 300),
+        )
+    return FileSystemStorage(location=settings.MEDIA_ROOT)
+
 class Conversation(models.Model):
     """
     Model representing a conversation with an AI tool.
@@ -11,6 +31,8 @@ class Conversation(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     tool = models.ForeignKey(AITool, on_delete=models.CASCADE)
     title = models.CharField(max_length=255, blank=True)
+    summary = models.TextField(blank=True, default='')  # Rolling summary of the turns sent before the history window (see context.py)
+    summary_until = models.BigIntegerField(blank=True, null=True)  # ID of the last message folded into the summary
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -28,6 +50,28 @@ class Conversation(models.Model):
         super().save(*args, **kwargs)
 
 
+class Attachment(models.Model):
+    """
+    Content-addressed media file (uploads and generated images/videos) referenced by messages.
+    Identical bytes are stored once.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='attachments/', storage=attachment_storage, max_length=255)
+    mime_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Users who uploaded these bytes; only they (or users whose messages reference it) may use it
+    uploaders = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True, related_name='uploaded_attachments')
+
+    def __str__(self):
+        return f"{self.mime_type} attachment {self.sha256[:12]}"
+
+    @property
+    def url(self):
+        # Always the app's URL, which checks who may see the file (see views.attachment_file)
+        return reverse('interaction:attachment', kwargs={'sha256': self.sha256})
+
+
 class Message(models.Model):
     """
     Model representing a message in a conversation.
@@ -40,6 +84,9 @@ class Message(models.Model):
     video_url = models.TextField(blank=True, null=True)  # Optional video URL or base64/YouTube
     audio_url = models.TextField(blank=True, null=True)  # Optional audio URL or base64
     file_type = models.CharField(max_length=20, blank=True, null=True)  # Type of file (image, pdf, video, audio, etc.)
+    attachments = models.ManyToManyField(Attachment, blank=True, related_name='messages')  # Media stored outside the row
+    is_truncated = models.BooleanField(default=False)  # AI answer stopped by the user before it finished
+    is_draft = models.BooleanField(default=False)  # AI answer still being generated (checkpoint, see resumable.py)
     timestamp = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -50,6 +97,147 @@ class Message(models.Model):
         return f"{sender} message in {self.conversation.id}"
 
 
+class GenerationJob(models.Model):
+    """
+    A long-running media generation (Imagen, image edit, Veo) that outlives the
+    socket that requested it. Picked up and resumed by the worker in jobs.py.
+    """
+    KIND_IMAGEN = 'imagen'
+    KIND_IMAGE_EDIT = 'image_edit'
+    KIND_VEO = 'veo'
+    KIND_CHOICES = [
+        (KIND_IMAGEN, 'Image generation'),
+        (KIND_IMAGE_EDIT, 'Image editing'),
+        (KIND_VEO, 'Video generation'),
+    ]
+
+    STATE_PENDING = 'pending'
+    STATE_RUNNING = 'running'
+    STATE_SUCCEEDED = 'succeeded'
+    STATE_FAILED = 'failed'
+    STATE_CHOICES = [
+        (STATE_PENDING, 'Pending'),
+        (STATE_RUNNING, 'Running'),
+        (STATE_SUCCEEDED, 'Succeeded'),
+        (STATE_FAILED, 'Failed'),
+    ]
+    ACTIVE_STATES = (STATE_PENDING, STATE_RUNNING)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='generation_jobs')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=STATE_PENDING)
+    prompt = models.TextField()
+    params = models.JSONField(default=dict, blank=True)  # Provider parameters parsed from the prompt
+    source_attachment = models.ForeignKey(Attachment, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')  # Input image
+    request_id = models.CharField(max_length=64, blank=True)  # Chat request that created the job
+    operation_name = models.CharField(max_length=255, blank=True)  # Provider long-running operation ID (Veo)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)  # Worker holding the lease
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    result_attachments = models.ManyToManyField(Attachment, blank=True, related_name='generation_jobs')
+    message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')  # AI message with the result
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['state', 'lease_expires_at'], name='generationjob_claim_idx')]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} job {self.id} ({self.state})"
+
+    @property
+    def is_active(self):
+        return self.state in self.ACTIVE_STATES
+
+
+class UnderstandingResult(models.Model):
+    """
+    Cached answer of an image/video/audio understanding request (database tier
+    of the cache in result_cache.py), keyed by media hash, request type, model and prompt.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    content_hash = models.CharField(max_length=64, db_index=True)  # SHA-256 of the media (or of the YouTube URL)
+    request_type = models.CharField(max_length=20)
+    model = models.CharField(max_length=100)
+    text = models.TextField()  # Raw model answer, before any HTML overlay is added
+    size = models.PositiveIntegerField()  # Bytes of text, counted against the cache size limit
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(db_index=True)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.request_type} result for {self.content_hash[:12]} ({self.model})"
+
+
+class RemoteFile(models.Model):
+    """
+    Media uploaded to the Gemini Files API, reused by later turns until the
+    provider deletes it (see gemini_files.py). Keyed by the media SHA-256.
+    """
+    sha256 = models.CharField(max_length=64)
+    account = models.CharField(max_length=16)  # Fingerprint of the API key owning the file
+    name = models.CharField(max_length=255)  # Provider file name (files/...)
+    uri = models.URLField(max_length=500)
+    mime_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)  # When the provider deletes the file
+
+    class Meta:
+        unique_together = ('account', 'sha256')
+
+    def __str__(self):
+        return f"{self.name} ({self.mime_type}, {self.sha256[:12]})"
+
+
+class CachedContext(models.Model):
+    """
+    Gemini cached content holding a large media prefix (PDF, video, audio), so
+    later turns about the same media only send their new text (see context_cache.py).
+    """
+    sha256 = models.CharField(max_length=64)  # SHA-256 of the cached media
+    account = models.CharField(max_length=16)  # Fingerprint of the API key owning the cache
+    model = models.CharField(max_length=100)
+    name = models.CharField(max_length=255)  # Provider cache name (cachedContents/...)
+    token_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('account', 'sha256', 'model')
+
+    def __str__(self):
+        return f"{self.name} ({self.model}, {self.sha256[:12]})"
+
+
+class ImageVariant(models.Model):
+    """
+    Downscaled, recompressed copy of an uploaded image for one provider profile
+    (see image_variants.py). Keyed by the source SHA-256; a null attachment
+    means the original is sent as it is.
+    """
+    source_sha256 = models.CharField(max_length=64)
+    profile = models.CharField(max_length=100)  # provider:max_side:max_short_side:format:quality
+    attachment = models.ForeignKey(Attachment, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    mime_type = models.CharField(max_length=100)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    source_size = models.PositiveBigIntegerField()
+    size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('source_sha256', 'profile')
+
+    def __str__(self):
+        return f"{self.profile} variant of {self.source_sha256[:12]}"
+
+
 class Favorite(models.Model):
     """
     Model representing a user's favorite AI tool.
@@ -0,0 +1,129 @@
+"""
+Adapter for CUSTOM tools: self-hosted OpenAI-compatible servers (vLLM,
+llama.cpp, TGI's Messages API...).
+
+``tool.api_endpoint`` is the server's base URL (``http://gpu-box:8000/v1``; a
+full ``.../chat/completions`` URL is accepted too). Every endpoint gets its own
+pooled ``AsyncOpenAI`` client, a cap of ``CUSTOM_ENDPOINT_CONCURRENCY``
+concurrent streams (requests over it wait for a free slot) and its own
+time-to-first-token and total latency timings, so the load sent to each box can
+be compared with the hosted providers on the metrics page.
+"""
+import asyncio
+import os
+import time
+import weakref
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from . import metrics
+from .adapters import AdapterError, max_output_tokens, sampling_options, system_prompt
+from .providers import get_async_openai_client
+
+CHAT_COMPLETIONS_SUFFIX = '/chat/completions'
+
+
+def endpoint_concurrency():
+    return getattr(settings, 'CUSTOM_ENDPOINT_CONCURRENCY', 16)
+
+
+def base_url(endpoint):
+    """Normalize ``tool.api_endpoint`` to the base URL expected by the OpenAI client."""
+    endpoint = endpoint.strip().rstrip('/')
+    if endpoint.endswith(CHAT_COMPLETIONS_SUFFIX):
+        endpoint = endpoint[:-len(CHAT_COMPLETIONS_SUFFIX)]
+    return endpoint
+
+
+def endpoint_name(url):
+    """Metric-friendly name of an endpoint (its host and port)."""
+    return urlsplit(url).netloc or url
+
+
+class EndpointLimiter:
+    """Concurrency cap and usage counts of one endpoint on one event loop."""
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(endpoint_concurrency())
+        self.active = 0
+        self.waiting = 0
+
+
+_limiters = weakref.WeakKeyDictionary()  # event loop -> {base_url: EndpointLimiter}
+
+
+def get_limiter(url):
+    limiters = _limiters.setdefault(asyncio.get_running_loop(), {})
+    limiter = limiters.get(url)
+    if limiter is None:
+        limiter = limiters[url] = EndpointLimiter()
+    return limiter
+
+
+async def stream(tool, user_message):
+    """
+    Stream an answer from the OpenAI-compatible server of ``tool``.
+
+    Yields:
+        Text deltas
+    """
+    if not tool.api_endpoint:
+        raise AdapterError("API endpoint not configured for this tool.")
+    url = base_url(tool.api_endpoint)
+    name = endpoint_name(url)
+    # Local servers usually ignore the key, but the client requires one
+    client = get_async_openai_client(os.environ.get('CUSTOM_API_KEY') or 'not-needed', url)
+    limiter = get_limiter(url)
+
+    queued_at = time.monotonic()
+    limiter.waiting += 1
+    try:
+        await limiter.semaphore.acquire()
+    finally:
+        limiter.waiting -= 1
+    limiter.active += 1
+    started_at = time.monotonic()
+    metrics.observe(f'custom.{name}.queue_wait', started_at - queued_at)
+    response = None
+    try:
+        response = await client.chat.completions.create(
+            model=tool.api_model or "default",
+            messages=[
+                {"role": "system", "content": system_prompt(tool)},
+                {"role": "user", "content": user_message},
+            ],
+            max_tokens=max_output_tokens(),
+            stream=True,
+            **sampling_options(tool),
+        )
+        first = True
+        async for event in response:
+            if event.choices and event.choices[0].delta.content:
+                if first:
+                    metrics.observe(f'custom.{name}.ttft', time.monotonic() - started_at)
+                    first = False
+                yield event.choices[0].delta.content
+        metrics.observe(f'custom.{name}.latency', time.monotonic() - started_at)
+        metrics.incr(f'custom.{name}.completed')
+    except Exception:
+        metrics.incr(f'custom.{name}.failed')
+        raise
+    finally:
+        if response is not None:
+            await response.close()
+        limiter.active -= 1
+        limiter.semaphore.release()
+
+
+def _stats():
+    stats = {}
+    for limiters in list(_limiters.values()):
+        for url, limiter in list(limiters.items()):
+            totals = stats.setdefault(endpoint_name(url), {'active': 0, 'waiting': 0})
+            totals['active'] += limiter.active
+            totals['waiting'] += limiter.waiting
+    return stats
+
+
+metrics.register_collector('custom_endpoints', _stats)
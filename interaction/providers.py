@@ -0,0 +1,229 @@
+"""
+Process-wide registry of pooled AI provider clients.
+
+Building a new ``AsyncOpenAI`` or ``genai.Client`` per message means a new TLS
+handshake to the provider every time. Clients are created lazily here, keep
+their keep-alive connection pools, and are shared by ``ChatConsumer`` and the
+fallback views.
+
+Async clients are cached per event loop (connections cannot move between
+loops); synchronous code running outside any loop shares one process-wide set.
+Synchronous views calling async code go through :func:`run_sync`, which closes
+the clients of its short-lived loop before returning.
+"""
+import asyncio
+import threading
+import weakref
+
+import httpx
+import google.genai as genai
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from google.genai import types
+from openai import AsyncOpenAI, OpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient
+
+from . import lifespan, metrics
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=getattr(settings, 'PROVIDER_HTTP_MAX_CONNECTIONS', 100),
+        max_keepalive_connections=getattr(settings, 'PROVIDER_HTTP_MAX_KEEPALIVE', 20),
+        keepalive_expiry=getattr(settings, 'PROVIDER_HTTP_KEEPALIVE_EXPIRY', 60),
+    )
+
+
+def _timeout():
+    return httpx.Timeout(getattr(settings, 'PROVIDER_HTTP_TIMEOUT', 600), connect=10)
+
+
+def _httpx_pool_stats(client):
+    """Open/idle/waiting connection counts of an httpx client (best effort, httpcore internals)."""
+    pool = getattr(getattr(client, '_transport', None), '_pool', None)
+    if pool is None:
+        return None
+    connections = list(getattr(pool, 'connections', []))
+    requests = list(getattr(pool, '_requests', []))
+    return {
+        'open': len(connections),
+        'idle': sum(1 for connection in connections if connection.is_idle()),
+        'waiting': sum(1 for request in requests if getattr(request, 'connection', None) is None),
+    }
+
+
+class ProviderClients:
+    """Lazily built provider clients, one per (kind, key) and event loop."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._process_scope = {}
+        self._loop_scopes = weakref.WeakKeyDictionary()
+
+    def _scope(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self._process_scope
+        scope = self._loop_scopes.get(loop)
+        if scope is None:
+            scope = self._loop_scopes[loop] = {}
+        return scope
+
+    def _get(self, kind, key, factory):
+        with self._lock:
+            scope = self._scope()
+            entry = scope.get((kind, key))
+            if entry is None:
+                entry = scope[(kind, key)] = factory()
+                metrics.incr(f'provider_clients.created.{kind}')
+            return entry[0]
+
+    def async_openai(self, api_key, base_url=None):
+        def factory():
+            http_client = DefaultAsyncHttpxClient(limits=_limits(), timeout=_timeout())
+            return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client), http_client
+        return self._get('async_openai', (api_key, base_url), factory)
+
+    def openai(self, api_key, base_url=None):
+        def factory():
+            http_client = DefaultHttpxClient(limits=_limits(), timeout=_timeout())
+            return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client), http_client
+        return self._get('openai', (api_key, base_url), factory)
+
+    def gemini(self, api_key, base_url=None):
+        def factory():
+            limits = _limits()
+            client = genai.Client(
+                api_key=api_key,
+                http_options=types.HttpOptions(
+                    base_url=base_url,
+                    client_args={'limits': limits},
+                    async_client_args={'limits': limits},
+                ),
+            )
+            return client, None
+        return self._get('gemini', (api_key, base_url), factory)
+
+    def http(self):
+        def factory():
+            client = httpx.AsyncClient(limits=_limits(), timeout=_timeout(), follow_redirects=True)
+            return client, client
+        return self._get('http', None, factory)
+
+    def _http_clients(self, entry, kind):
+        client, http_client = entry
+        if kind == 'gemini':
+            api_client = getattr(client, '_api_client', None)
+            return [c for c in (getattr(api_client, '_httpx_client', None),
+                                getattr(api_client, '_async_httpx_client', None)) if c is not None]
+        return [http_client] if http_client is not None else []
+
+    def stats(self):
+        """Connection pool statistics per client, summed over all scopes."""
+        with self._lock:
+            scopes = [self._process_scope] + list(self._loop_scopes.values())
+            items = [(kind, key, entry) for scope in scopes for (kind, key), entry in scope.items()]
+
+        result = {}
+        for kind, key, entry in items:
+            totals = result.setdefault(kind, {'clients': 0, 'open': 0, 'idle': 0, 'waiting': 0})
+            totals['clients'] += 1
+            for http_client in self._http_clients(entry, kind):
+                pool = _httpx_pool_stats(http_client)
+                if pool:
+                    for name, value in pool.items():
+                        totals[name] += value
+        return result
+
+    async def aclose(self):
+        """Close the clients owned by the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            scope = self._loop_scopes.pop(loop, {})
+        for (kind, key), entry in scope.items():
+            client, http_client = entry
+            try:
+                if kind == 'gemini':
+                    aio_close = getattr(client.aio, 'aclose', None)
+                    if aio_close is not None:
+                        await aio_close()
+                elif kind == 'http':
+                    await client.aclose()
+                else:
+                    await client.close()
+            except Exception as e:
+                print(f"Warning: could not close {kind} client: {e}")
+
+    def close(self):
+        """Close the process-wide synchronous clients."""
+        with self._lock:
+            scope, self._process_scope = self._process_scope, {}
+        for (kind, key), entry in scope.items():
+            client, http_client = entry
+            try:
+                close = getattr(client, 'close', None)
+                if close is not None and not asyncio.iscoroutinefunction(close):
+                    close()
+            except Exception as e:
+                print(f"Warning: could not close {kind} client: {e}")
+
+
+registry = ProviderClients()
+metrics.register_collector('provider_pools', registry.stats)
+lifespan.on_shutdown(registry.aclose)
+lifespan.on_sync_shutdown(registry.close)
+
+
+def get_async_openai_client(api_key, base_url=None):
+    """Shared ``AsyncOpenAI`` client for the running event loop."""
+    return registry.async_openai(api_key, base_url)
+
+
+def get_openai_client(api_key, base_url=None):
+    """Shared synchronous ``OpenAI`` client."""
+    return registry.openai(api_key, base_url)
+
+
+def get_gemini_client(api_key, base_url=None):
+    """
+    Shared ``genai.Client``; use ``.aio`` for the async API.
+
+    ``base_url`` (default: the GEMINI_BASE_URL setting) points the client at
+    another server, e.g. the stub of ``manage.py bench_context_cache``.
+    """
+    return registry.gemini(api_key, base_url or getattr(settings, 'GEMINI_BASE_URL', None))
+
+
+def get_http_client():
+    """Shared ``httpx.AsyncClient`` for plain HTTP calls (downloads, REST endpoints)."""
+    return registry.http()
+
+
+def pool_stats():
+    return registry.stats()
+
+
+def run_sync(async_function, *args, **kwargs):
+    """
+    Call ``async_function`` from synchronous code and return its result.
+
+    The coroutine runs on a new event loop (even under ASGI, where
+    ``async_to_sync`` would otherwise borrow the server's loop), and the
+    provider clients created for that loop are closed before it ends, so each
+    call does not leave a pooled client with open connections behind.
+
+    Args:
+        async_function: Coroutine function to run
+        *args, **kwargs: Its arguments
+
+    Returns:
+        The result of the coroutine
+    """
+    async def call():
+        try:
+            return await async_function(*args, **kwargs)
+        finally:
+            await registry.aclose()
+            metrics.incr('provider_clients.loop_closed')
+
+    return async_to_sync(call, force_new_loop=True)()
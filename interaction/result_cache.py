@@ -0,0 +1,195 @@
+"""
+Cache of image/video/audio understanding answers.
+
+Understanding requests run at a low temperature with fixed prompts, so the same
+file (or YouTube URL) asked the same thing by the same model gets the same
+answer. Results are keyed by media hash, request type, model and prompt, and
+looked up through a chain of tiers, fastest first:
+
+* ``memory``: per-process LRU bounded by ``UNDERSTANDING_CACHE_MEMORY_BYTES``.
+* ``database``: :class:`~interaction.models.UnderstandingResult` rows shared by
+  every worker, bounded by ``UNDERSTANDING_CACHE_DATABASE_BYTES`` (least
+  recently used rows are evicted first).
+
+Tiers are picked with ``UNDERSTANDING_CACHE_TIERS``; every entry expires after
+``UNDERSTANDING_CACHE_TTL`` seconds. A hit in a slower tier is copied into the
+faster ones. Only the raw model text is cached; the HTML overlays built around
+it depend on the message and are rebuilt on every answer.
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import metrics
+from .models import UnderstandingResult
+
+
+def ttl():
+    return getattr(settings, 'UNDERSTANDING_CACHE_TTL', 7 * 24 * 3600)
+
+
+def memory_max_bytes():
+    return getattr(settings, 'UNDERSTANDING_CACHE_MEMORY_BYTES', 16 * 1024 * 1024)
+
+
+def database_max_bytes():
+    return getattr(settings, 'UNDERSTANDING_CACHE_DATABASE_BYTES', 256 * 1024 * 1024)
+
+
+def content_hash(data):
+    """SHA-256 of media bytes, or of a URL for remote media (YouTube)."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_key(media_hash, request_type, model, prompt):
+    material = json.dumps([media_hash, request_type, model, prompt])
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class MemoryTier:
+    """LRU of recent results in this process."""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._entries = OrderedDict()  # key -> (text, expires_at)
+        self.bytes = 0
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        text, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return text
+
+    async def set(self, key, text, **meta):
+        if key in self._entries:
+            self._remove(key)
+        size = len(text.encode('utf-8'))
+        if size > memory_max_bytes():
+            return
+        self._entries[key] = (text, time.monotonic() + ttl())
+        self.bytes += size
+        while self.bytes > memory_max_bytes():
+            self._remove(next(iter(self._entries)))
+            metrics.incr('understanding_cache.evicted.memory')
+
+    def _remove(self, key):
+        text, expires_at = self._entries.pop(key)
+        self.bytes -= len(text.encode('utf-8'))
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.bytes}
+
+
+class DatabaseTier:
+    """Results stored in the database, shared by every worker."""
+
+    name = 'database'
+
+    async def get(self, key):
+        now = timezone.now()
+        try:
+            result = await UnderstandingResult.objects.aget(key=key, expires_at__gt=now)
+        except UnderstandingResult.DoesNotExist:
+            return None
+        await UnderstandingResult.objects.filter(pk=result.pk).aupdate(last_used_at=now)
+        return result.text
+
+    async def set(self, key, text, media_hash='', request_type='', model=''):
+        now = timezone.now()
+        await UnderstandingResult.objects.aupdate_or_create(key=key, defaults={
+            'content_hash': media_hash,
+            'request_type': request_type,
+            'model': model,
+            'text': text,
+            'size': len(text.encode('utf-8')),
+            'last_used_at': now,
+            'expires_at': now + timedelta(seconds=ttl()),
+        })
+        await self.evict(now)
+
+    async def evict(self, now):
+        expired, _ = await UnderstandingResult.objects.filter(expires_at__lte=now).adelete()
+        evicted = 0
+        total = (await UnderstandingResult.objects.aaggregate(total=Sum('size')))['total'] or 0
+        if total > database_max_bytes():
+            async for pk, size in UnderstandingResult.objects.order_by('last_used_at').values_list('pk', 'size'):
+                await UnderstandingResult.objects.filter(pk=pk).adelete()
+                evicted += 1
+                total -= size
+                if total <= database_max_bytes():
+                    break
+        if expired or evicted:
+            metrics.incr('understanding_cache.evicted.database', expired + evicted)
+
+
+TIERS = {
+    'memory': MemoryTier,
+    'database': DatabaseTier,
+}
+
+
+class ResultCache:
+    """Lookups through a chain of tiers, fastest first."""
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+    async def get(self, key):
+        """Return the cached text for ``key``, or None on a miss."""
+        for i, tier in enumerate(self.tiers):
+            try:
+                text = await tier.get(key)
+            except Exception as e:
+                print(f"Understanding cache {tier.name} lookup failed: {e}")
+                continue
+            if text is not None:
+                metrics.incr(f'understanding_cache.hits.{tier.name}')
+                metrics.incr('understanding_cache.bytes_served', len(text.encode('utf-8')))
+                for faster in self.tiers[:i]:
+                    await faster.set(key, text)
+                return text
+        metrics.incr('understanding_cache.misses')
+        return None
+
+    async def set(self, key, text, media_hash, request_type, model):
+        """Store ``text`` in every tier (empty answers are not cached)."""
+        if not text:
+            return
+        for tier in self.tiers:
+            try:
+                await tier.set(key, text, media_hash=media_hash, request_type=request_type, model=model)
+            except Exception as e:
+                print(f"Understanding cache {tier.name} store failed: {e}")
+        metrics.incr('understanding_cache.stored')
+        metrics.incr('understanding_cache.bytes_stored', len(text.encode('utf-8')))
+
+    def stats(self):
+        return {tier.name: tier.stats() for tier in self.tiers if hasattr(tier, 'stats')}
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        names = getattr(settings, 'UNDERSTANDING_CACHE_TIERS', ['memory', 'database'])
+        _cache = ResultCache([TIERS[name]() for name in names])
+    return _cache
+
+
+metrics.register_collector('understanding_cache', lambda: get_cache().stats())
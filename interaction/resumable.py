@@ -0,0 +1,201 @@
+"""
+Resumable streamed answers.
+
+Every streamed answer is registered here under its ``(user_id, request_id)``
+while it is generated. The :class:`ResponseStream` keeps a bounded ring buffer
+of the most recent ``ai_delta`` text, checkpoints the answer to a draft
+``Message`` row every ``CHAT_RESUME_CHECKPOINT_TOKENS`` tokens and forwards
+each frame to whichever socket is currently attached.
+
+When a socket drops mid-answer the generating task keeps running. The client
+reconnects and sends ``{"type": "resume", "request_id": ..., "offset": N}``,
+where N is the number of UTF-8 bytes it already has. It receives one
+``ai_resume`` frame with the missing tail, and then the live frames on the new
+socket. An offset that has already left the ring gets the whole answer so far
+with ``"reset": true``. Streams are kept for ``CHAT_RESUME_RETENTION`` seconds
+after they finish so a client that reconnects just too late still receives
+the end of its answer.
+
+Streams live in process memory. A client that reconnects to another server
+process gets ``resume_unavailable`` and finds the checkpointed draft after a
+reload.
+"""
+import asyncio
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .models import Message
+from .streaming import estimate_tokens
+
+FINAL_FRAME_TYPES = ('ai_done', 'error')
+
+_streams = {}
+
+
+def ring_bytes():
+    return getattr(settings, 'CHAT_RESUME_BUFFER_BYTES', 64 * 1024)
+
+
+def checkpoint_tokens():
+    return getattr(settings, 'CHAT_RESUME_CHECKPOINT_TOKENS', 200)
+
+
+def retention_seconds():
+    return getattr(settings, 'CHAT_RESUME_RETENTION', 60)
+
+
+def _save_draft(draft_id, conversation, content):
+    if draft_id is None:
+        return Message.objects.create(conversation=conversation, is_from_user=False, content=content, is_draft=True).id
+    Message.objects.filter(id=draft_id, is_draft=True).update(content=content)
+    return draft_id
+
+
+def _abandon_draft(draft_id, content):
+    # The exchange ended without saving its answer (error, crash): keep the partial text
+    Message.objects.filter(id=draft_id, is_draft=True).update(content=content, is_draft=False, is_truncated=True)
+
+
+class ResponseStream:
+    """
+    One in-flight streamed answer.
+
+    Args:
+        socket: The consumer currently receiving the frames (must provide ``deliver``)
+        streamer: The answer's ``DeltaStreamer``
+        conversation: Conversation the answer belongs to
+        request_id: Client request ID of the exchange
+    """
+
+    def __init__(self, socket, streamer, conversation, request_id):
+        self.socket = socket
+        self.streamer = streamer
+        self.conversation = conversation
+        self.request_id = request_id
+        self.task = asyncio.current_task()
+        self.offset = 0  # UTF-8 bytes sent so far
+        self.final_frames = []
+        self.finished = False
+        self.draft_id = None
+        self._ring = deque()
+        self._ring_bytes = 0
+        self._unsaved_tokens = 0
+        self._checkpoint_task = None
+        self._drafts_closed = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def sent_content(self):
+        """The part of the answer that has been sent to the client."""
+        if self.streamer.protocol < 2:
+            return self.streamer.content
+        return self.streamer.content.encode('utf-8')[:self.offset].decode('utf-8', errors='ignore')
+
+    async def send(self, payload):
+        """Record a frame and deliver it to the attached socket."""
+        async with self._lock:
+            self._record(payload)
+            await self.socket.deliver(payload)
+
+    def _record(self, payload):
+        frame_type = payload.get('type')
+        if frame_type == 'ai_delta':
+            data = payload['delta'].encode('utf-8')
+            self._ring.append(data)
+            self._ring_bytes += len(data)
+            self.offset += len(data)
+            while self._ring_bytes > ring_bytes() and len(self._ring) > 1:
+                self._ring_bytes -= len(self._ring.popleft())
+
+            self._unsaved_tokens += estimate_tokens(payload['delta'])
+            if self._unsaved_tokens >= checkpoint_tokens() and not self._drafts_closed:
+                if self._checkpoint_task is None or self._checkpoint_task.done():
+                    self._unsaved_tokens = 0
+                    self._checkpoint_task = asyncio.create_task(self._checkpoint())
+        elif frame_type == 'ai_message' and payload.get('done'):
+            # Protocol 1 end-of-answer frame
+            self.final_frames.append(payload)
+        elif frame_type in FINAL_FRAME_TYPES:
+            self.final_frames.append(payload)
+
+    async def _checkpoint(self):
+        try:
+            self.draft_id = await database_sync_to_async(_save_draft)(self.draft_id, self.conversation, self.sent_content)
+            metrics.incr('chat.resume_checkpoints')
+        except Exception as e:
+            print(f"Error checkpointing answer {self.request_id}: {e}")
+
+    async def take_draft(self):
+        """
+        Stop checkpointing and return the draft Message ID (or None), so the
+        final answer can be written into the draft row.
+        """
+        self._drafts_closed = True
+        if self._checkpoint_task is not None:
+            await asyncio.shield(self._checkpoint_task)
+        draft_id, self.draft_id = self.draft_id, None
+        return draft_id
+
+    async def resume(self, socket, offset):
+        """Attach ``socket``, send it what it missed after ``offset`` and keep it live."""
+        async with self._lock:
+            self.socket = socket
+            base = self.offset - self._ring_bytes
+            frame = {'type': 'ai_resume', 'request_id': self.request_id, 'seq': self.streamer.seq}
+            if self.streamer.protocol >= 2 and offset is not None and base <= offset <= self.offset:
+                tail = b''.join(self._ring)[offset - base:]
+                frame.update(offset=offset, delta=tail.decode('utf-8', errors='ignore'))
+                metrics.incr('chat.resumed')
+            else:
+                frame.update(offset=0, delta=self.sent_content, reset=True)
+                metrics.incr('chat.resumed_with_reset')
+            await socket.deliver(frame)
+            for final_frame in self.final_frames:
+                await socket.deliver(final_frame)
+
+    async def finish(self):
+        """Mark the exchange as ended; a draft that was never finalized keeps the partial answer."""
+        self.finished = True
+        draft_id = await self.take_draft()
+        if draft_id is not None:
+            try:
+                await database_sync_to_async(_abandon_draft)(draft_id, self.sent_content)
+            except Exception as e:
+                print(f"Error saving partial answer {self.request_id}: {e}")
+
+
+def open_stream(user_id, request_id, socket, streamer, conversation):
+    """Register the answer being streamed for ``request_id``. Returns the ResponseStream."""
+    stream = ResponseStream(socket, streamer, conversation, request_id)
+    _streams[(user_id, request_id)] = stream
+    return stream
+
+
+def get_stream(user_id, request_id):
+    return _streams.get((user_id, request_id))
+
+
+async def close_stream(user_id, request_id):
+    """Finish the stream of an ended exchange and forget it after the retention period."""
+    stream = _streams.get((user_id, request_id))
+    if stream is None:
+        return
+    await stream.finish()
+
+    def forget():
+        if _streams.get((user_id, request_id)) is stream:
+            del _streams[(user_id, request_id)]
+    asyncio.get_running_loop().call_later(retention_seconds(), forget)
+
+
+def _stats():
+    return {
+        'streams': len(_streams),
+        'live': sum(1 for stream in list(_streams.values()) if not stream.finished),
+    }
+
+
+metrics.register_collector('resumable_streams', _stats)
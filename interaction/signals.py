@@ -0,0 +1,46 @@
+"""
+Signal handlers of the interaction app.
+
+Chat sockets cache their conversation's ``AITool`` for the whole connection
+(see ``ChatConsumer.connect``). When a tool is saved or deleted, every socket
+using it is told through the ``tool_<id>`` channel layer group, once the
+change is committed.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from catalog.models import AITool
+
+
+def tool_group_name(tool_id):
+    return f'tool_{tool_id}'
+
+
+def _broadcast_tool_change(tool_id, deleted=False):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(
+            tool_group_name(tool_id), {'type': 'tool_updated', 'tool_id': tool_id, 'deleted': deleted}
+        )
+    except Exception as e:
+        print(f"Error broadcasting change of tool {tool_id}: {e}")
+
+
+@receiver(post_save, sender=AITool)
+def tool_saved(sender, instance, update_fields=None, **kwargs):
+    # Rating updates only touch popularity, which sockets do not use
+    if update_fields is not None and set(update_fields) <= {'popularity'}:
+        return
+    tool_id = instance.id
+    transaction.on_commit(lambda: _broadcast_tool_change(tool_id))
+
+
+@receiver(post_delete, sender=AITool)
+def tool_deleted(sender, instance, **kwargs):
+    tool_id = instance.id
+    transaction.on_commit(lambda: _broadcast_tool_change(tool_id, deleted=True))
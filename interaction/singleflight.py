@@ -0,0 +1,146 @@
+"""
+Single-flight coalescing of identical in-flight provider requests.
+
+When several sockets send the same prompt (and attachment) to the same tool at
+the same moment, for instance a class working through the same exercise, only
+the first request calls the provider. Its streamed chunks are recorded and
+fanned out to every identical request that arrives while it is still running;
+late joiners first receive the chunks they missed.
+
+Requests are keyed by tool, model, normalized prompt, attachment hash and
+generation parameters. Only tools sampling at a temperature of at most
+``SINGLEFLIGHT_MAX_TEMPERATURE`` are coalesced, where every caller would get
+an (almost) identical answer anyway. The upstream stream is stopped when the
+last waiter goes away. Finished results are not kept: this is not a cache.
+"""
+import asyncio
+import hashlib
+import json
+
+from django.conf import settings
+
+from . import metrics
+from .streaming import estimate_tokens
+
+_flights = {}
+
+
+def enabled():
+    return getattr(settings, 'SINGLEFLIGHT_ENABLED', True)
+
+
+def max_temperature():
+    return getattr(settings, 'SINGLEFLIGHT_MAX_TEMPERATURE', 0.2)
+
+
+def is_eligible(temperature):
+    """Whether answers sampled at ``temperature`` may be shared (None = provider default, not shared)."""
+    return enabled() and temperature is not None and temperature <= max_temperature()
+
+
+def normalize_prompt(prompt):
+    return ' '.join((prompt or '').split())
+
+
+def media_hash(media):
+    """Hash of an attachment sent with the prompt (an Attachment SHA-256 is used as is)."""
+    if not media:
+        return None
+    if len(media) == 64 and all(c in '0123456789abcdef' for c in media):
+        return media
+    return hashlib.sha256(media.encode('utf-8')).hexdigest()
+
+
+def make_key(tool, model, prompt, attachment_hash=None, **params):
+    """Key of a provider request; requests with equal keys are coalesced."""
+    material = json.dumps(
+        [tool.id, model, normalize_prompt(prompt), attachment_hash or '', params],
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.changed = asyncio.Condition()
+
+    async def run(self, factory):
+        try:
+            async for chunk in factory():
+                self.chunks.append(chunk)
+                async with self.changed:
+                    self.changed.notify_all()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+            async with self.changed:
+                self.changed.notify_all()
+
+
+async def stream(key, factory):
+    """
+    Iterate the chunks of ``factory()``, shared with identical in-flight calls.
+
+    Args:
+        key: Request key from :func:`make_key`
+        factory: Callable returning the async iterator of chunks (called only
+            by the first caller of a key)
+
+    Yields:
+        The chunks; errors of the shared call are raised in every waiter
+    """
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _flights[key] = _Flight(key)
+        flight.task = asyncio.create_task(flight.run(factory))
+        metrics.incr('singleflight.leaders')
+        leader = True
+    else:
+        metrics.incr('singleflight.hits')
+        leader = False
+
+    flight.subscribers += 1
+    index = 0
+    try:
+        while True:
+            if index < len(flight.chunks):
+                chunk = flight.chunks[index]
+                index += 1
+                if not leader and isinstance(chunk, str):
+                    metrics.incr('singleflight.tokens_saved', estimate_tokens(chunk))
+                yield chunk
+            elif flight.done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+            else:
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: flight.done or index < len(flight.chunks))
+    finally:
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done:
+            # Nobody is listening any more: stop generating upstream
+            flight.task.cancel()
+            if _flights.get(key) is flight:
+                del _flights[key]
+
+
+def _stats():
+    return {
+        'in_flight': len(_flights),
+        'subscribers': sum(flight.subscribers for flight in list(_flights.values())),
+    }
+
+
+metrics.register_collector('singleflight', _stats)
@@ -0,0 +1,158 @@
+"""
+Chat streaming protocol helpers.
+
+Protocol versions:
+
+* 1 (legacy): every ``ai_message`` frame carries the whole accumulated answer.
+* 2: ``ai_delta`` frames carry only the text appended since the previous frame,
+  numbered by ``seq``. The answer ends with an ``ai_done`` frame holding the
+  UTF-8 byte length and CRC32 checksum of the full text so the client can
+  verify what it assembled.
+
+When the user stops an answer (a ``cancel`` message), the final frame of either
+version carries ``"truncated": true``.
+
+Clients opt into version 2 by sending ``"protocol": 2`` with their message;
+anything else is served with version 1.
+"""
+import asyncio
+import zlib
+
+from django.conf import settings
+
+PROTOCOL_VERSION = 2
+
+
+def negotiate_protocol(value):
+    """Protocol version to use for a client asking for ``value``: 1 if it is missing or invalid."""
+    try:
+        requested = int(value)
+    except (TypeError, ValueError):
+        return 1
+    return max(1, min(requested, PROTOCOL_VERSION))
+
+
+def estimate_tokens(text):
+    """Rough token count of ``text`` (about four characters per token)."""
+    return (len(text) + 3) // 4
+
+
+def content_checksum(text):
+    """CRC32 (hex) of the UTF-8 encoded text, as verified by the browser client."""
+    return format(zlib.crc32(text.encode('utf-8')) & 0xffffffff, '08x')
+
+
+class DeltaStreamer:
+    """
+    Accumulates streamed model output and sends it to the client in coalesced frames.
+
+    Text pushed within ``window_ms`` milliseconds is merged into a single frame,
+    unless the pending text reaches ``window_bytes`` first.
+
+    Args:
+        send_event: Coroutine function taking the frame dict to send
+        protocol: Protocol version negotiated with the client (1 or 2)
+        window_ms: Coalescing time window in milliseconds
+        window_bytes: Pending size (UTF-8 bytes) that forces an immediate flush
+    """
+
+    def __init__(self, send_event, protocol=1, window_ms=None, window_bytes=None):
+        self.send_event = send_event
+        self.protocol = protocol
+        if window_ms is None:
+            window_ms = getattr(settings, 'CHAT_STREAM_COALESCE_MS', 30)
+        if window_bytes is None:
+            window_bytes = getattr(settings, 'CHAT_STREAM_COALESCE_BYTES', 1024)
+        self.window = window_ms / 1000
+        self.window_bytes = window_bytes
+        self.seq = 0
+        self._parts = []
+        self._pending = []
+        self._pending_bytes = 0
+        self._timer = None
+        self._flush_task = None  # Flush started by the timer
+        self._error = None  # Why a timer flush failed, raised to the producer
+        self._lock = asyncio.Lock()
+
+    @property
+    def content(self):
+        if len(self._parts) > 1:
+            self._parts = [''.join(self._parts)]
+        return self._parts[0] if self._parts else ''
+
+    async def push(self, text):
+        """Append generated text; it is sent once the coalescing window closes."""
+        if self._error is not None:
+            raise self._error
+        if not text:
+            return
+        self._parts.append(text)
+        self._pending.append(text)
+        self._pending_bytes += len(text.encode('utf-8'))
+
+        if self._pending_bytes >= self.window_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+
+    def _start_flush(self):
+        # Timer callback: keep a reference to the task so it is neither collected nor unobserved
+        self._flush_task = asyncio.ensure_future(self.flush())
+        self._flush_task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        if task is self._flush_task:
+            self._flush_task = None
+        if not task.cancelled() and task.exception() is not None:
+            self._error = task.exception()
+            print(f"Error sending streamed text: {self._error}")
+
+    async def flush(self):
+        """Send whatever text is pending as one frame."""
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            delta = ''.join(self._pending)
+            self._pending = []
+            self._pending_bytes = 0
+
+            if self.protocol >= 2:
+                self.seq += 1
+                await self.send_event({'type': 'ai_delta', 'seq': self.seq, 'delta': delta})
+            else:
+                await self.send_event({'type': 'ai_message', 'content': self.content, 'done': False})
+
+    async def finish(self, truncated=False):
+        """
+        Flush pending text and send the end-of-answer frame.
+
+        Args:
+            truncated: The answer was stopped before the model finished it
+        """
+        await self.flush()
+        if self._error is not None:
+            raise self._error
+        content = self.content
+        if self.protocol >= 2:
+            frame = {
+                'type': 'ai_done',
+                'seq': self.seq,
+                'length': len(content.encode('utf-8')),
+                'checksum': content_checksum(content),
+            }
+        else:
+            frame = {'type': 'ai_message', 'content': content, 'done': True}
+        if truncated:
+            frame['truncated'] = True
+        await self.send_event(frame)
+
+    def close(self):
+        """Drop any scheduled or running timer flush (e.g. when the stream failed)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
@@ -1,3 +1,939 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import zlib
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from catalog.models import AITool
+
+from . import (
+    admission, attachments, context, gemini_files, huggingface, image_variants, jobs, media_pool, result_cache,
+    resumable, singleflight, writebehind,
+)
+from .adapters import AdapterError
+from .models import (
+    Attachment, Conversation, GenerationJob, ImageVariant, Message, RemoteFile, UnderstandingResult,
+)
+from .streaming import DeltaStreamer, content_checksum, negotiate_protocol
+
+
+class FrameRecorder:
+    """Collects the frames a DeltaStreamer sends."""
+
+    def __init__(self):
+        self.frames = []
+
+    async def __call__(self, frame):
+        self.frames.append(frame)
+
+    def deltas(self):
+        return [frame for frame in self.frames if frame['type'] == 'ai_delta']
+
+
+class StreamingProtocolTests(SimpleTestCase):
+
+    def test_negotiate_protocol(self):
+        self.assertEqual(negotiate_protocol(2), 2)
+        self.assertEqual(negotiate_protocol('2'), 2)
+        self.assertEqual(negotiate_protocol(99), 2)
+        self.assertEqual(negotiate_protocol(0), 1)
+        self.assertEqual(negotiate_protocol(None), 1)
+        self.assertEqual(negotiate_protocol('latest'), 1)
+
+    def test_content_checksum_is_crc32_of_utf8(self):
+        text = 'Grüße, 世界 👋'
+        self.assertEqual(content_checksum(text), format(zlib.crc32(text.encode('utf-8')), '08x'))
+        self.assertEqual(content_checksum(''), '00000000')
+
+    async def test_deltas_round_trip_with_checksum(self):
+        recorder = FrameRecorder()
+        streamer = DeltaStreamer(recorder, protocol=2, window_ms=1000, window_bytes=8)
+        chunks = ['Hola ', 'señor, ', '世界', '! 👋', ' done']
+        for chunk in chunks:
+            await streamer.push(chunk)
+        await streamer.finish()
+
+        deltas = recorder.deltas()
+        done = recorder.frames[-1]
+        assembled = ''.join(frame['delta'] for frame in deltas)
+        self.assertEqual(assembled, ''.join(chunks))
+        self.assertEqual([frame['seq'] for frame in deltas], list(range(1, len(deltas) + 1)))
+        self.assertEqual(done['type'], 'ai_done')
+        self.assertEqual(done['seq'], deltas[-1]['seq'])
+        self.assertEqual(done['length'], len(assembled.encode('utf-8')))
+        self.assertEqual(done['checksum'], content_checksum(assembled))
+        self.assertNotIn('truncated', done)
+
+    async def test_flushes_when_pending_bytes_reach_window(self):
+        recorder = FrameRecorder()
+        streamer = DeltaStreamer(recorder, protocol=2, window_ms=1000, window_bytes=10)
+        await streamer.push('abc')
+        await streamer.push('defg')
+        self.assertEqual(recorder.frames, [])
+
+        await streamer.push('hij')  # 10 bytes pending
+        self.assertEqual(recorder.frames, [{'type': 'ai_delta', 'seq': 1, 'delta': 'abcdefghij'}])
+
+        await streamer.push('ü')  # Counted in UTF-8 bytes
+        await streamer.push('12345678')
+        self.assertEqual(recorder.deltas()[-1], {'type': 'ai_delta', 'seq': 2, 'delta': 'ü12345678'})
+
+        await streamer.push('k')
+        await streamer.finish(truncated=True)
+        self.assertEqual(recorder.deltas()[-1], {'type': 'ai_delta', 'seq': 3, 'delta': 'k'})
+        self.assertEqual(recorder.frames[-1]['seq'], 3)
+        self.assertTrue(recorder.frames[-1]['truncated'])
+
+    async def test_coalesces_pushes_within_time_window(self):
+        recorder = FrameRecorder()
+        streamer = DeltaStreamer(recorder, protocol=2, window_ms=20, window_bytes=1024)
+        await streamer.push('a')
+        await streamer.push('b')
+        await streamer.push('')
+        self.assertEqual(recorder.frames, [])
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(recorder.frames, [{'type': 'ai_delta', 'seq': 1, 'delta': 'ab'}])
+
+        await streamer.push('c')
+        streamer.close()
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(recorder.frames), 1)  # The scheduled flush was dropped
+
+    async def test_failed_timer_flush_is_raised_to_the_producer(self):
+        async def send_event(frame):
+            raise ConnectionError('socket closed')
+
+        streamer = DeltaStreamer(send_event, protocol=2, window_ms=10, window_bytes=1024)
+        await streamer.push('a')
+        with mock.patch('builtins.print') as log:
+            await asyncio.sleep(0.05)
+        log.assert_called_once()
+        self.assertIsNone(streamer._flush_task)
+        with self.assertRaises(ConnectionError):
+            await streamer.push('b')
+        with self.assertRaises(ConnectionError):
+            await streamer.finish()
+
+    async def test_close_cancels_a_running_timer_flush(self):
+        sending = asyncio.Event()
+
+        async def send_event(frame):
+            sending.set()
+            await asyncio.sleep(10)
+
+        streamer = DeltaStreamer(send_event, protocol=2, window_ms=1, window_bytes=1024)
+        await streamer.push('a')
+        await asyncio.wait_for(sending.wait(), timeout=1)
+        task = streamer._flush_task
+        streamer.close()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertTrue(task.cancelled())
+        self.assertIsNone(streamer._flush_task)
+
+    async def test_protocol_1_sends_accumulated_content(self):
+        recorder = FrameRecorder()
+        streamer = DeltaStreamer(recorder, protocol=1, window_ms=1000, window_bytes=4)
+        await streamer.push('abcd')
+        await streamer.push('ef')
+        await streamer.finish()
+        self.assertEqual(recorder.frames, [
+            {'type': 'ai_message', 'content': 'abcd', 'done': False},
+            {'type': 'ai_message', 'content': 'abcdef', 'done': False},
+            {'type': 'ai_message', 'content': 'abcdef', 'done': True},
+        ])
+
+
+class RecordingSocket:
+    """Stands in for the ChatConsumer a ResponseStream delivers to."""
+
+    def __init__(self):
+        self.frames = []
+
+    async def deliver(self, payload):
+        self.frames.append(payload)
+
+
+@override_settings(CHAT_RESUME_BUFFER_BYTES=8, CHAT_RESUME_CHECKPOINT_TOKENS=10 ** 6)
+class ResumableStreamTests(SimpleTestCase):
+
+    async def open_stream(self, chunks):
+        socket = RecordingSocket()
+        streamer = DeltaStreamer(None, protocol=2, window_ms=1000, window_bytes=1)
+        stream = resumable.ResponseStream(socket, streamer, conversation=None, request_id='r1')
+        streamer.send_event = stream.send
+        for chunk in chunks:
+            await streamer.push(chunk)
+        return stream
+
+    async def test_ring_keeps_the_most_recent_bytes(self):
+        stream = await self.open_stream(['0123', '4567', '89ab'])
+        self.assertEqual(stream.offset, 12)
+        self.assertEqual(list(stream._ring), [b'4567', b'89ab'])
+        self.assertEqual(stream._ring_bytes, 8)
+
+    async def test_resume_sends_tail_after_offset(self):
+        stream = await self.open_stream(['0123', '4567', '89ab'])
+        socket = RecordingSocket()
+        await stream.resume(socket, 6)
+
+        self.assertIs(stream.socket, socket)
+        self.assertEqual(socket.frames, [
+            {'type': 'ai_resume', 'request_id': 'r1', 'seq': 3, 'offset': 6, 'delta': '6789ab'},
+        ])
+
+    async def test_resume_at_ring_start_and_end(self):
+        stream = await self.open_stream(['0123', '4567', '89ab'])
+        socket = RecordingSocket()
+        await stream.resume(socket, 4)
+        await stream.resume(socket, 12)
+        self.assertEqual([(frame['offset'], frame['delta']) for frame in socket.frames], [(4, '456789ab'), (12, '')])
+
+    async def test_offset_truncated_from_ring_resets(self):
+        stream = await self.open_stream(['0123', '4567', '89ab'])
+        for offset in (3, 13, None):
+            socket = RecordingSocket()
+            await stream.resume(socket, offset)
+            self.assertEqual(socket.frames, [
+                {'type': 'ai_resume', 'request_id': 'r1', 'seq': 3, 'offset': 0, 'delta': '0123456789ab', 'reset': True},
+            ])
+
+    async def test_resume_replays_final_frame_and_follows_live_frames(self):
+        stream = await self.open_stream(['0123', '4567'])
+        socket = RecordingSocket()
+        await stream.resume(socket, 8)
+        await stream.streamer.push('89')
+        await stream.streamer.finish()
+        self.assertEqual([frame['type'] for frame in socket.frames], ['ai_resume', 'ai_delta', 'ai_done'])
+
+        late = RecordingSocket()
+        await stream.resume(late, 6)
+        self.assertEqual(late.frames[0]['delta'], '6789')
+        self.assertEqual(late.frames[1], socket.frames[-1])
+
+    async def test_ring_keeps_an_oversized_delta(self):
+        stream = await self.open_stream(['0123456789ab'])
+        socket = RecordingSocket()
+        await stream.resume(socket, 2)
+        self.assertEqual(socket.frames[0]['delta'], '23456789ab')
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def test_refills_at_rate_up_to_burst(self):
+        bucket = admission.TokenBucket(60, 2)  # One token per second
+        now = bucket.updated_at
+        self.assertEqual(bucket.wait_time(now), 0)
+        bucket.take()
+        bucket.take()
+        self.assertAlmostEqual(bucket.wait_time(now), 1.0)
+        self.assertAlmostEqual(bucket.wait_time(now + 0.25), 0.75)
+        self.assertEqual(bucket.wait_time(now + 1.0), 0)
+
+        self.assertEqual(bucket.wait_time(now + 100), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_zero_rate_never_refills(self):
+        bucket = admission.TokenBucket(0, 1)
+        now = bucket.updated_at
+        bucket.take()
+        self.assertEqual(bucket.wait_time(now + 3600), float('inf'))
+
+
+@override_settings(
+    ADMISSION_USER_CONCURRENCY=1,
+    ADMISSION_USER_MAX_QUEUED=2,
+    ADMISSION_USER_RATE=6000,
+    ADMISSION_USER_BURST=100,
+    ADMISSION_PROVIDER_RATE=6000,
+    ADMISSION_PROVIDER_BURST=100,
+)
+class AdmissionControllerTests(SimpleTestCase):
+
+    async def test_user_queue_overflow_is_rejected(self):
+        controller = admission.AdmissionController()
+        running = await controller.acquire(1, 'OPENAI')
+        positions = {}
+
+        async def report(name, position):
+            positions.setdefault(name, []).append(position)
+
+        waiters = [
+            asyncio.ensure_future(controller.acquire(1, 'OPENAI', on_queued=lambda p, n=n: report(n, p)))
+            for n in ('first', 'second')
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(controller.stats()['queued'][admission.LANE_INTERACTIVE], 2)
+        self.assertEqual(positions, {'first': [1], 'second': [2]})
+
+        with self.assertRaises(admission.AdmissionRejected):
+            await controller.acquire(1, 'OPENAI')
+        # Other users and the other lane have their own queues
+        other = await controller.acquire(2, 'OPENAI')
+        batch = await controller.acquire(1, 'OPENAI', lane=admission.LANE_BATCH)
+
+        controller.release(running)
+        first = await waiters[0]
+        await asyncio.sleep(0)
+        self.assertEqual(positions['second'], [2, 1])
+        self.assertFalse(waiters[1].done())
+
+        controller.release(first)
+        second = await waiters[1]
+        for ticket in (second, other, batch):
+            controller.release(ticket)
+        await asyncio.sleep(0)
+        self.assertEqual(controller.stats()['queued'][admission.LANE_INTERACTIVE], 0)
+        self.assertEqual(controller.stats()['running'], {'OPENAI': 0})
+
+    async def test_waits_for_token_refill(self):
+        controller = admission.AdmissionController()
+        controller._user_buckets[1] = admission.TokenBucket(1200, 1)  # One token per 50 ms
+        controller.release(await controller.acquire(1, 'OPENAI'))
+
+        started = asyncio.get_running_loop().time()
+        ticket = await asyncio.wait_for(controller.acquire(1, 'OPENAI'), timeout=1)
+        self.assertGreaterEqual(asyncio.get_running_loop().time() - started, 0.03)
+        controller.release(ticket)
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        controller = admission.AdmissionController()
+        running = await controller.acquire(1, 'OPENAI')
+        waiter = asyncio.ensure_future(controller.acquire(1, 'OPENAI'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        self.assertEqual(controller.stats()['queued'][admission.LANE_INTERACTIVE], 0)
+        controller.release(running)
+
+
+def create_conversation(username, api_type='NONE'):
+    user = get_user_model().objects.create_user(username, f'{username}@example.com', 'password')
+    tool = AITool.objects.create(name=f'Tool of {username}', description='Test tool', provider='Test',
+                                 website_url='https://example.com', category='TEXT', api_type=api_type)
+    return Conversation.objects.create(user=user, tool=tool)
+
+
+class WriteBehindBatchTests(TestCase):
+
+    def setUp(self):
+        self.conversation = create_conversation('writer')
+
+    def pending(self, content, **fields):
+        fields.setdefault('conversation', self.conversation)
+        return writebehind._PendingMessage(dict(content=content, is_from_user=False, **fields), (), None)
+
+    def saved_contents(self):
+        return list(Message.objects.filter(conversation=self.conversation).order_by('id').values_list('content', flat=True))
+
+    def test_batch_is_written_in_one_transaction(self):
+        messages = [self.pending('one'), self.pending('two')]
+        writebehind._write_batch(messages, {self.conversation.pk})
+
+        self.assertTrue(all(pending.message is not None for pending in messages))
+        self.assertEqual(self.saved_contents(), ['one', 'two'])
+
+    def test_failed_batch_falls_back_to_row_by_row(self):
+        before = Conversation.objects.get(pk=self.conversation.pk).updated_at
+        messages = [self.pending('one'), self.pending('broken', conversation=None), self.pending('three')]
+        writebehind._write_batch(messages, {self.conversation.pk})
+
+        self.assertIsNotNone(messages[0].message)
+        self.assertIsNone(messages[1].message)
+        self.assertIsNotNone(messages[2].message)
+        # The rows of the failed batch transaction were rolled back and written once
+        self.assertEqual(self.saved_contents(), ['one', 'three'])
+        self.assertGreater(Conversation.objects.get(pk=self.conversation.pk).updated_at, before)
+
+
+class GeminiFileSweeperTests(TestCase):
+
+    def remote_file(self, data, expires_in, api_key='test-key'):
+        now = timezone.now()
+        return RemoteFile.objects.create(
+            account=gemini_files.account_id(api_key), sha256=hashlib.sha256(data).hexdigest(),
+            name=f"files/{data.decode()}", uri=f"https://example.com/files/{data.decode()}",
+            mime_type='application/pdf', size=len(data), last_used_at=now, expires_at=now + expires_in,
+        )
+
+    async def test_first_file_request_starts_sweeper_without_lifespan(self):
+        await database_sync_to_async(self.remote_file)(b'live', timedelta(hours=24))
+        expired = await database_sync_to_async(self.remote_file)(b'expired', timedelta(seconds=-1))
+        with mock.patch.dict(os.environ, {'GEMINI_API_KEY': ''}):
+            try:
+                # Reused upload: no provider call, but the sweeper now runs
+                part = await gemini_files.get_file_part(None, 'test-key', b'live', 'application/pdf')
+                self.assertEqual(part.file_data.file_uri, 'https://example.com/files/live')
+                for _ in range(100):
+                    if not await RemoteFile.objects.filter(pk=expired.pk).aexists():
+                        break
+                    await asyncio.sleep(0.01)
+            finally:
+                await gemini_files.get_sweeper().stop()
+
+        self.assertFalse(await RemoteFile.objects.filter(pk=expired.pk).aexists())
+        self.assertTrue(await RemoteFile.objects.filter(sha256=hashlib.sha256(b'live').hexdigest()).aexists())
+
+
+class TemporaryStorageMixin:
+    """Stores attachment files in a temporary directory for the duration of a test."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        patcher = mock.patch.object(Attachment._meta.get_field('file'), 'storage', FileSystemStorage(location=directory))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class AttachmentAccessTests(TemporaryStorageMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        User = get_user_model()
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.other = User.objects.create_user('other', 'other@example.com', 'password')
+        self.attachment = attachments.store_bytes(b'private bytes', 'text/plain', uploader=self.owner)
+
+    def test_url_is_served_by_the_app(self):
+        self.assertEqual(self.attachment.url, reverse('interaction:attachment', kwargs={'sha256': self.attachment.sha256}))
+
+    def test_uploader_can_fetch_attachment(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(self.attachment.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'private bytes')
+
+    def test_other_user_cannot_fetch_attachment(self):
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(self.attachment.url).status_code, 404)
+        self.assertFalse(attachments.user_attachments(self.other).filter(pk=self.attachment.pk).exists())
+
+    def test_anonymous_user_is_sent_to_login(self):
+        self.assertEqual(self.client.get(self.attachment.url).status_code, 302)
+
+    def test_storing_same_bytes_adds_uploader(self):
+        again = attachments.store_bytes(b'private bytes', 'text/plain', uploader=self.other)
+        self.assertEqual(again.pk, self.attachment.pk)
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(self.attachment.url).status_code, 200)
+
+
+class GenerationJobLeaseTests(TestCase):
+
+    def setUp(self):
+        self.conversation = create_conversation('jobs', api_type='GOOGLE')
+        self.job = jobs.create_job(self.conversation, GenerationJob.KIND_IMAGEN, 'A lighthouse')
+
+    def expire_lease(self):
+        GenerationJob.objects.filter(pk=self.job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_leased_job_is_not_claimed_twice(self):
+        [claimed] = jobs._claim_jobs('worker-a', 5)
+        self.assertEqual(claimed.state, GenerationJob.STATE_RUNNING)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertGreater(claimed.lease_expires_at, timezone.now())
+        self.assertEqual(jobs._claim_jobs('worker-b', 5), [])
+
+    def test_expired_lease_is_claimed_by_another_worker(self):
+        [stale] = jobs._claim_jobs('worker-a', 5)
+        self.expire_lease()
+        [claimed] = jobs._claim_jobs('worker-b', 5)
+        self.assertEqual(claimed.worker, 'worker-b')
+        self.assertEqual(claimed.attempts, 2)
+
+        # The first worker finishes late: its result is discarded
+        self.assertIsNone(jobs._save_result(stale, 'Late result', []))
+        self.assertFalse(jobs._save_failure(stale, 'Late error'))
+        self.assertFalse(Message.objects.filter(conversation=self.conversation).exists())
+        self.assertIsNotNone(jobs._save_result(claimed, 'Result', []))
+        self.assertEqual(GenerationJob.objects.get(pk=self.job.pk).state, GenerationJob.STATE_SUCCEEDED)
+
+    def test_renewing_requires_the_lease(self):
+        jobs._claim_jobs('worker-a', 5)
+        self.assertEqual(jobs._renew_lease(self.job.pk, 'worker-b'), 0)
+        self.assertEqual(jobs._renew_lease(self.job.pk, 'worker-a'), 1)
+
+    def test_retry_is_claimable_after_backoff(self):
+        [claimed] = jobs._claim_jobs('worker-a', 5)
+        self.assertTrue(jobs._save_retry(claimed, 'Rate limited', 30))
+
+        job = GenerationJob.objects.get(pk=self.job.pk)
+        self.assertEqual(job.state, GenerationJob.STATE_PENDING)
+        self.assertEqual(job.error, 'Rate limited')
+        self.assertGreater(job.lease_expires_at, timezone.now() + timedelta(seconds=25))
+        self.assertEqual(jobs._claim_jobs('worker-a', 5), [])
+        self.expire_lease()
+        self.assertEqual(len(jobs._claim_jobs('worker-a', 5)), 1)
+
+    def test_release_does_not_count_the_interrupted_attempt(self):
+        jobs._claim_jobs('worker-a', 5)
+        jobs._release_jobs('worker-a')
+        job = GenerationJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.state, job.attempts, job.lease_expires_at), (GenerationJob.STATE_PENDING, 0, None))
+
+
+class GenerationJobRetryTests(TestCase):
+
+    def setUp(self):
+        self.conversation = create_conversation('retries', api_type='GOOGLE')
+        self.job = jobs.create_job(self.conversation, GenerationJob.KIND_IMAGEN, 'A lighthouse')
+
+    async def run_failing_job(self, error):
+        [claimed] = await database_sync_to_async(jobs._claim_jobs)('worker-a', 5)
+        runner = mock.AsyncMock(side_effect=error)
+        with mock.patch.dict(jobs.RUNNERS, {GenerationJob.KIND_IMAGEN: runner}), \
+                mock.patch.object(jobs, 'notify', mock.AsyncMock()):
+            await jobs.JobWorker()._execute(claimed)
+        return await GenerationJob.objects.aget(pk=self.job.pk)
+
+    async def test_transient_error_is_retried_later(self):
+        job = await self.run_failing_job(jobs.JobError('Image generation error: 429 RESOURCE_EXHAUSTED', retriable=True))
+        self.assertEqual(job.state, GenerationJob.STATE_PENDING)
+        self.assertGreater(job.lease_expires_at, timezone.now())
+        self.assertFalse(await Message.objects.filter(conversation=self.conversation).aexists())
+
+    async def test_unexpected_exception_is_retried(self):
+        job = await self.run_failing_job(TimeoutError('read timed out'))
+        self.assertEqual(job.state, GenerationJob.STATE_PENDING)
+
+    async def test_permanent_error_fails_the_job(self):
+        job = await self.run_failing_job(jobs.JobError('Image generation error: prompt rejected'))
+        self.assertEqual(job.state, GenerationJob.STATE_FAILED)
+        self.assertEqual(job.error, 'Image generation error: prompt rejected')
+        self.assertTrue(await Message.objects.filter(conversation=self.conversation, content=job.error).aexists())
+
+    @override_settings(GENERATION_JOB_MAX_ATTEMPTS=1)
+    async def test_last_attempt_fails_the_job(self):
+        job = await self.run_failing_job(jobs.JobError('Image generation error: 503 UNAVAILABLE', retriable=True))
+        self.assertEqual(job.state, GenerationJob.STATE_FAILED)
+
+    def test_transient_errors(self):
+        class APIError(Exception):
+            def __init__(self, code):
+                self.code = code
+
+        self.assertTrue(jobs.is_transient(APIError(429)))
+        self.assertTrue(jobs.is_transient(APIError(503)))
+        self.assertTrue(jobs.is_transient(TimeoutError()))
+        self.assertFalse(jobs.is_transient(APIError(400)))
+        self.assertFalse(jobs.is_transient(ValueError('Invalid image data format')))
+
+
+@override_settings(CHAT_HISTORY_BUDGET=25, CHAT_HISTORY_BUDGETS={}, CHAT_HISTORY_MAX_MESSAGES=20)
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        self.conversation = create_conversation('history', api_type='OPENAI')
+        # 40 characters: 10 estimated tokens each
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, is_from_user=i % 2 == 0, content=f"{i:02d}" + 'x' * 38)
+            for i in range(6)
+        ]
+        patcher = mock.patch.object(context, '_encoding', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_keeps_newest_turns_within_budget(self):
+        with mock.patch.object(context, 'schedule_summary') as schedule_summary:
+            history = await context.build_history(self.conversation, 'test-model', api_type='OPENAI')
+
+        self.assertEqual([text[:2] for role, text in history.turns], ['04', '05'])
+        self.assertEqual([role for role, text in history.turns], ['user', 'assistant'])
+        self.assertEqual(history.tokens, 20)
+        # The turns that no longer fit are folded into the summary, up to the oldest kept one
+        schedule_summary.assert_called_once_with(self.conversation.pk, 'OPENAI', self.messages[4].id)
+
+    async def test_only_messages_before_the_answered_one(self):
+        with mock.patch.object(context, 'schedule_summary'):
+            history = await context.build_history(self.conversation, 'test-model', before_id=self.messages[3].id)
+        self.assertEqual([text[:2] for role, text in history.turns], ['01', '02'])
+
+    async def test_summary_is_extended_with_new_messages_only(self):
+        summarize = mock.AsyncMock(return_value='First summary')
+        with mock.patch.object(context, 'summarize', summarize):
+            await context.update_summary(self.conversation.pk, 'OPENAI', self.messages[2].id)
+        api_type, previous, transcript = summarize.call_args.args
+        self.assertEqual(previous, '')
+        self.assertEqual([line.split('x')[0] for line in transcript.splitlines()], ['User: 00', 'Assistant: 01'])
+        conversation = await Conversation.objects.aget(pk=self.conversation.pk)
+        self.assertEqual((conversation.summary, conversation.summary_until), ('First summary', self.messages[1].id))
+
+        summarize = mock.AsyncMock(return_value='Second summary')
+        with mock.patch.object(context, 'summarize', summarize):
+            await context.update_summary(self.conversation.pk, 'OPENAI', self.messages[4].id)
+        api_type, previous, transcript = summarize.call_args.args
+        self.assertEqual(previous, 'First summary')
+        self.assertEqual([line.split('x')[0] for line in transcript.splitlines()], ['User: 02', 'Assistant: 03'])
+        conversation = await Conversation.objects.aget(pk=self.conversation.pk)
+        self.assertEqual((conversation.summary, conversation.summary_until), ('Second summary', self.messages[3].id))
+
+    async def test_history_starts_after_the_summary(self):
+        await Conversation.objects.filter(pk=self.conversation.pk).aupdate(
+            summary='x' * 20, summary_until=self.messages[3].id  # 5 estimated tokens
+        )
+        with mock.patch.object(context, 'schedule_summary') as schedule_summary:
+            history = await context.build_history(self.conversation, 'test-model', api_type='OPENAI')
+
+        self.assertEqual(history.summary, 'x' * 20)
+        self.assertEqual([text[:2] for role, text in history.turns], ['04', '05'])
+        self.assertEqual(history.tokens, 25)
+        self.assertEqual(history.openai_messages()[0]['role'], 'system')
+        schedule_summary.assert_not_called()
+
+    async def test_concurrent_summary_update_is_not_overwritten(self):
+        async def summarize(api_type, previous, transcript):
+            # Another update lands while this one waits for the provider
+            await Conversation.objects.filter(pk=self.conversation.pk).aupdate(summary='Other', summary_until=self.messages[0].id)
+            return 'Stale summary'
+
+        with mock.patch.object(context, 'summarize', summarize):
+            await context.update_summary(self.conversation.pk, 'OPENAI', self.messages[2].id)
+        conversation = await Conversation.objects.aget(pk=self.conversation.pk)
+        self.assertEqual(conversation.summary, 'Other')
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    def factory(self, fail=False):
+        async def generate():
+            self.calls += 1
+            yield 'Hello '
+            await self.release.wait()
+            if fail:
+                raise ConnectionError('provider failed')
+            yield 'world'
+        return generate
+
+    async def collect(self, key, factory):
+        return [chunk async for chunk in singleflight.stream(key, factory)]
+
+    async def test_identical_requests_share_one_call(self):
+        key = singleflight.make_key(mock.Mock(id=1), 'model', 'Same  prompt', temperature=0)
+        self.assertEqual(key, singleflight.make_key(mock.Mock(id=1), 'model', ' Same prompt ', temperature=0))
+        leader = asyncio.ensure_future(self.collect(key, self.factory()))
+        await asyncio.sleep(0.01)
+        # Joins after the first chunk and still receives it
+        follower = asyncio.ensure_future(self.collect(key, self.factory()))
+        await asyncio.sleep(0.01)
+        self.release.set()
+
+        self.assertEqual(await leader, ['Hello ', 'world'])
+        self.assertEqual(await follower, ['Hello ', 'world'])
+        self.assertEqual(self.calls, 1)
+        self.assertNotIn(key, singleflight._flights)
+
+    async def test_leader_failure_is_raised_in_every_waiter(self):
+        key = singleflight.make_key(mock.Mock(id=1), 'model', 'Failing prompt')
+        waiters = [asyncio.ensure_future(self.collect(key, self.factory(fail=True))) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        self.release.set()
+
+        for result in await asyncio.gather(*waiters, return_exceptions=True):
+            self.assertIsInstance(result, ConnectionError)
+        self.assertEqual(self.calls, 1)
+        self.assertNotIn(key, singleflight._flights)
+
+        # The failed flight is not reused: the next request calls the provider again
+        self.assertEqual(await self.collect(key, self.factory()), ['Hello ', 'world'])
+        self.assertEqual(self.calls, 2)
+
+    async def test_last_waiter_leaving_stops_the_call(self):
+        key = singleflight.make_key(mock.Mock(id=1), 'model', 'Abandoned prompt')
+        waiter = asyncio.ensure_future(self.collect(key, self.factory()))
+        await asyncio.sleep(0.01)
+        flight = singleflight._flights[key]
+        waiter.cancel()
+        await asyncio.gather(waiter, flight.task, return_exceptions=True)
+
+        self.assertTrue(flight.done)
+        self.assertIsInstance(flight.error, asyncio.CancelledError)
+        self.assertNotIn(key, singleflight._flights)
+
+    def test_only_low_temperature_requests_are_eligible(self):
+        self.assertTrue(singleflight.is_eligible(0))
+        self.assertFalse(singleflight.is_eligible(None))
+        self.assertFalse(singleflight.is_eligible(singleflight.max_temperature() + 0.1))
+
+
+@override_settings(UNDERSTANDING_CACHE_MEMORY_BYTES=10, UNDERSTANDING_CACHE_DATABASE_BYTES=10)
+class ResultCacheTests(TestCase):
+
+    async def test_memory_tier_evicts_least_recently_used(self):
+        tier = result_cache.MemoryTier()
+        await tier.set('a', 'aaaa')
+        await tier.set('b', 'bbbb')
+        self.assertEqual(await tier.get('a'), 'aaaa')  # 'b' is now the least recently used
+        await tier.set('c', 'cccc')
+
+        self.assertIsNone(await tier.get('b'))
+        self.assertEqual(await tier.get('a'), 'aaaa')
+        self.assertEqual(await tier.get('c'), 'cccc')
+        self.assertEqual(tier.stats(), {'entries': 2, 'bytes': 8})
+
+        # Larger than the whole tier: not stored, nothing evicted
+        await tier.set('d', 'd' * 11)
+        self.assertIsNone(await tier.get('d'))
+        self.assertEqual(tier.stats(), {'entries': 2, 'bytes': 8})
+
+    async def test_database_tier_evicts_least_recently_used(self):
+        tier = result_cache.DatabaseTier()
+        await tier.set('a', 'aaaa', media_hash='h', request_type='image', model='m')
+        await tier.set('b', 'bbbb', media_hash='h', request_type='image', model='m')
+        self.assertEqual(await tier.get('a'), 'aaaa')
+        await tier.set('c', 'cccc', media_hash='h', request_type='image', model='m')
+
+        keys = [key async for key in UnderstandingResult.objects.order_by('key').values_list('key', flat=True)]
+        self.assertEqual(keys, ['a', 'c'])
+
+    async def test_database_tier_ignores_expired_results(self):
+        tier = result_cache.DatabaseTier()
+        await tier.set('a', 'aaaa', media_hash='h', request_type='image', model='m')
+        await UnderstandingResult.objects.filter(key='a').aupdate(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(await tier.get('a'))
+
+    async def test_database_hit_is_copied_into_memory(self):
+        memory, database = result_cache.MemoryTier(), result_cache.DatabaseTier()
+        cache = result_cache.ResultCache([memory, database])
+        await database.set('key', 'answer', media_hash='h', request_type='image', model='m')
+        self.assertIsNone(await memory.get('key'))
+
+        self.assertEqual(await cache.get('key'), 'answer')
+        self.assertEqual(await memory.get('key'), 'answer')
+
+        # Served from memory now, even once the row is gone
+        await UnderstandingResult.objects.all().adelete()
+        self.assertEqual(await cache.get('key'), 'answer')
+
+    async def test_failing_tier_falls_back_to_the_next_one(self):
+        memory, database = result_cache.MemoryTier(), result_cache.DatabaseTier()
+        cache = result_cache.ResultCache([memory, database])
+        await cache.set('key', 'answer', 'h', 'image', 'm')
+
+        with mock.patch.object(memory, 'get', side_effect=RuntimeError('broken')), \
+                mock.patch('builtins.print'):
+            self.assertEqual(await cache.get('key'), 'answer')
+        self.assertIsNone(await cache.get('missing'))
+
+    async def test_empty_answers_are_not_cached(self):
+        cache = result_cache.ResultCache([result_cache.MemoryTier(), result_cache.DatabaseTier()])
+        await cache.set('key', '', 'h', 'image', 'm')
+        self.assertIsNone(await cache.get('key'))
+        self.assertFalse(await UnderstandingResult.objects.aexists())
+
+
+class FakeBatchClient:
+    """Pipeline endpoint answering every input in upper case."""
+
+    def __init__(self, fail=False):
+        self.payloads = []
+        self.fail = fail
+
+    async def post(self, url, headers, json):
+        self.payloads.append(json)
+        if self.fail:
+            raise ConnectionError('endpoint down')
+        inputs = json['inputs']
+        if isinstance(inputs, str):
+            results = [{'generated_text': inputs.upper()}]
+        else:
+            results = [[{'generated_text': prompt.upper()}] for prompt in inputs]
+        return mock.Mock(raise_for_status=mock.Mock(), json=mock.Mock(return_value=results))
+
+
+@override_settings(HF_BATCH_MAX_SIZE=3, HF_BATCH_WINDOW_MS=20)
+class PromptBatcherTests(SimpleTestCase):
+
+    async def submit_all(self, client, prompts):
+        batcher = huggingface.PromptBatcher('https://hf.example.com/model', 'key')
+        with mock.patch.object(huggingface, 'get_http_client', return_value=client):
+            return await asyncio.gather(*(batcher.submit(prompt) for prompt in prompts), return_exceptions=True)
+
+    async def test_full_batches_are_sent_at_once_and_the_rest_after_the_window(self):
+        client = FakeBatchClient()
+        prompts = ['a', 'b', 'c', 'd', 'e']
+        self.assertEqual(await self.submit_all(client, prompts), ['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual([payload['inputs'] for payload in client.payloads], [['a', 'b', 'c'], ['d', 'e']])
+
+    async def test_single_prompt_is_sent_as_plain_input(self):
+        client = FakeBatchClient()
+        self.assertEqual(await self.submit_all(client, ['alone']), ['ALONE'])
+        self.assertEqual(client.payloads[0]['inputs'], 'alone')
+
+    async def test_prompts_after_the_window_go_in_a_new_batch(self):
+        client = FakeBatchClient()
+        batcher = huggingface.PromptBatcher('https://hf.example.com/model', 'key')
+        with mock.patch.object(huggingface, 'get_http_client', return_value=client):
+            first = asyncio.ensure_future(batcher.submit('a'))
+            await asyncio.sleep(0.05)
+            second = await batcher.submit('b')
+        self.assertEqual((await first, second), ('A', 'B'))
+        self.assertEqual([payload['inputs'] for payload in client.payloads], ['a', 'b'])
+
+    async def test_failed_batch_fails_every_caller(self):
+        results = await self.submit_all(FakeBatchClient(fail=True), ['a', 'b'])
+        self.assertEqual([type(result) for result in results], [ConnectionError, ConnectionError])
+
+    async def test_mismatched_batch_response_is_an_error(self):
+        client = FakeBatchClient()
+        client.post = mock.AsyncMock(return_value=mock.Mock(json=mock.Mock(return_value=[{'generated_text': 'A'}])))
+        results = await self.submit_all(client, ['a', 'b'])
+        self.assertEqual([type(result) for result in results], [AdapterError, AdapterError])
+
+
+def noise_image(width, height, image_format='PNG', mode='RGB'):
+    """Image bytes that do not compress, so any downscaled copy is smaller."""
+    image = Image.frombytes(mode, (width, height), os.urandom(width * height * len(mode)))
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue()
+
+
+class ImageVariantTests(TemporaryStorageMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write(self, data):
+        path = os.path.join(self.directory, 'source')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_variants_are_smaller_webp_within_the_profile(self):
+        path = self.write(noise_image(2400, 1600))
+        for provider, expected_size in (('openai', (1152, 768)), ('gemini', (1536, 1024))):
+            with self.subTest(provider=provider):
+                result = media_pool.resize_file(path, **image_variants.DEFAULT_PROFILES[provider])
+                self.assertEqual(result['mime_type'], 'image/webp')
+                self.assertEqual((result['width'], result['height']), expected_size)
+                self.assertLess(result['size'], os.path.getsize(path))
+                self.assertEqual(result['size'], os.path.getsize(result['path']))
+                with Image.open(result['path']) as variant:
+                    self.assertEqual((variant.format, variant.size), ('WEBP', expected_size))
+                os.remove(result['path'])
+
+    def test_jpeg_variant_drops_alpha(self):
+        path = self.write(noise_image(1200, 800, mode='RGBA'))
+        result = media_pool.resize_file(path, max_side=600, image_format='JPEG')
+        with Image.open(result['path']) as variant:
+            self.assertEqual((variant.format, variant.mode, variant.size), ('JPEG', 'RGB', (600, 400)))
+        self.assertEqual(result['mime_type'], 'image/jpeg')
+
+    async def test_prepared_variant_is_stored_and_reused(self):
+        processor = media_pool.MediaProcessor(max_workers=1, max_queue=4)
+        self.addCleanup(processor.shutdown, wait=True)
+        source = noise_image(1200, 800)
+        data_url = f"data:image/png;base64,{base64.b64encode(source).decode('ascii')}"
+
+        with mock.patch.object(media_pool, 'get_media_processor', return_value=processor):
+            prepared = await image_variants.prepare(data_url, 'openai')
+            with mock.patch.object(processor, 'resize_image') as resize_image:
+                reused = await image_variants.prepare(data_url, 'openai')
+
+        self.assertEqual(prepared.mime_type, 'image/webp')
+        self.assertEqual(prepared.source_size, len(source))
+        self.assertLess(len(prepared.data), len(source))
+        self.assertEqual(prepared.sha256, hashlib.sha256(source).hexdigest())
+        variant = await ImageVariant.objects.select_related('attachment').aget(source_sha256=prepared.sha256)
+        self.assertEqual((variant.mime_type, variant.width, variant.height), ('image/webp', 1152, 768))
+        self.assertEqual(variant.size, len(prepared.data))
+
+        resize_image.assert_not_called()
+        self.assertEqual((reused.data, reused.mime_type), (prepared.data, 'image/webp'))
+
+
+@override_settings(CHAT_UPLOAD_CHUNK_SIZE=4)
+class ChunkedUploadTests(TemporaryStorageMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        upload_settings = self.settings(CHAT_UPLOAD_DIR=directory)
+        upload_settings.enable()
+        self.addCleanup(upload_settings.disable)
+        User = get_user_model()
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.other = User.objects.create_user('other', 'other@example.com', 'password')
+
+    def start(self, user, data, mime_type='application/pdf'):
+        self.client.force_login(user)
+        response = self.client.post(reverse('interaction:upload_start'),
+                                    {'name': 'doc.pdf', 'mime_type': mime_type, 'size': len(data)},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['chunk_size'], 4)
+        return response.json()['upload_id']
+
+    def put(self, upload_id, offset, chunk):
+        url = reverse('interaction:upload_chunk', kwargs={'upload_id': upload_id})
+        return self.client.put(f'{url}?offset={offset}', chunk, content_type='application/octet-stream')
+
+    def complete(self, upload_id):
+        return self.client.post(reverse('interaction:upload_complete', kwargs={'upload_id': upload_id}))
+
+    def test_chunks_are_assembled_into_an_attachment(self):
+        data = b'%PDF-1.4 chunks'
+        upload_id = self.start(self.owner, data)
+        for offset in range(0, len(data), 4):
+            response = self.put(upload_id, offset, data[offset:offset + 4])
+            self.assertEqual(response.json(), {'offset': min(offset + 4, len(data))})
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        attachment = Attachment.objects.get(sha256=response.json()['attachment_id'])
+        self.assertEqual(attachment.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual((attachments.read_bytes(attachment), attachment.mime_type), (data, 'application/pdf'))
+        self.assertTrue(attachments.user_attachments(self.owner).filter(pk=attachment.pk).exists())
+        self.assertFalse(attachments.user_attachments(self.other).filter(pk=attachment.pk).exists())
+        # The upload is gone once completed
+        self.assertEqual(self.complete(upload_id).status_code, 400)
+
+    def test_out_of_order_oversized_and_incomplete_uploads_are_rejected(self):
+        upload_id = self.start(self.owner, b'12345678')
+        self.assertEqual(self.put(upload_id, 4, b'5678').status_code, 400)
+        self.assertEqual(self.put(upload_id, 0, b'12345').status_code, 400)
+        self.assertEqual(self.put(upload_id, 0, b'1234').json(), {'offset': 4})
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('received 4 of 8', response.json()['error'])
+
+    def test_other_user_cannot_use_an_upload(self):
+        upload_id = self.start(self.owner, b'12345678')
+        self.client.force_login(self.other)
+        self.assertEqual(self.put(upload_id, 0, b'1234').json(), {'error': 'Upload not found.'})
+
+        self.client.force_login(self.owner)
+        self.assertEqual(self.put(upload_id, 0, b'1234').json(), {'offset': 4})
+        self.assertEqual(self.put(upload_id, 4, b'5678').json(), {'offset': 8})
+        self.client.force_login(self.other)
+        self.assertEqual(self.complete(upload_id).json(), {'error': 'Upload not found.'})
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_unsupported_types_are_rejected(self):
+        self.client.force_login(self.owner)
+        response = self.client.post(reverse('interaction:upload_start'),
+                                    {'name': 'run.sh', 'mime_type': 'text/x-shellscript', 'size': 10},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
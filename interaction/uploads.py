@@ -0,0 +1,162 @@
+"""
+Chunked media uploads for the chat.
+
+Instead of embedding a base64 data URL in the chat WebSocket frame, the browser
+uploads the raw file in bounded chunks over HTTP and then references the
+resulting attachment ID in its chat message:
+
+1. ``POST uploads/`` with ``{"name", "mime_type", "size"}`` -> ``upload_id`` and ``chunk_size``
+2. ``PUT uploads/<upload_id>/?offset=N`` with up to ``chunk_size`` raw bytes, in order
+3. ``POST uploads/<upload_id>/complete/`` -> ``attachment_id`` (the SHA-256 of an ``Attachment``)
+
+Chunks are appended to a file on disk as they arrive, so server memory per
+upload is bounded by the chunk size rather than by the file size.
+"""
+import json
+import os
+import time
+import uuid
+
+from django.conf import settings
+
+from . import attachments
+
+ALLOWED_MIME_PREFIXES = ('image/', 'video/', 'audio/', 'application/pdf')
+COPY_BUFFER_SIZE = 64 * 1024
+STALE_UPLOAD_SECONDS = 24 * 60 * 60
+
+
+class UploadError(Exception):
+    """Raised for invalid upload requests; the message is safe to show to the user."""
+
+
+def upload_dir():
+    path = getattr(settings, 'CHAT_UPLOAD_DIR', os.path.join(settings.BASE_DIR, 'media', 'uploads'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def chunk_size():
+    return getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+
+
+def max_upload_size():
+    return getattr(settings, 'CHAT_UPLOAD_MAX_SIZE', 200 * 1024 * 1024)
+
+
+def _paths(upload_id):
+    base = os.path.join(upload_dir(), str(uuid.UUID(str(upload_id))))
+    return base + '.json', base + '.part'
+
+
+def _read_meta(upload_id, user_id):
+    meta_path = _paths(upload_id)[0]
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise UploadError("Upload not found.")
+    if meta['user_id'] != user_id:
+        raise UploadError("Upload not found.")
+    return meta
+
+
+def _write_meta(upload_id, meta):
+    meta_path = _paths(upload_id)[0]
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def _sweep_stale_uploads():
+    """Remove unfinished uploads older than a day."""
+    cutoff = time.time() - STALE_UPLOAD_SECONDS
+    directory = upload_dir()
+    for name in os.listdir(directory):
+        if not name.endswith('.part'):
+            continue
+        part_path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(part_path) < cutoff:
+                os.remove(part_path)
+                os.remove(part_path[:-len('.part')] + '.json')
+        except OSError:
+            pass
+
+
+def start_upload(user_id, name, mime_type, size):
+    """
+    Register a new upload.
+
+    Returns:
+        The new upload ID (a UUID string)
+    """
+    if not mime_type or not mime_type.startswith(ALLOWED_MIME_PREFIXES):
+        raise UploadError("Unsupported file type.")
+    if size is None or size <= 0:
+        raise UploadError("Invalid file size.")
+    if size > max_upload_size():
+        raise UploadError(f"File is too large (max {max_upload_size() // (1024 * 1024)}MB).")
+
+    _sweep_stale_uploads()
+    upload_id = str(uuid.uuid4())
+    _write_meta(upload_id, {
+        'user_id': user_id,
+        'name': name or '',
+        'mime_type': mime_type,
+        'size': size,
+        'received': 0,
+    })
+    open(_paths(upload_id)[1], 'wb').close()
+    return upload_id
+
+
+def append_chunk(upload_id, user_id, offset, stream, length):
+    """
+    Append one chunk read from ``stream`` (e.g. the request) to the upload.
+
+    Chunks must arrive in order: ``offset`` has to match the bytes received so far.
+
+    Returns:
+        Total number of bytes received
+    """
+    meta = _read_meta(upload_id, user_id)
+    if offset != meta['received']:
+        raise UploadError(f"Unexpected offset {offset}, expected {meta['received']}.")
+    if length > chunk_size():
+        raise UploadError("Chunk is too large.")
+    if meta['received'] + length > meta['size']:
+        raise UploadError("Upload exceeds the declared size.")
+
+    remaining = length
+    with open(_paths(upload_id)[1], 'ab') as f:
+        while remaining:
+            data = stream.read(min(COPY_BUFFER_SIZE, remaining))
+            if not data:
+                break
+            f.write(data)
+            remaining -= len(data)
+
+    meta['received'] += length - remaining
+    _write_meta(upload_id, meta)
+    return meta['received']
+
+
+def complete_upload(upload_id, user_id):
+    """
+    Finish an upload once every byte has been received and move it into the
+    content-addressed attachment store.
+
+    Returns:
+        The attachment ID (SHA-256) to reference from chat messages
+    """
+    meta = _read_meta(upload_id, user_id)
+    if meta['received'] != meta['size']:
+        raise UploadError(f"Upload incomplete: received {meta['received']} of {meta['size']} bytes.")
+
+    meta_path, part_path = _paths(upload_id)
+    with open(part_path, 'rb') as f:
+        attachment = attachments.store_file(f, meta['mime_type'], uploader=user_id)
+    os.remove(part_path)
+    os.remove(meta_path)
+    return attachment.sha256
@@ -1,8 +1,9 @@
 from django.urls import path
 from .views import (
     ConversationListView, ConversationDetailView,
-    start_conversation, send_message, update_conversation_title,
-    delete_conversation
+    start_conversation, send_message, stream_message, update_conversation_title,
+    delete_conversation, metrics_view, upload_start, upload_chunk, upload_complete,
+    attachment_file
 )
 
 app_name = 'interaction'
@@ -13,6 +14,12 @@ urlpatterns = [
     path('conversations/<uuid:pk>/', ConversationDetailView.as_view(), name='conversation_detail'),
     path('conversations/start/<int:tool_id>/', start_conversation, name='start_conversation'),
     path('conversations/<uuid:conversation_id>/send/', send_message, name='send_message'),
+    path('conversations/<uuid:conversation_id>/stream/', stream_message, name='stream_message'),
     path('conversations/<uuid:conversation_id>/update-title/', update_conversation_title, name='update_title'),
     path('conversations/<uuid:conversation_id>/delete/', delete_conversation, name='delete_conversation'),
+    path('uploads/', upload_start, name='upload_start'),
+    path('uploads/<uuid:upload_id>/', upload_chunk, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/complete/', upload_complete, name='upload_complete'),
+    path('attachments/<str:sha256>/', attachment_file, name='attachment'),
+    path('metrics/', metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -0,0 +1,256 @@
+"""
+Asynchronous Veo video generation.
+
+Veo answers with a long-running operation that takes minutes to finish.
+Instead of parking a worker thread in a ``time.sleep`` loop per request, every
+in-flight operation is registered with the :class:`OperationPoller` of its event
+loop, which checks all of them on one shared timer with
+``client.aio.operations.get``. Waiting costs no threads; finished videos are
+streamed from the provider straight into the attachment store.
+"""
+import asyncio
+import os
+import tempfile
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from google.genai import types
+
+from . import attachments, metrics
+from .providers import get_gemini_client, get_http_client
+
+VEO_MODEL = 'veo-2.0-generate-001'
+DOWNLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+MAX_POLL_FAILURES = 5
+
+
+def poll_interval():
+    return getattr(settings, 'VEO_POLL_INTERVAL', 10)
+
+
+def operation_timeout():
+    return getattr(settings, 'VEO_OPERATION_TIMEOUT', 15 * 60)
+
+
+def build_video_config(has_image, aspect_ratio="16:9", person_generation="ALLOW_ADULT",
+                       number_of_videos=1, duration_seconds=5, enhance_prompt=True):
+    """
+    Clamp user-supplied Veo parameters to the values the API accepts.
+
+    Returns:
+        ``types.GenerateVideosConfig``
+    """
+    if aspect_ratio not in ("16:9", "9:16"):
+        aspect_ratio = "16:9"
+    if person_generation not in ("DONT_ALLOW", "ALLOW_ADULT"):
+        person_generation = "ALLOW_ADULT"
+
+    config_params = {
+        "aspect_ratio": aspect_ratio,
+        "number_of_videos": max(1, min(2, number_of_videos)),
+        "duration_seconds": max(5, min(8, duration_seconds)),
+        "enhance_prompt": enhance_prompt,
+    }
+    # person_generation is only supported for text-to-video
+    if not has_image:
+        config_params["person_generation"] = person_generation
+    return types.GenerateVideosConfig(**config_params)
+
+
+class _PendingOperation:
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+        self.tick = None
+        self.failures = 0
+
+
+class OperationPoller:
+    """
+    Polls every pending long-running operation of one event loop on a shared timer.
+
+    Callers ``await wait(...)``; the poller task wakes them after each round with
+    the refreshed operation, so progress callbacks run in the caller's own task.
+    The poller task only exists while operations are pending.
+    """
+
+    def __init__(self):
+        self._pending = set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def wait(self, client, operation, on_progress=None, timeout=None):
+        """
+        Wait until ``operation`` is done.
+
+        Args:
+            client: The ``genai.Client`` that started the operation
+            operation: The operation returned by the ``generate_*`` call
+            on_progress: Optional coroutine function called with the elapsed seconds after each poll
+            timeout: Seconds to wait before giving up (defaults to VEO_OPERATION_TIMEOUT)
+
+        Returns:
+            The finished operation
+        """
+        loop = asyncio.get_running_loop()
+        timeout = operation_timeout() if timeout is None else timeout
+        started_at = time.monotonic()
+        entry = _PendingOperation(client, operation)
+        self._pending.add(entry)
+        try:
+            while not entry.operation.done:
+                entry.tick = loop.create_future()
+                if self._task is None or self._task.done():
+                    self._task = loop.create_task(self._run())
+                await entry.tick
+
+                elapsed = time.monotonic() - started_at
+                if entry.operation.done:
+                    break
+                if elapsed > timeout:
+                    metrics.incr('veo.operations_timed_out')
+                    raise TimeoutError(f"Operation did not finish within {int(timeout)} seconds.")
+                if on_progress:
+                    await on_progress(elapsed)
+            metrics.observe('veo.operation_time', time.monotonic() - started_at)
+            return entry.operation
+        finally:
+            self._pending.discard(entry)
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(poll_interval())
+            entries = [entry for entry in self._pending if entry.tick is not None and not entry.tick.done()]
+            metrics.incr('veo.poll_rounds')
+            await asyncio.gather(*(self._poll(entry) for entry in entries))
+
+    async def _poll(self, entry):
+        try:
+            entry.operation = await entry.client.aio.operations.get(entry.operation)
+            entry.failures = 0
+        except Exception as e:
+            entry.failures += 1
+            print(f"Error polling Veo operation (attempt {entry.failures}): {e}")
+            if entry.failures >= MAX_POLL_FAILURES and not entry.tick.done():
+                entry.tick.set_exception(e)
+                return
+        if not entry.tick.done():
+            entry.tick.set_result(None)
+
+
+_pollers = weakref.WeakKeyDictionary()
+
+
+def get_operation_poller():
+    """Return the operation poller of the running event loop."""
+    loop = asyncio.get_running_loop()
+    poller = _pollers.get(loop)
+    if poller is None:
+        poller = _pollers[loop] = OperationPoller()
+    return poller
+
+
+def _poller_stats():
+    return {'pending_operations': sum(len(poller) for poller in list(_pollers.values()))}
+
+
+metrics.register_collector('veo', _poller_stats)
+
+
+async def download_video(api_key, video):
+    """
+    Stream one generated video into the attachment store.
+
+    The body is spooled to a temporary file (in memory up to DOWNLOAD_SPOOL_SIZE)
+    as it arrives, so the whole video is never held as one bytes object.
+
+    Returns:
+        The Attachment
+    """
+    mime_type = video.mime_type or 'video/mp4'
+    if video.video_bytes:
+        return await sync_to_async(attachments.store_bytes, thread_sensitive=False)(video.video_bytes, mime_type)
+
+    with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE) as spool:
+        async with get_http_client().stream('GET', video.uri, headers={'x-goog-api-key': api_key}) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                spool.write(chunk)
+        metrics.incr('veo.downloaded_bytes', spool.tell())
+        spool.seek(0)
+        return await sync_to_async(attachments.store_file, thread_sensitive=False)(spool, mime_type)
+
+
+async def start_generation(client, prompt, image_data=None, **params):
+    """
+    Submit a Veo generation.
+
+    Returns:
+        The provider operation; its ``name`` can be stored to resume waiting later
+    """
+    image = None
+    if image_data:
+        if not (isinstance(image_data, str) and image_data.startswith('data:image')):
+            raise ValueError("Invalid image data format")
+        mime_type, image_bytes = attachments.parse_data_url(image_data)
+        image = types.Image(image_bytes=image_bytes, mime_type=mime_type)
+
+    metrics.incr('veo.operations_started')
+    return await client.aio.models.generate_videos(
+        model=VEO_MODEL,
+        prompt=prompt,
+        image=image,
+        config=build_video_config(image is not None, **params),
+    )
+
+
+def resume_operation(operation_name):
+    """Rebuild a handle for an operation started earlier (possibly by another process)."""
+    return types.GenerateVideosOperation(name=operation_name)
+
+
+async def collect_videos(api_key, client, operation, on_progress=None):
+    """
+    Wait for a Veo operation and store its videos.
+
+    Returns:
+        List of Attachments with the generated videos, or a dict with an error message
+    """
+    operation = await get_operation_poller().wait(client, operation, on_progress)
+    if operation.error:
+        return {"error": str(operation.error.get('message', operation.error))}
+    generated_videos = operation.response.generated_videos if operation.response else None
+    if not generated_videos:
+        return {"error": "No videos were generated."}
+    return [await download_video(api_key, generated.video) for generated in generated_videos]
+
+
+async def generate_videos(tool, prompt, image_data=None, on_progress=None, **params):
+    """
+    Generate videos with Veo without holding a thread while the operation runs.
+
+    Args:
+        tool: The AITool object
+        prompt: Text prompt for video generation
+        image_data: Optional base64 encoded image data URL for image-to-video generation
+        on_progress: Optional coroutine function called with the elapsed seconds while waiting
+        **params: aspect_ratio, person_generation, number_of_videos, duration_seconds, enhance_prompt
+
+    Returns:
+        List of Attachments with the generated videos, or a dict with an error message
+    """
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key:
+        return {"error": "Gemini API key not found."}
+
+    try:
+        client = get_gemini_client(api_key)
+        operation = await start_generation(client, prompt, image_data, **params)
+        return await collect_videos(api_key, client, operation, on_progress)
+    except Exception as e:
+        print(f"Veo API error: {str(e)}")
+        return {"error": f"Error generating video: {str(e)}"}
@@ -1,27 +1,32 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.http import FileResponse, Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
 from django.views.generic import ListView, DetailView
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
+from django.core.files.storage import FileSystemStorage
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
+import asyncio
 import json
 import random
+import time
 import os
-import requests
 import io
 import base64
-from openai import OpenAI
 import google.genai as genai
 from google.genai import types
 from PIL import Image
 import posthog # Import PostHog
 from django.conf import settings # Import Django settings
 
-from .models import Conversation, Message, Favorite
+from .models import Attachment, Conversation, Message, Favorite
 from .forms import MessageForm, ConversationTitleForm
+from . import adapters, admission, attachments, jobs, metrics, uploads, video_jobs, writebehind
+from .streaming import DeltaStreamer, PROTOCOL_VERSION
+from .providers import get_openai_client, get_gemini_client, run_sync
 from catalog.models import AITool
 
 
@@ -129,9 +134,9 @@ def start_conversation(request, tool_id):
 def send_message(request, conversation_id):
     """
     Send a message in a conversation.
-    NOTE: This view is primarily a fallback for non-JS/non-WebSocket scenarios or
-          for API types that don't support streaming via the ChatConsumer yet.
-          The main interaction for streaming APIs (OpenAI, Gemini) happens via WebSocket.
+    NOTE: This view is only the fallback for plain form posts (no JavaScript).
+          The chat page streams OpenAI/Gemini answers over the WebSocket and
+          every other API type over Server-Sent Events (see stream_message).
     """
     conversation = get_object_or_404(Conversation, id=conversation_id, user=request.user)
     
@@ -150,12 +155,16 @@ def send_message(request, conversation_id):
             # Generate AI response using the simulation/fallback function
             # This function handles dispatching to the correct non-streaming API call
             ai_response_content = simulate_ai_response(conversation.tool, user_content)
+            # Generated media goes to the attachment store; the message keeps only its URL
+            ai_response_content, media = attachments.replace_data_urls(ai_response_content)
             
             ai_message = Message.objects.create(
                 conversation=conversation,
                 is_from_user=False,
                 content=ai_response_content
             )
+            if media:
+                ai_message.attachments.add(*media)
             
             conversation.save() # Update timestamp
             
@@ -175,6 +184,85 @@ def send_message(request, conversation_id):
     return redirect('interaction:conversation_detail', pk=conversation.id)
 
 
+@login_required
+@require_POST
+async def stream_message(request, conversation_id):
+    """
+    Send a message and stream the answer as Server-Sent Events.
+
+    Works for every API type through the async adapters in adapters.py, so no
+    thread is held while the provider generates. Events carry the same frames
+    as the WebSocket protocol 2: ``queued``, ``ai_delta``, then ``ai_done`` or
+    ``error``.
+    """
+    user = await request.auser()
+    try:
+        conversation = await Conversation.objects.select_related('tool').aget(id=conversation_id, user=user)
+    except Conversation.DoesNotExist:
+        raise Http404("Conversation not found")
+
+    form = MessageForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors.get_json_data()}, status=400)
+    user_content = form.cleaned_data['content']
+    await writebehind.get_queue().settle(conversation.pk)
+    await Message.objects.acreate(conversation=conversation, is_from_user=True, content=user_content)
+
+    response = StreamingHttpResponse(_answer_events(conversation, user_content), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Keep reverse proxies from buffering the stream
+    return response
+
+
+async def _answer_events(conversation, user_message):
+    """Run the answer in its own task and yield its frames as SSE events."""
+    frames = asyncio.Queue()
+    producer = asyncio.create_task(_stream_answer(conversation, user_message, frames.put))
+    producer.add_done_callback(lambda finished: frames.put_nowait(None))
+    try:
+        while True:
+            frame = await frames.get()
+            if frame is None:
+                return
+            yield f"event: {frame['type']}\ndata: {json.dumps(frame)}\n\n"
+    finally:
+        # The client went away: stop generating, the partial answer is kept
+        producer.cancel()
+
+
+async def _stream_answer(conversation, user_message, send_event):
+    tool = conversation.tool
+    streamer = DeltaStreamer(send_event, protocol=PROTOCOL_VERSION)
+    started_at = time.monotonic()
+
+    async def report_position(position):
+        await send_event({'type': 'queued', 'position': position})
+
+    try:
+        async with admission.get_controller().admit(conversation.user_id, tool.api_type, on_queued=report_position):
+            async for delta in adapters.stream_text(tool, user_message):
+                if not streamer.content:
+                    metrics.observe(f'sse.ttft.{tool.api_type}', time.monotonic() - started_at)
+                await streamer.push(delta)
+        await streamer.flush()
+        writebehind.get_queue().write(conversation=conversation, is_from_user=False, content=streamer.content)
+        await streamer.finish()
+        metrics.incr(f'sse.answers.{tool.api_type}')
+    except asyncio.CancelledError:
+        streamer.close()
+        if streamer.content:
+            writebehind.get_queue().write(conversation=conversation, is_from_user=False,
+                                          content=streamer.content, is_truncated=True)
+        metrics.incr('sse.disconnected')
+        raise
+    except Exception as e:
+        streamer.close()
+        error_message = str(e) if isinstance(e, (adapters.AdapterError, admission.AdmissionRejected)) else f"Error from {tool.name}: {e}"
+        print(f"SSE answer error: {error_message}")
+        writebehind.get_queue().write(conversation=conversation, is_from_user=False, content=f"Error: {error_message}")
+        await send_event({'type': 'error', 'content': error_message})
+
+
 def simulate_ai_response(tool, user_message, image_url=None, is_image_generation=False, is_video_generation=False):
     """
     Dispatch to the appropriate non-streaming API generation function based on tool type.
@@ -233,9 +321,7 @@ def simulate_ai_response(tool, user_message, image_url=None, is_image_generation
                 
                 response = "Generated videos based on your prompt:\n\n"
                 for i, video in enumerate(result):
-                    if isinstance(video, dict) and "video_data" in video:
-                        video_data = video.get("video_data", "")
-                        response += f"Video {i+1}: {video_data}\n\n"
+                    response += f"Video {i+1}: <video controls src=\"{video.url}\" style=\"max-width: 100%;\"></video>\n\n"
                 return response
             else:
                 return fallback_response(tool, user_message, "Video generation is only available with Gemini API.")
@@ -277,7 +363,7 @@ def simulate_ai_response(tool, user_message, image_url=None, is_image_generation
                 for i, img in enumerate(result):
                     if isinstance(img, dict) and "image_data" in img:
                         image_data = img.get("image_data", "")
-                        response += f"Image {i+1}: {image_data}\n\n"
+                        response += f"Image {i+1}: ![Image {i+1}]({image_data})\n\n"
                 return response
             else:
                 return fallback_response(tool, user_message, "Image generation is only available with Gemini API.")
@@ -289,7 +375,7 @@ def simulate_ai_response(tool, user_message, image_url=None, is_image_generation
             
             response = result["text"] + "\n\n"
             for i, img_url in enumerate(result["images"]):
-                response += f"Edited image {i+1}: {img_url}\n\n"
+                response += f"Edited image {i+1}: ![Edited image {i+1}]({img_url})\n\n"
             return response
         
         # Handle regular text generation
@@ -299,8 +385,8 @@ def simulate_ai_response(tool, user_message, image_url=None, is_image_generation
             return generate_gemini_response(tool, user_message)
         elif tool.api_type == 'HUGGINGFACE':
             return generate_huggingface_response(tool, user_message)
-        elif tool.api_type == 'ANTHROPIC':
-            return fallback_response(tool, user_message, "Anthropic API integration is not yet available for non-streaming.")
+        elif tool.api_type in ('ANTHROPIC', 'CUSTOM'):
+            return generate_adapter_response(tool, user_message)
         elif tool.api_type == 'GOOGLE': # Consider renaming or removing if GEMINI covers all Google AI
             return fallback_response(tool, user_message, "Google AI API integration is not yet available for non-streaming.")
         else:
@@ -320,7 +406,7 @@ def generate_openai_response(tool, user_message):
         return fallback_response(tool, user_message, "OpenAI API key not found.")
 
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
         model = tool.api_model or "gpt-4o" # Default model
 
         # Using chat completions endpoint for consistency, text-only
@@ -346,7 +432,7 @@ def generate_gemini_response(tool, user_message):
         return fallback_response(tool, user_message, "Gemini API key not found.")
 
     try:
-        client = genai.Client(api_key=api_key)
+        client = get_gemini_client(api_key)
         model_name = tool.api_model or "gemini-2.0-flash"
         
         # Generate content with text only for this fallback
@@ -379,30 +465,31 @@ def generate_gemini_response(tool, user_message):
 
 def generate_huggingface_response(tool, user_message):
     """
-    Generate a response using Hugging Face API (placeholder/example).
-    Requires tool.api_endpoint to be set correctly.
+    Generate a response using the Hugging Face endpoint of the tool (tool.api_endpoint).
+    Runs the async adapter (huggingface.py) through providers.run_sync, with
+    the same request building and parsing as the streaming paths.
     """
-    api_key = os.environ.get('HUGGINGFACE_API_KEY') # Assumes HF key is needed
-    if not api_key:
-        return fallback_response(tool, user_message, "Hugging Face API key not found.")
-    if not tool.api_endpoint:
-         return fallback_response(tool, user_message, "Hugging Face model endpoint not configured for this tool.")
-
     try:
-        headers = {"Authorization": f"Bearer {api_key}"}
-        payload = {"inputs": user_message}
-        response = requests.post(tool.api_endpoint, headers=headers, json=payload, timeout=30)
-        response.raise_for_status() # Raise an exception for bad status codes
-        result = response.json()
-        # The actual response structure depends heavily on the specific HF model/API
-        # This is a common structure for text generation models
-        return result[0].get('generated_text', "Sorry, I couldn't process that.")
-    except requests.exceptions.RequestException as e:
-         return fallback_response(tool, user_message, f"Hugging Face API request error: {str(e)}")
+        return run_sync(adapters.complete_text, tool, user_message)
+    except adapters.AdapterError as e:
+        return fallback_response(tool, user_message, str(e))
     except Exception as e:
         return fallback_response(tool, user_message, f"Hugging Face API error: {str(e)}")
 
 
+def generate_adapter_response(tool, user_message):
+    """
+    Non-streaming response through the async adapter of the tool's API type
+    (Anthropic, OpenAI-compatible CUSTOM servers), see adapters.py.
+    """
+    try:
+        return run_sync(adapters.complete_text, tool, user_message)
+    except adapters.AdapterError as e:
+        return fallback_response(tool, user_message, str(e))
+    except Exception as e:
+        return fallback_response(tool, user_message, f"{tool.get_api_type_display()} error: {str(e)}")
+
+
 def generate_imagen_image(tool, prompt, number_of_images=1, aspect_ratio="1:1", person_generation="ALLOW_ADULT"):
     """
     Generate images using Imagen 3 model.
@@ -422,7 +509,7 @@ def generate_imagen_image(tool, prompt, number_of_images=1, aspect_ratio="1:1",
         return {"error": "Gemini API key not found."}
     
     try:
-        client = genai.Client(api_key=api_key)
+        client = get_gemini_client(api_key)
         model = 'imagen-3.0-generate-002'  # Imagen 3 model
         
         number_of_images = max(1, min(4, number_of_images))
@@ -458,7 +545,7 @@ def generate_imagen_image(tool, prompt, number_of_images=1, aspect_ratio="1:1",
     
     except Exception as e:
         print(f"Imagen API error: {str(e)}")
-        return {"error": f"Error generating image: {str(e)}"}
+        return {"error": f"Error generating image: {str(e)}", "retriable": jobs.is_transient(e)}
 
 
 def generate_gemini_image_edit(tool, prompt, image_data, response_modalities=None):
@@ -479,7 +566,7 @@ def generate_gemini_image_edit(tool, prompt, image_data, response_modalities=Non
         return {"error": "Gemini API key not found."}
     
     try:
-        client = genai.Client(api_key=api_key)
+        client = get_gemini_client(api_key)
         model = "gemini-1.5-flash"
         
         if response_modalities is None:
@@ -519,113 +606,23 @@ def generate_gemini_image_edit(tool, prompt, image_data, response_modalities=Non
     
     except Exception as e:
         print(f"Gemini image editing error: {str(e)}")
-        return {"error": f"Error editing image: {str(e)}"}
+        return {"error": f"Error editing image: {str(e)}", "retriable": jobs.is_transient(e)}
 
 
-def generate_veo_video(tool, prompt, image_data=None, aspect_ratio="16:9", person_generation="ALLOW_ADULT", 
-                      number_of_videos=1, duration_seconds=5, enhance_prompt=True):
+def generate_veo_video(tool, prompt, image_data=None, **params):
     """
-    Generate videos using Veo model.
+    Generate videos using Veo model (synchronous wrapper around video_jobs.generate_videos).
     
     Args:
         tool: The AITool object
         prompt: Text prompt for video generation
-        image_data: Optional base64 encoded image data or PIL Image object for image-to-video generation
-        aspect_ratio: Aspect ratio of generated videos ("16:9" or "9:16")
-        person_generation: Person generation policy ("DONT_ALLOW" or "ALLOW_ADULT") - only for text-to-video
-        number_of_videos: Number of videos to generate (1 or 2)
-        duration_seconds: Length of each output video in seconds (5-8)
-        enhance_prompt: Enable or disable the prompt rewriter
+        image_data: Optional base64 encoded image data for image-to-video generation
+        **params: aspect_ratio, person_generation, number_of_videos, duration_seconds, enhance_prompt
         
     Returns:
-        List of dictionaries with video data or error message
+        List of Attachments with the generated videos or error message
     """
-    api_key = os.environ.get('GEMINI_API_KEY')
-    if not api_key:
-        return {"error": "Gemini API key not found."}
-    
-    try:
-        client = genai.Client(api_key=api_key)
-        model = 'veo-2.0-generate-001'  # Veo model
-        
-        valid_aspect_ratios = ["16:9", "9:16"]
-        if aspect_ratio not in valid_aspect_ratios:
-            aspect_ratio = "16:9"  # Default to 16:9 if invalid
-        
-        valid_person_generation = ["DONT_ALLOW", "ALLOW_ADULT"]
-        if person_generation not in valid_person_generation:
-            person_generation = "ALLOW_ADULT"  # Default
-        
-        number_of_videos = max(1, min(2, number_of_videos))
-        duration_seconds = max(5, min(8, duration_seconds))
-        
-        config_params = {
-            "aspect_ratio": aspect_ratio,
-            "number_of_videos": number_of_videos,
-            "duration_seconds": duration_seconds,
-            "enhance_prompt": enhance_prompt
-        }
-        
-        # For text-to-video, we can specify person_generation
-        if image_data is None:
-            config_params["person_generation"] = person_generation
-        
-        pil_image = None
-        if image_data:
-            if isinstance(image_data, str) and image_data.startswith('data:image'):
-                header, encoded = image_data.split(',', 1)
-                decoded_bytes = base64.b64decode(encoded)
-                pil_image = Image.open(io.BytesIO(decoded_bytes))
-            elif isinstance(image_data, Image.Image):
-                pil_image = image_data
-            else:
-                return {"error": "Invalid image data format"}
-        
-        if pil_image:
-            # Image-to-video generation
-            operation = client.models.generate_videos(
-                model=model,
-                prompt=prompt,
-                image=pil_image,
-                config=types.GenerateVideosConfig(**config_params)
-            )
-        else:
-            # Text-to-video generation
-            operation = client.models.generate_videos(
-                model=model,
-                prompt=prompt,
-                config=types.GenerateVideosConfig(**config_params)
-            )
-        
-        import time
-        while not operation.done:
-            time.sleep(20)
-            operation = client.operations.get(operation)
-        
-        result = []
-        for i, video in enumerate(operation.response.generated_videos):
-            video_filename = f"video_{int(time.time())}_{i}.mp4"
-            video_path = os.path.join("/tmp", video_filename)
-            
-            client.files.download(file=video.video)
-            video.video.save(video_path)
-            
-            with open(video_path, "rb") as video_file:
-                video_bytes = video_file.read()
-                base64_video = base64.b64encode(video_bytes).decode('utf-8')
-            
-            result.append({
-                "video_data": f"data:video/mp4;base64,{base64_video}",
-                "prompt": prompt
-            })
-            
-            os.remove(video_path)
-        
-        return result
-    
-    except Exception as e:
-        print(f"Veo API error: {str(e)}")
-        return {"error": f"Error generating video: {str(e)}"}
+    return run_sync(video_jobs.generate_videos, tool, prompt, image_data, **params)
 
 
 def fallback_response(tool, user_message, error_message=None):
@@ -644,6 +641,77 @@ def fallback_response(tool, user_message, error_message=None):
         return random.choice(responses)
 
 
+@login_required
+def upload_start(request):
+    """
+    Start a chunked media upload (see uploads.py for the protocol).
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required.'}, status=405)
+    try:
+        data = json.loads(request.body or b'{}')
+        upload_id = uploads.start_upload(
+            request.user.id,
+            name=data.get('name'),
+            mime_type=data.get('mime_type'),
+            size=int(data.get('size') or 0),
+        )
+    except (ValueError, uploads.UploadError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'upload_id': upload_id, 'chunk_size': uploads.chunk_size()})
+
+
+@login_required
+def upload_chunk(request, upload_id):
+    """
+    Append one raw chunk (request body) to an upload at the given ?offset=.
+    """
+    if request.method != 'PUT':
+        return JsonResponse({'error': 'PUT required.'}, status=405)
+    try:
+        offset = int(request.GET.get('offset', 0))
+        length = int(request.headers.get('Content-Length') or 0)
+        received = uploads.append_chunk(upload_id, request.user.id, offset, request, length)
+    except (ValueError, uploads.UploadError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'offset': received})
+
+
+@login_required
+def upload_complete(request, upload_id):
+    """
+    Finish a chunked upload and return the attachment ID to send with the chat message.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required.'}, status=405)
+    try:
+        attachment_id = uploads.complete_upload(upload_id, request.user.id)
+    except uploads.UploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'attachment_id': attachment_id})
+
+
+@login_required
+def attachment_file(request, sha256):
+    """
+    Serve a stored attachment to a user who uploaded it or whose messages reference it.
+    Files in remote (S3) storage are private: the user is redirected to a signed, expiring URL.
+    """
+    if request.user.is_staff:
+        attachment = get_object_or_404(Attachment, sha256=sha256)
+    else:
+        attachment = get_object_or_404(attachments.user_attachments(request.user), sha256=sha256)
+    if not isinstance(attachment.file.storage, FileSystemStorage):
+        response = redirect(attachment.file.url)
+        # The signed URL expires, so the redirect must not outlive it
+        response['Cache-Control'] = 'private, no-store'
+        return response
+    response = FileResponse(attachment.file.open('rb'), content_type=attachment.mime_type)
+    # Content-addressed: the bytes behind this URL never change
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
 @login_required
 def update_conversation_title(request, conversation_id):
     """
@@ -686,3 +754,12 @@ def delete_conversation(request, conversation_id):
     # You might want to redirect to list if accessed via GET directly
     # return render(request, 'interaction/delete_confirmation.html', {'conversation': conversation})
     return redirect('interaction:conversation_list')
+
+
+@login_required
+@user_passes_test(lambda user: user.is_staff)
+def metrics_view(request):
+    """
+    Return the process-local interaction metrics (executor queues, pools, caches...) as JSON.
+    """
+    return JsonResponse(metrics.snapshot())
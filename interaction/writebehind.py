@@ -0,0 +1,204 @@
+"""
+Write-behind persistence for chat messages.
+
+AI replies, error rows and conversation ``updated_at`` touches do not need to
+be committed before the client sees them, so instead of one serialized
+database round trip each they are queued here and written by a background
+task in batched transactions: every ``CHAT_WRITE_BEHIND_INTERVAL_MS``
+milliseconds, or as soon as ``CHAT_WRITE_BEHIND_BATCH`` writes are pending.
+
+Messages of a conversation must keep their order, so before a new user
+message is saved (and before history is read) :meth:`WriteBehindQueue.settle`
+waits for that conversation's queued writes. Sockets flush the queue when they
+disconnect and the lifespan shutdown hook flushes it before the process exits; under Daphne, which has no lifespan
+support, the ``atexit`` hook writes what is left synchronously.
+"""
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import lifespan, metrics
+from .models import Conversation, Message
+
+
+def flush_interval():
+    return getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL_MS', 50) / 1000
+
+
+def batch_size():
+    return getattr(settings, 'CHAT_WRITE_BEHIND_BATCH', 50)
+
+
+class _PendingMessage:
+    def __init__(self, fields, media, future):
+        self.fields = fields
+        self.media = list(media)
+        self.future = future
+        self.message = None
+
+
+def _create(pending):
+    pending.message = Message.objects.create(**pending.fields)
+    if pending.media:
+        pending.message.attachments.add(*pending.media)
+
+
+def _write_batch(messages, touched):
+    """Write one batch in a single transaction, or row by row if the batch fails."""
+    try:
+        with transaction.atomic():
+            for pending in messages:
+                _create(pending)
+            if touched:
+                Conversation.objects.filter(id__in=touched).update(updated_at=timezone.now())
+        return
+    except Exception as e:
+        print(f"Error writing message batch, retrying row by row: {e}")
+        for pending in messages:
+            pending.message = None
+
+    for pending in messages:
+        try:
+            with transaction.atomic():
+                _create(pending)
+        except Exception as e:
+            metrics.incr('write_behind.failed')
+            print(f"Error saving message for conversation {pending.fields.get('conversation')}: {e}")
+    if touched:
+        try:
+            Conversation.objects.filter(id__in=touched).update(updated_at=timezone.now())
+        except Exception as e:
+            print(f"Error touching conversations: {e}")
+
+
+class WriteBehindQueue:
+    """
+    Pending message writes of the process, flushed by a task on the event loop
+    that queued them first.
+    """
+
+    def __init__(self):
+        self._messages = []
+        self._touched = set()
+        self._task = None
+        self._wakeup = None
+        self._flush_lock = None
+        self._pending = {}  # conversation ID -> queued or in-flight messages
+
+    def write(self, media=(), **fields):
+        """
+        Queue a Message to be created with ``fields`` and linked to ``media``.
+
+        Returns:
+            A future resolved with the Message once it is committed (None if it
+            could not be saved); awaiting it is optional.
+        """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._messages.append(_PendingMessage(fields, media, future))
+        conversation = fields.get('conversation')
+        if conversation is not None:
+            self._touched.add(conversation.pk)
+            self._pending[conversation.pk] = self._pending.get(conversation.pk, 0) + 1
+            future.add_done_callback(lambda finished, pk=conversation.pk: self._settled(pk))
+        metrics.incr('write_behind.queued')
+        self._wake()
+        return future
+
+    def _settled(self, conversation_id):
+        remaining = self._pending.get(conversation_id, 0) - 1
+        if remaining > 0:
+            self._pending[conversation_id] = remaining
+        else:
+            self._pending.pop(conversation_id, None)
+
+    async def settle(self, conversation_id):
+        """
+        Wait until every message queued for a conversation is committed, so
+        that the rows written next get later IDs and reads see them.
+        """
+        if self._pending.get(conversation_id):
+            metrics.incr('write_behind.settled')
+            await self.flush()
+
+    def touch(self, conversation_id):
+        """Queue an ``updated_at`` bump for a conversation."""
+        self._start()
+        self._touched.add(conversation_id)
+        self._wake()
+
+    def _start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _wake(self):
+        if len(self._messages) >= batch_size():
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=flush_interval())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # Shielded so stop() cannot drop a batch that is being written
+                await asyncio.shield(self.flush())
+            except Exception as e:
+                print(f"Error flushing write-behind queue: {e}")
+
+    async def flush(self):
+        """Write everything queued so far and wait until it is committed."""
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            while self._messages or self._touched:
+                messages, self._messages = self._messages[:batch_size()], self._messages[batch_size():]
+                touched, self._touched = self._touched, set()
+                await database_sync_to_async(_write_batch)(messages, touched)
+                metrics.incr('write_behind.batches')
+                metrics.incr('write_behind.written', sum(1 for pending in messages if pending.message is not None))
+                for pending in messages:
+                    if not pending.future.done():
+                        pending.future.set_result(pending.message)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+
+    def flush_sync(self):
+        """Write what is left when the event loop is already gone (interpreter exit)."""
+        messages, self._messages = self._messages, []
+        touched, self._touched = self._touched, set()
+        if messages or touched:
+            _write_batch(messages, touched)
+
+    def stats(self):
+        return {
+            'pending_messages': len(self._messages),
+            'pending_touches': len(self._touched),
+            'pending_conversations': len(self._pending),
+        }
+
+
+_queue = WriteBehindQueue()
+metrics.register_collector('write_behind', _queue.stats)
+
+
+def get_queue():
+    return _queue
+
+
+lifespan.on_shutdown(_queue.stop)
+lifespan.on_sync_shutdown(_queue.flush_sync)